@@ -1,6 +1,15 @@
 from __future__ import with_statement
 from functools import wraps
+from itertools import islice
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
 
 try:
     from cStringIO import StringIO
@@ -10,12 +19,12 @@ except ImportError:
 os.environ["DJANGO_SETTINGS_MODULE"] = "wind.settings.local"
 
 from boto.exception import S3ResponseError
-from boto.s3.connection import S3Connection
+from boto.s3.connection import S3Connection, SubdomainCallingFormat
 from bs4 import BeautifulSoup
 from cssmin import cssmin
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from fabric.api import local, run, env, cd, lcd, task
+from fabric.api import local, run, env, cd, lcd, puts, task
 from fabric.contrib.console import confirm
 from hashlib import md5
 from slimit import minify
@@ -40,6 +49,21 @@ AUTO_CREATE_BUCKET = getattr(settings, "AWS_AUTO_CREATE_BUCKET", False)
 SHOULD_GZIP = getattr(settings, "AWS_IS_GZIPPED", True)
 BUCKET_ACL = getattr(settings, "BUCKET_ACL", "public-read")
 DEFAULT_ACL = getattr(settings, "DEFAULT_ACL", "public-read")
+# Where S3 is, which can be pointed at a local fake S3 to try uploads out
+S3_HOST = getattr(settings, "AWS_S3_HOST", S3Connection.DefaultHost)
+S3_PORT = getattr(settings, "AWS_S3_PORT", None)
+S3_SECURE = getattr(settings, "AWS_S3_SECURE_URLS", True)
+S3_CALLING_FORMAT = getattr(settings, "AWS_S3_CALLING_FORMAT",
+                            SubdomainCallingFormat())
+S3_UPLOAD_MANIFEST = getattr(settings, "S3_UPLOAD_MANIFEST", None)
+S3_UPLOAD_THREADS = getattr(settings, "S3_UPLOAD_THREADS", 4)
+STATIC_BUILD_MANIFEST = getattr(settings, "STATIC_BUILD_MANIFEST", None)
+STATIC_BUILD_PROCESSES = getattr(settings, "STATIC_BUILD_PROCESSES",
+                                 multiprocessing.cpu_count())
+
+# Matches the file of LESS imports like @import "base"; and
+# @import (reference) url('mixins.less');
+LESS_IMPORT_RE = re.compile(r"""@import\s*(?:\([^)]*\)\s*)?(?:url\(\s*)?["']([^"']+)["']""")
 
 if SHOULD_GZIP:
     from gzip import GzipFile
@@ -84,26 +108,52 @@ def check_remote_root(func):
     return wrapper
 
 
-@check_local_root
-def _convert_to_css(filename):
+def _convert_to_css(filename, temp_dir):
     """
-    Converts a LESS file into a CSS file and stores it in temp directory
+    Converts a LESS file into a CSS file and stores it in temp_dir
+
+    Runs in the build's worker processes, so lessc is run directly rather
+    than through fabric, whose aborts would take the worker down with them
 
     Returns path to new css file
     """
-    root = LOCAL_PROJECT_ROOT
-    if not root.endswith("/"):
-        root += "/"
-    root += "temp/"
-    if not os.path.isdir(root):
-        # Create 'temp' dir if doesn't already exist
-        os.makedirs(root)
-    branch = filename.split("/")[-1].replace(".less", ".css")
-    new_filename = root + branch
-    local("lessc {0} > {1}".format(filename, new_filename))
+    handle, new_filename = tempfile.mkstemp(suffix=".css", dir=temp_dir)
+    with os.fdopen(handle, "w") as f:
+        try:
+            subprocess.check_call(["lessc", filename], stdout=f)
+        except subprocess.CalledProcessError as e:
+            # CalledProcessError can't be unpickled, which would leave the
+            # pool waiting on the worker forever
+            raise RuntimeError("lessc failed on {0} with exit status {1}"
+                               .format(filename, e.returncode))
     return new_filename
 
 
+def _read_source(job):
+    """
+    Runs in the build's worker processes
+
+    Returns the contents of a static file, as CSS if it's a LESS file
+    """
+    filename, temp_dir = job
+    if filename.endswith(".less"):
+        filename = _convert_to_css(filename, temp_dir)
+    with open(filename, "r") as f:
+        return f.read()
+
+
+def _minify(job):
+    """
+    Runs in the build's worker processes
+
+    Returns a bundle's combined files minified
+    """
+    ext, combined = job
+    if ext == "css":
+        return cssmin(combined)
+    return minify(combined)
+
+
 def _compress_content(content):
     """
     Gzip a given string.
@@ -114,35 +164,183 @@ def _compress_content(content):
     return buf.getvalue()
 
 
-def _s3_upload(filename, content, content_type):
+class S3Uploader(object):
+    """
+    Uploads static bundles to the bucket over one connection
+
+    Bundles are named by a hash of their contents, so a key that's already
+    in the bucket never needs uploading again. Keys uploaded before are kept
+    in a local manifest, per bucket, and skipped without asking S3, and the
+    others are only uploaded if a HEAD request doesn't find them.
+    """
+    def __init__(self, bucket_name=BUCKET_NAME, manifest_path=None,
+                 threads=S3_UPLOAD_THREADS, connection=None):
+        self.bucket_name = bucket_name
+        self.manifest_path = manifest_path or _upload_manifest_path()
+        self.threads = threads
+        self.connection = connection or S3Connection(
+            ACCESS_KEY, SECRET_ACCESS_KEY, host=S3_HOST, port=S3_PORT,
+            is_secure=S3_SECURE, calling_format=S3_CALLING_FORMAT)
+        self.uploaded = set(self._read_manifest().get(bucket_name, []))
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        """
+        Gets the bucket the first time it's needed, so runs where every key
+        is in the manifest don't connect at all
+        """
+        if self._bucket is None:
+            try:
+                self._bucket = self.connection.get_bucket(
+                    self.bucket_name, validate=AUTO_CREATE_BUCKET)
+            except S3ResponseError:
+                if AUTO_CREATE_BUCKET:
+                    self._bucket = self.connection.create_bucket(
+                        self.bucket_name)
+                    self._bucket.set_acl(BUCKET_ACL)
+                else:
+                    raise ImproperlyConfigured("Bucket given by "
+                        "AWS_STORAGE_BUCKET doesn't exist. Buckets can be "
+                        "created automatically by setting "
+                        "AWS_AUTO_CREATE_BUCKET to True")
+        return self._bucket
+
+    def upload(self, filename, content, content_type):
+        """
+        Uploads a file to S3 given a name and content, unless it's there
+        already
+
+        Returns whether it was uploaded
+        """
+        if filename in self.uploaded:
+            return False
+        if self.bucket.get_key(filename) is None:
+            # Copied, since uploads run at the same time
+            headers = dict(HEADERS)
+            headers["Content-Type"] = content_type
+            if SHOULD_GZIP:
+                content = _compress_content(content)
+                headers["Content-Encoding"] = "gzip"
+
+            k = self.bucket.new_key(filename)
+            k.set_metadata("Content-Type", content_type)
+            k.set_contents_from_string(content,
+                                       headers=headers, policy=DEFAULT_ACL)
+            uploaded = True
+        else:
+            uploaded = False
+        self.uploaded.add(filename)
+        return uploaded
+
+    def upload_many(self, files):
+        """
+        Uploads (name, content, content type) tuples at the same time, and
+        records the ones that made it in the manifest
+
+        Returns the names of the files that were uploaded
+        """
+        if not files:
+            return []
+        if any(name not in self.uploaded for name, content, content_type in files):
+            # Looked up before the threads start, so they don't race to
+            # get or create the bucket
+            self.bucket
+        pool = ThreadPool(min(self.threads, len(files)))
+        try:
+            uploaded = pool.map(lambda args: self.upload(*args), files)
+        finally:
+            pool.close()
+            pool.join()
+            self.save_manifest()
+        return [name for (name, content, content_type), was_uploaded
+                in zip(files, uploaded) if was_uploaded]
+
+    def _read_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def save_manifest(self):
+        # Other buckets' keys are kept
+        manifest = self._read_manifest()
+        manifest[self.bucket_name] = sorted(self.uploaded)
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def _as_bool(value):
     """
-    Upload a file to S3 given a name and content
+    Fabric passes task arguments as strings, so 'False' shouldn't count as true
     """
-    conn = S3Connection(ACCESS_KEY, SECRET_ACCESS_KEY)
+    if isinstance(value, basestring):
+        return value.lower() not in ("", "0", "false", "no", "n")
+    return bool(value)
+
+
+def _less_sources(filename, seen=None):
+    """
+    Returns filename and every LESS file it imports, recursively, in the
+    order they're first imported
+
+    Imports are looked up relative to the importing file, as lessc does.
+    Ones that can't be found locally, like remote URLs, are left out
+    """
+    if seen is None:
+        seen = []
+    filename = os.path.abspath(filename)
+    if filename in seen:
+        return seen
+    seen.append(filename)
+    with open(filename, "r") as f:
+        imports = LESS_IMPORT_RE.findall(f.read())
+    for imported in imports:
+        if not os.path.splitext(imported)[1]:
+            imported += ".less"
+        imported = os.path.join(os.path.dirname(filename), imported)
+        if os.path.isfile(imported):
+            _less_sources(imported, seen)
+    return seen
+
+
+def _hash_inputs(filenames):
+    """
+    Returns [filename, md5 of its contents] for each of filenames, which is
+    what a bundle built from them is recorded against in the build manifest
+    """
+    inputs = []
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            inputs.append([filename, md5(f.read()).hexdigest()])
+    return inputs
 
-    try:
-        bucket = conn.get_bucket(BUCKET_NAME, validate=AUTO_CREATE_BUCKET)
-    except S3ResponseError:
-        if AUTO_CREATE_BUCKET:
-            bucket = conn.create_bucket(BUCKET_NAME)
-            bucket.set_acl(BUCKET_ACL)
-        else:
-            raise ImproperlyConfigured("Bucket given by AWS_STORAGE_BUCKET "
-                "doesn't exist. Buckets can be created automatically by "
-                "setting AWS_AUTO_CREATE_BUCKET to True")
 
-    k = bucket.get_key(filename)
-    if not k:
-        k = bucket.new_key(filename)
-    k.set_metadata("Content-Type", content_type)
-    HEADERS["Content-Type"] = content_type
+def _manifest_path():
+    return STATIC_BUILD_MANIFEST or os.path.join(LOCAL_PROJECT_ROOT,
+                                                 "static_build.json")
 
-    if SHOULD_GZIP:
-        content = _compress_content(content)
-        HEADERS["Content-Encoding"] = "gzip"
 
-    k.set_contents_from_string(content,
-                               headers=HEADERS, policy=DEFAULT_ACL)
+def _upload_manifest_path():
+    return S3_UPLOAD_MANIFEST or os.path.join(LOCAL_PROJECT_ROOT,
+                                              "s3_uploads.json")
+
+
+def _read_manifest():
+    """
+    Returns the build manifest, mapping each bundle ('css' or 'js') to the
+    files it's made of in order, the hashes of every file it was built from,
+    imports included, and the name it was uploaded as
+    """
+    if not os.path.isfile(_manifest_path()):
+        return {}
+    with open(_manifest_path(), "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest):
+    with open(_manifest_path(), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
 
 
 def _find_file(filename, directories):
@@ -189,12 +387,17 @@ def _get_static_file(filepath):
                         .format(filepath))
 
 
-def _update_static(exts):
+@check_local_root
+def _update_static(exts, force=False):
     """
     Implements the combination, minification, and compression of static files.
 
     Filename is hashed so a far future Expires header can be set on it.
     Thus, we need to change the filename (the hash) when we make changes.
+
+    Bundles whose files, including the LESS files they import, haven't changed
+    since the last build recorded in the build manifest are skipped without
+    compiling or uploading anything, unless force is set.
     """
     base_html_file = _get_base_html()
     with open(base_html_file, "r") as base:
@@ -206,6 +409,8 @@ def _update_static(exts):
         # of <head> and adding <p> tags around it for some reason
         soup = BeautifulSoup(base.read(), "html.parser")
 
+    manifest = _read_manifest()
+    bundles = []
     # For both js and css if updating both
     for ext in exts:
         files_to_include = soup.select(".minify-{0}".format(ext))
@@ -214,76 +419,132 @@ def _update_static(exts):
                 " files, you need to set a class of 'minify-{1} on the "
                 "links/scripts you want to include".format(ext.upper(), ext))
 
-        combined = ""
-        # Concatenate selected files into 'combined'
-        for static_file in files_to_include:
-            if ext == "css":
-                fname = _get_static_file(static_file["href"])
-                clear_temp = False
-                if fname.endswith(".less"):
-                    clear_temp = True
-                    fname = _convert_to_css(fname)
-            else:  # JS
-                fname = _get_static_file(static_file["src"])
-            with open(fname, "r") as f:
-                combined += f.read()
-                if clear_temp:
-                    # If converted from LESS, should clean up temp CSS file
-                    os.remove(fname)
-
-        hashed_name = "{0}/{1}.min.{0}".format(ext, md5(combined).hexdigest())
-
-        if ext == "css":
-            minifier = cssmin
-            content_type = "text/css"
-        else:
-            minifier = minify
-            content_type = "application/javascript"
-
-        minified = minifier(combined)
-        _s3_upload(hashed_name, minified, content_type)
-
-        destination = soup.select(".minified-{0}".format(ext))[0]
-        if not destination:
+        destinations = soup.select(".minified-{0}".format(ext))
+        if not destinations:
             raise ImproperlyConfigured("You need a {0} element with a class "
                 "of 'minified-{1}' as a placeholder element for the compressed"
                 " {2} {0}.".format("link" if ext == "css" else "script",
                                    ext, ext.upper()))
+        destination = destinations[0]
 
+        if ext == "css":
+            fnames = [_get_static_file(static_file["href"])
+                      for static_file in files_to_include]
+        else:  # JS
+            fnames = [_get_static_file(static_file["src"])
+                      for static_file in files_to_include]
+
+        sources = []
+        for fname in fnames:
+            if fname.endswith(".less"):
+                sources.extend(_less_sources(fname))
+            else:
+                sources.append(os.path.abspath(fname))
+        files = [os.path.abspath(fname) for fname in fnames]
+        inputs = _hash_inputs(sources)
+        built = manifest.get(ext)
+        if (not force and built and built["files"] == files
+                and built["inputs"] == inputs
+                and destination.attrs.get("href", "").endswith(built["name"])):
+            puts("{0} unchanged since {1}, skipping".format(ext.upper(),
+                                                             built["name"]))
+            continue
+
+        bundles.append((ext, fnames, files, inputs, destination))
+
+    if not bundles:
+        return
+
+    timings = []
+    temp_dir = tempfile.mkdtemp(prefix="static-build-")
+    processes = min(STATIC_BUILD_PROCESSES,
+                    sum(len(bundle[1]) for bundle in bundles))
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    mapper = pool.map if pool else map
+    try:
+        # Every file of every bundle is read, and compiled from LESS, at once.
+        # map keeps them in order, so they're concatenated in the order
+        # they're linked from base HTML
+        start = time.time()
+        contents = iter(mapper(_read_source, [(fname, temp_dir)
+                                              for bundle in bundles
+                                              for fname in bundle[1]]))
+        combined = ["".join(islice(contents, len(bundle[1])))
+                    for bundle in bundles]
+        timings.append(("compile", time.time() - start))
+
+        start = time.time()
+        minified = mapper(_minify, [(bundle[0], content) for bundle, content
+                                    in zip(bundles, combined)])
+        timings.append(("minify", time.time() - start))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        shutil.rmtree(temp_dir)
+
+    hashed_names = ["{0}/{1}.min.{0}".format(bundle[0],
+                                              md5(content).hexdigest())
+                    for bundle, content in zip(bundles, combined)]
+    content_types = [("text/css" if bundle[0] == "css"
+                      else "application/javascript") for bundle in bundles]
+
+    start = time.time()
+    uploaded = S3Uploader().upload_many(zip(hashed_names, minified,
+                                            content_types))
+    timings.append(("upload", time.time() - start))
+    puts("Uploaded {0} of {1} bundles".format(len(uploaded), len(bundles)))
+
+    for (ext, fnames, files, inputs, destination), hashed_name \
+            in zip(bundles, hashed_names):
         if "{{ STATIC_URL }}" in destination.attrs["href"]:
             new_href = "{{ STATIC_URL }}" + hashed_name
         else:
             new_href = hashed_name
 
         destination.attrs["href"] = new_href
+        manifest[ext] = {"files": files, "inputs": inputs, "name": hashed_name}
 
     # Write changed href(s) to base HTML file
     with open(base_html_file, "w") as f:
         f.write(unicode(soup.prettify()))
+    _write_manifest(manifest)
+
+    for stage, elapsed in timings:
+        puts("{0:>8}: {1:.2f}s".format(stage, elapsed))
 
 
 @task
-def update_css():
+def update_css(force=False):
     """
     Combines, minifies, and compresses CSS stylesheets.
+
+    Skipped if they haven't changed since the last build. Run with
+    update_css:force=True to build them anyway.
     """
-    _update_static(("css",))
+    _update_static(("css",), _as_bool(force))
 
 
 @task
-def update_js():
+def update_js(force=False):
     """
     Combines, minifies, and compresses JS scripts.
+
+    Skipped if they haven't changed since the last build. Run with
+    update_js:force=True to build them anyway.
     """
-    _update_static(("js",))
+    _update_static(("js",), _as_bool(force))
 
 
 @task
-def update_css_and_js():
+def update_css_and_js(force=False):
     """
     Combines, minifies, and compresses CSS stylesheets and JS scripts.
+
+    Each is skipped if it hasn't changed since the last build. Run with
+    update_css_and_js:force=True to build them anyway.
     """
-    _update_static(("css", "js"))
+    _update_static(("css", "js"), _as_bool(force))
 
 
 @task
@@ -311,6 +572,16 @@ def migrate_database():
             run("./manage.py migrate {0}".format(app))
 
 
+@task
+@check_remote_root
+def invalidate_page_cache():
+    """
+    Invalidates every cached page on server, so new templates show up
+    """
+    with cd(REMOTE_PROJECT_ROOT):
+        run("./manage.py invalidate_page_cache")
+
+
 @task
 def restart():
     """
@@ -360,7 +631,7 @@ def deploy(amend=False):
     Asks user if we need to update css, syncdb, or migrate and responds
     accordingly.
 
-    Finally restarts server
+    Finally restarts server and invalidates the cached pages
     """
     new_css = new_js = sync = migrate = install_reqs = False
     if confirm("Do we need to update css or js, syncdb, migrate, or update "
@@ -404,3 +675,5 @@ def deploy(amend=False):
 
     if RESTART_PATH:
         restart()
+
+    invalidate_page_cache()
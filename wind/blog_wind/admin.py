@@ -1,7 +1,49 @@
+import json
+
+from django.conf.urls import patterns, url
 from django.contrib import admin
+from django.contrib.admin.actions import delete_selected as confirm_delete_selected
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.utils.encoding import force_unicode
 from sorl.thumbnail.admin import AdminImageMixin
 
-from blog_wind.models import Post, Photo, Gallery, GalleryUpload
+from blog_wind.models import Post, PostToken, Photo, Gallery, GalleryUpload
+
+
+def log_deletions(modeladmin, request, queryset):
+    """
+    Checks the user may delete what they confirmed on the default action's
+    confirmation page, and logs the deletions like it does
+
+    Returns the objects to delete
+    """
+    if not modeladmin.has_delete_permission(request):
+        raise PermissionDenied
+    objs = list(queryset)
+    for obj in objs:
+        modeladmin.log_deletion(request, obj, force_unicode(obj))
+    return objs
+
+
+class PostChangeList(ChangeList):
+    """
+    Searches posts through the PostToken index, which has the words of their
+    titles and bodies, instead of scanning every body with LIKE
+    """
+    def get_query_set(self, request):
+        query, self.query = self.query, ''
+        try:
+            qs = super(PostChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        if query:
+            qs = qs.filter(pk__in=PostToken.objects.matching(query))
+        return qs
 
 
 class PostAdmin(admin.ModelAdmin):
@@ -12,7 +54,8 @@ class PostAdmin(admin.ModelAdmin):
     list_filter = ('publish_at', 'modified', 'created', 'active')
     change_list_filter_template = "admin/filter_listing.html"
     date_hierarchy = 'publish_at'
-    search_fields = ['title', 'body']
+    # Only shows the search box, searching is done by PostChangeList
+    search_fields = ['title']
     fieldsets = (
         (None, {
             'fields': ('title',),
@@ -29,6 +72,9 @@ class PostAdmin(admin.ModelAdmin):
         })
     )
 
+    def get_changelist(self, request, **kwargs):
+        return PostChangeList
+
 admin.site.register(Post, PostAdmin)
 
 
@@ -40,12 +86,71 @@ class GalleryAdmin(admin.ModelAdmin):
     change_list_filter_template = "admin/filter_listing.html"
     date_hierarchy = 'created'
     search_fields = ['title']
+    actions = ['delete_selected']
+
+    def delete_selected(self, request, queryset):
+        """
+        Asks for confirmation like the default action, which would delete
+        galleries without their photos, then deletes the galleries along
+        with the photos in no other gallery
+        """
+        if not request.POST.get('post'):
+            return confirm_delete_selected(self, request, queryset)
+        galleries = log_deletions(self, request, queryset)
+        Gallery.objects.delete_with_photos(galleries)
+        self.message_user(request, "Deleted {0} galleries and the photos in no other gallery."
+                                   .format(len(galleries)))
+    delete_selected.short_description = "Delete selected galleries and their photos"
 
 admin.site.register(Gallery, GalleryAdmin)
 
 
 class GalleryUploadAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('title', 'status', 'progress', 'attempts', 'created')
+    list_filter = ('status', 'created')
+    actions = ['retry']
+
+    def progress(self, obj):
+        return '{0} / {1}'.format(obj.photos_done, obj.photos_total)
+
+    def retry(self, request, queryset):
+        """
+        Puts failed uploads, and running ones that have stalled, back in the queue
+        """
+        stalled = GalleryUpload.objects.stalled().values('pk')
+        count = queryset.filter(Q(status=GalleryUpload.FAILED) | Q(pk__in=stalled)) \
+                        .update(status=GalleryUpload.PENDING, attempts=0, error='')
+        self.message_user(request, "{0} uploads queued again.".format(count))
+    retry.short_description = "Retry selected failed or stalled uploads"
+
+    def get_urls(self):
+        urls = super(GalleryUploadAdmin, self).get_urls()
+        return patterns('',
+            url(r'^(\d+)/status/$', self.admin_site.admin_view(self.status_view),
+                name='blog_wind_galleryupload_status'),
+        ) + urls
+
+    def status_view(self, request, pk):
+        """
+        Returns the processing state of an upload as JSON for the change form to poll
+        """
+        upload = get_object_or_404(GalleryUpload, pk=pk)
+        return HttpResponse(json.dumps({
+            'status': upload.status,
+            'status_display': upload.get_status_display(),
+            'photos_done': upload.photos_done,
+            'photos_total': upload.photos_total,
+            'attempts': upload.attempts,
+            'error': upload.error,
+        }), content_type='application/json')
+
+    def response_add(self, request, obj, *args, **kwargs):
+        """
+        Goes to the new upload's change form, where its processing can be followed
+        """
+        if '_addanother' in request.POST:
+            return super(GalleryUploadAdmin, self).response_add(request, obj, *args, **kwargs)
+        return HttpResponseRedirect(reverse('admin:blog_wind_galleryupload_change', args=(obj.pk,)))
 
 admin.site.register(GalleryUpload, GalleryUploadAdmin)
 
@@ -58,5 +163,18 @@ class PhotoAdmin(AdminImageMixin, admin.ModelAdmin):
     change_list_filter_template = "admin/filter_listing.html"
     date_hierarchy = 'created'
     search_fields = ['title']
+    actions = ['delete_selected']
+
+    def delete_selected(self, request, queryset):
+        """
+        Asks for confirmation like the default action, which would leave the
+        images and thumbnails on S3, then deletes the photos with their files
+        """
+        if not request.POST.get('post'):
+            return confirm_delete_selected(self, request, queryset)
+        photos = log_deletions(self, request, queryset)
+        Photo.objects.delete_with_files(photos)
+        self.message_user(request, "Deleted {0} photos and their images.".format(len(photos)))
+    delete_selected.short_description = "Delete selected photos and their images"
 
 admin.site.register(Photo, PhotoAdmin)
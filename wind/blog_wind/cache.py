@@ -0,0 +1,198 @@
+"""
+Versioned namespaces for the page cache
+
+Every cached page is keyed on the version of the namespaces it depends on:
+'site' for every page, 'listing' for the pages that list posts, and
+'post:<slug>' for a post's own page. Saving or deleting a Post, Gallery or
+Photo bumps the versions of just the pages showing it, so their old cache
+entries are never looked up again and the cache can hold pages for as long
+as CACHE_MIDDLEWARE_SECONDS allows instead of waiting for them to expire.
+When a namespace was last bumped is kept too, for pages' Last-Modified.
+
+Listings also depend on the time, as scheduled posts go live. Rather than
+the current time they're filtered on the next scheduled publish_at, which is
+cached until it arrives, so listings stay cached in between and are rebuilt
+as soon as a scheduled post is due.
+"""
+import datetime
+import gzip
+import math
+import re
+import time
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.urlresolvers import Resolver404, resolve
+from django.db.models import get_model
+
+SITE = 'site'
+LISTING = 'listing'
+
+# Names of the urls whose pages list posts
+LISTING_PAGES = ('home', 'paged_home', 'older_home', 'newer_home', 'writing', 'galleries', 'feed',
+                 'search')
+
+# Names of the urls whose pages show a single post, by its slug
+POST_PAGES = ('post', 'preview')
+
+
+def get_page_cache():
+    return get_cache(settings.CACHE_MIDDLEWARE_ALIAS)
+
+
+def post_namespace(slug):
+    return 'post:{0}'.format(slug)
+
+
+def page_namespaces(path):
+    """
+    Returns the namespaces the page at path is cached under
+    """
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return [SITE]
+    if match.url_name in LISTING_PAGES:
+        return [SITE, LISTING]
+    if match.url_name in POST_PAGES:
+        return [SITE, post_namespace(match.kwargs['slug'])]
+    return [SITE]
+
+
+def _version_key(namespace):
+    return 'page_version:{0}'.format(namespace)
+
+
+def _new_version():
+    # Versions start from the clock, so one that fell out of the cache never
+    # comes back with a number pages were cached under before
+    return int(time.time() * 1000)
+
+
+def _changed_key(namespace):
+    return 'page_changed:{0}'.format(namespace)
+
+
+def get_page_changes(namespaces):
+    """
+    Returns the current version of each namespace, starting any that don't
+    have one yet, and when the last of them changed
+
+    A namespace whose version is started, or whose time of change has fallen
+    out of the cache, is taken to have changed just now
+    """
+    cache = get_page_cache()
+    keys = [_version_key(namespace) for namespace in namespaces]
+    changed_keys = [_changed_key(namespace) for namespace in namespaces]
+    values = cache.get_many(keys + changed_keys)
+    now = datetime.datetime.now()
+    started = {}
+    for key, changed_key in zip(keys, changed_keys):
+        if key not in values:
+            started[key] = _new_version()
+        if key not in values or changed_key not in values:
+            started[changed_key] = now
+    if started:
+        cache.set_many(started, settings.CACHE_MIDDLEWARE_SECONDS)
+        values.update(started)
+    return [values[key] for key in keys], max(values[key] for key in changed_keys)
+
+
+def request_page_changes(request):
+    """
+    Returns get_page_changes of the namespaces of the page requested, looking
+    them up once per request
+    """
+    if not hasattr(request, '_page_changes'):
+        request._page_changes = get_page_changes(page_namespaces(request.path_info))
+    return request._page_changes
+
+
+def page_key_prefix(request):
+    """
+    Returns the key prefix the page cache middleware uses for request
+    """
+    namespaces = page_namespaces(request.path_info)
+    versions = request_page_changes(request)[0]
+    prefix = '.'.join('{0}{1}'.format(namespace, version) for namespace, version in zip(namespaces, versions))
+    if LISTING in namespaces:
+        next_publish_at = get_next_publish_at(get_model('blog_wind', 'Post'))
+        prefix += '.until{0}'.format(next_publish_at.strftime('%Y%m%d%H%M%S') if next_publish_at else '')
+    return settings.CACHE_MIDDLEWARE_KEY_PREFIX + prefix
+
+
+def invalidate_pages(*namespaces):
+    """
+    Bumps the versions of namespaces, so pages cached under them are rebuilt,
+    and records when they changed
+    """
+    cache = get_page_cache()
+    # The time goes first, so a version is never newer than its time
+    now = datetime.datetime.now()
+    cache.set_many(dict((_changed_key(namespace), now) for namespace in namespaces),
+                   settings.CACHE_MIDDLEWARE_SECONDS)
+    for namespace in set(namespaces):
+        key = _version_key(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:  # no version yet, or a cache that can't count
+            cache.set(key, _new_version(), settings.CACHE_MIDDLEWARE_SECONDS)
+
+
+def _next_publish_at_key(model):
+    return 'next_publish_at:{0}'.format(model._meta.db_table)
+
+
+def get_next_publish_at(model):
+    """
+    Returns the publish_at of model's next scheduled active instance, or None
+    if none are scheduled
+
+    The answer is cached until that publish_at arrives
+    """
+    cache = get_page_cache()
+    key = _next_publish_at_key(model)
+    now = datetime.datetime.now()
+    next_publish_at = cache.get(key)
+    # '' is cached when nothing is scheduled
+    if next_publish_at == '' or next_publish_at and next_publish_at > now:
+        return next_publish_at or None
+
+    upcoming = list(model._default_manager.filter(active=True, publish_at__gt=now)
+                                          .order_by('publish_at').values_list('publish_at', flat=True)[:1])
+    if upcoming:
+        delta = upcoming[0] - now
+        timeout = int(math.ceil(delta.days * 86400 + delta.seconds + delta.microseconds / 1e6))
+        cache.set(key, upcoming[0], min(timeout, settings.CACHE_MIDDLEWARE_SECONDS))
+        return upcoming[0]
+    cache.set(key, '', settings.CACHE_MIDDLEWARE_SECONDS)
+    return None
+
+
+def forget_next_publish_at(model):
+    """
+    Drops the cached next publish_at, e.g. as a post is scheduled
+    """
+    get_page_cache().delete(_next_publish_at_key(model))
+
+
+# Matches the Accept-Encoding of clients that take gzipped responses
+accepts_gzip_re = re.compile(r'\bgzip\b')
+
+
+def compress(content):
+    """
+    Returns content gzipped at the highest level, for storing compressed
+    documents that are served many times
+
+    The timestamp in the gzip header is left out, so the same content
+    always compresses to the same bytes
+    """
+    buf = StringIO()
+    f = gzip.GzipFile(mode='wb', compresslevel=9, fileobj=buf, mtime=0)
+    try:
+        f.write(content)
+    finally:
+        f.close()
+    return buf.getvalue()
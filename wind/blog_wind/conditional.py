@@ -0,0 +1,63 @@
+"""
+ETags and Last-Modified headers for pages built from posts
+
+A page's validators come from one aggregate query over the posts it is built
+from and the page cache's versions of what it shows, so a conditional GET
+that matches is answered with a 304 before the page is rendered.
+"""
+import hashlib
+
+from django.db.models import Count, Max
+from django.views.decorators.http import condition
+
+from blog_wind.cache import request_page_changes
+
+
+def posts_state(posts):
+    """
+    Returns a digest of posts and when they last changed
+
+    Changes to the posts, their galleries and how many there are, e.g. as
+    one is deleted or goes live, all change the digest
+    """
+    state = posts.order_by().aggregate(count=Count('pk'), modified=Max('modified'),
+                                       publish_at=Max('publish_at'), gallery_modified=Max('gallery__modified'))
+    dates = [state[key] for key in ('modified', 'publish_at', 'gallery_modified') if state[key]]
+    return hashlib.sha1(repr(sorted(state.items()))).hexdigest(), max(dates) if dates else None
+
+
+def request_posts_state(request, get_posts, *args, **kwargs):
+    """
+    Returns the posts_state of the posts returned by get_posts, which is
+    called with the view's arguments, working it out once per request
+    """
+    if not hasattr(request, '_posts_state'):
+        request._posts_state = posts_state(get_posts(*args, **kwargs))
+    return request._posts_state
+
+
+def request_state(request, get_posts, *args, **kwargs):
+    """
+    Returns the ETag and Last-Modified of the page requested
+
+    The ETag also depends on the path, since pages of the same posts differ,
+    and on the versions of the namespaces the page is cached under. Those
+    change as posts are deleted or deactivated, which the aggregates can
+    miss, and as new templates are deployed, so Last-Modified is the later
+    of when the posts and the namespaces last changed
+    """
+    digest, last_modified = request_posts_state(request, get_posts, *args, **kwargs)
+    versions, changed = request_page_changes(request)
+    etag = hashlib.sha1(repr((request.get_full_path(), digest, versions))).hexdigest()
+    return etag, max(last_modified, changed) if last_modified else changed
+
+
+def conditional_on(get_posts):
+    """
+    Returns a view decorator adding the validators of the posts returned by
+    get_posts, and answering conditional GETs that match them with a 304
+    """
+    # Django asks for the ETag and Last-Modified separately
+    return condition(
+        etag_func=lambda request, *args, **kwargs: request_state(request, get_posts, *args, **kwargs)[0],
+        last_modified_func=lambda request, *args, **kwargs: request_state(request, get_posts, *args, **kwargs)[1])
@@ -1,5 +1,26 @@
+"""
+The RSS feed
+
+Feed readers poll it every few minutes, so the document is only rendered
+once per change to the posts. It's kept gzipped in the cache and on disk,
+keyed on a digest of the posts, and served as is to the readers that accept
+gzip.
+"""
+import errno
+import glob
+import gzip
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.conf import settings
 from django.contrib.syndication.views import Feed
+from django.http import HttpResponse
+from django.template.defaultfilters import truncatewords_html
+from django.utils.http import quote_etag
 
+from blog_wind.cache import accepts_gzip_re, compress, get_page_cache
+from blog_wind.conditional import conditional_on, request_posts_state, request_state
 from blog_wind.models import Post
 
 
@@ -9,10 +30,96 @@ class RecentFeed(Feed):
     description = "Recent posts by Brian Holdefehr"
 
     def items(self):
-        return Post.objects.get_active()[:10]
+        return Post.objects.get_posted()[:getattr(settings, 'FEED_ITEM_COUNT', 10)]
 
     def item_title(self, item):
         return item.title
 
     def item_description(self, item):
-        return item.body
+        if getattr(settings, 'FEED_SUMMARY_ONLY', False):
+            return truncatewords_html(item.body_highlighted, getattr(settings, 'FEED_SUMMARY_WORDS', 50))
+        return item.body_highlighted
+
+
+def _feed_posts():
+    return Post.objects.get_posted()
+
+
+def _document_name(key):
+    return os.path.join(settings.FEED_CACHE_ROOT, 'recent-{0}.xml.gz'.format(key))
+
+
+def get_document(request, key):
+    """
+    Returns the gzipped feed document stored under key, from the cache, then
+    disk, rendering and storing it if it's in neither
+    """
+    cache = get_page_cache()
+    cache_key = 'feed:{0}'.format(key)
+    document = cache.get(cache_key)
+    if document is not None:
+        return document
+
+    name = _document_name(key)
+    if os.path.exists(name):
+        with open(name, 'rb') as f:
+            document = f.read()
+    else:
+        document = compress(RecentFeed()(request).content)
+        _write_document(name, document)
+    cache.set(cache_key, document, settings.CACHE_MIDDLEWARE_SECONDS)
+    return document
+
+
+def _write_document(name, document):
+    """
+    Stores a document under name and removes the ones of earlier states
+
+    Several processes may render the feed at once, so each writes a file of
+    its own that's renamed into place in one step, and files another has
+    already moved or removed are left alone
+    """
+    try:
+        os.makedirs(settings.FEED_CACHE_ROOT)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, temp_name = tempfile.mkstemp(suffix='.tmp', dir=settings.FEED_CACHE_ROOT)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(document)
+        os.rename(temp_name, name)
+    except:
+        os.remove(temp_name)
+        raise
+    for old in glob.glob(_document_name('*')):
+        if old != name:
+            try:
+                os.remove(old)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+@conditional_on(_feed_posts)
+def recent_feed(request):
+    """
+    Serves RecentFeed's document, rendered once per change to the posts
+    """
+    digest, last_modified = request_posts_state(request, _feed_posts)
+    key = '{0}-{1}-{2}-{3}'.format(digest, getattr(settings, 'FEED_ITEM_COUNT', 10),
+                                   int(getattr(settings, 'FEED_SUMMARY_ONLY', False)),
+                                   getattr(settings, 'FEED_SUMMARY_WORDS', 50))
+    document = get_document(request, key)
+
+    response = HttpResponse(content_type='application/rss+xml; charset=utf-8')
+    if accepts_gzip_re.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        response.content = document
+        response['Content-Encoding'] = 'gzip'
+        # The ETag stays the same for both bodies, so it's only a weak one
+        response['ETag'] = 'W/' + quote_etag(request_state(request, _feed_posts)[0])
+    else:
+        response.content = gzip.GzipFile(fileobj=StringIO(document)).read()
+    response['Content-Length'] = str(len(response.content))
+    response['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,85 @@
+"""
+Syntax highlighting for code in the <pre> blocks of post bodies
+"""
+import re
+from HTMLParser import HTMLParser
+
+from bs4 import BeautifulSoup
+from pygments import highlight, lexers
+from pygments.formatters import HtmlFormatter
+
+# Options passed to pygments' HtmlFormatter for every block
+FORMATTER_OPTIONS = {}
+
+PRE_BLOCK_RE = re.compile(r'<pre(?P<attrs>\s[^>]*)?>(?P<code>.*?)</pre\s*>',
+                          re.IGNORECASE | re.DOTALL)
+CLASS_ATTR_RE = re.compile(r'''\bclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+))''',
+                           re.IGNORECASE)
+
+_html_parser = HTMLParser()
+
+
+def unescape_html(html):
+    """
+    Turns entities like '&lt;' back into the characters pygments should see
+    """
+    return _html_parser.unescape(html)
+
+
+def highlight_block(code, lexer_name, formatter_options=None):
+    """
+    Lexes, formats, and styles a single block of code with pygments
+    """
+    lexer = lexers.get_lexer_by_name(lexer_name)
+    return highlight(code, lexer, HtmlFormatter(**(formatter_options or FORMATTER_OPTIONS)))
+
+
+def get_lexer_name(attrs):
+    """
+    Returns the first class of a <pre>'s attributes, which names its language
+    """
+    match = CLASS_ATTR_RE.search(attrs or '')
+    if match:
+        classes = (match.group(1) or match.group(2) or match.group(3) or '').split()
+        if classes:
+            return classes[0]
+    return None
+
+
+def highlight_body(body, highlighter=highlight_block):
+    """
+    Highlights code in all <pre> elements of body that have a class
+
+    Scans body once for <pre> blocks and splices the highlighted markup in
+    their place. Everything outside of those blocks is copied through as is,
+    so the rest of the document never has to be parsed or re-serialized.
+
+    highlighter is called with the unescaped code and the lexer name, so a
+    cache can be put in front of pygments
+    """
+    pieces = []
+    position = 0
+    for match in PRE_BLOCK_RE.finditer(body):
+        lexer_name = get_lexer_name(match.group('attrs'))
+        if lexer_name is None:
+            continue
+        pieces.append(body[position:match.start()])
+        pieces.append(highlighter(unescape_html(match.group('code')), lexer_name))
+        position = match.end()
+    pieces.append(body[position:])
+    return u''.join(pieces)
+
+
+def highlight_body_with_soup(body, highlighter=highlight_block):
+    """
+    The original BeautifulSoup based implementation of highlight_body
+
+    Parses and re-serializes the whole body. Kept as the reference that
+    highlight_body's output is checked and benchmarked against.
+    """
+    soup = BeautifulSoup(body)
+    for pre in soup.findAll('pre'):
+        code = ''.join([unicode(item) for item in pre.contents])
+        code = code.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+        pre.replaceWith(BeautifulSoup(highlighter(code, pre['class'][0])))
+    return unicode(soup)
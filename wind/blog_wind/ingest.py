@@ -0,0 +1,288 @@
+"""
+Turns a .zip file of images into the Photos of a Gallery
+
+Decoding and validating images is CPU bound, so it runs on a process pool.
+Uploading them to storage is bound by network round trips, so each image is
+handed to a bounded thread pool as soon as it validates. Database writes
+happen in this process, in order, once every upload has finished.
+
+Members are streamed out of the zip file rather than read whole, spooling to
+disk past GALLERY_UPLOAD_SPOOL_SIZE bytes, so memory use is bounded by that
+limit times the number of workers rather than by the size of the archive.
+
+A digest of each image is taken as it streams. Images that have been uploaded
+before, to any gallery, reuse the existing Photo along with its file and
+thumbnails instead of being uploaded again.
+"""
+from __future__ import with_statement
+import hashlib
+import itertools
+import multiprocessing
+import tempfile
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import File
+from django.db import transaction
+from PIL import Image
+
+from blog_wind.models import Gallery, Photo, touch_galleries
+
+
+# Size of the reads used to stream zip members
+CHUNK_SIZE = 64 * 1024
+
+# Number of validated images whose digests are looked up in one query
+DIGEST_BATCH_SIZE = 50
+
+
+def copy_and_hash(src, dst=None):
+    """
+    Copies src to dst, if given, in chunks while taking the SHA-1 of the
+    content. Returns the number of bytes and the hex digest.
+    """
+    digest = hashlib.sha1()
+    length = 0
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        length += len(chunk)
+        if dst is not None:
+            dst.write(chunk)
+    return length, digest.hexdigest()
+
+
+def spool_member(zf, filename):
+    """
+    Streams a member of the zip file into a temporary file, which only goes
+    to disk once it's bigger than GALLERY_UPLOAD_SPOOL_SIZE
+
+    The member's CRC is checked as it streams, raising zipfile.BadZipfile if
+    it is corrupt, or zlib.error if it can't be decompressed. Returns the
+    temporary file, rewound, its size and digest.
+    """
+    spool = tempfile.SpooledTemporaryFile(
+        max_size=getattr(settings, 'GALLERY_UPLOAD_SPOOL_SIZE', 8 * 1024 * 1024))
+    member = zf.open(filename)
+    try:
+        size, digest = copy_and_hash(member, spool)
+    except:
+        spool.close()
+        raise
+    finally:
+        member.close()
+    spool.seek(0)
+    return spool, size, digest
+
+
+def read_image_size(img_file):
+    """
+    Returns the (width, height) of an image, raising an error if PIL can't
+    fully decode it
+    """
+    # load() can spot a truncated JPEG. Decoding a JPEG at an eighth of its
+    # size checks it just as well without holding the full size bitmap
+    trial_image = Image.open(img_file)
+    size = trial_image.size
+    # Images under 8 pixels across would be asked for at a size of 0
+    trial_image.draft(trial_image.mode, (max(1, size[0] // 8), max(1, size[1] // 8)))
+    trial_image.load()
+
+    # Since we're about to use the file again we have to reset the file object
+    img_file.seek(0)
+
+    # verify() can spot a corrupt PNG
+    # but it must be called immediately after the constructor
+    trial_image = Image.open(img_file)
+    trial_image.verify()
+    return size
+
+
+def validate_member(args):
+    """
+    Runs in the decode pool's worker processes
+
+    Returns the member's filename, image size, digest, and an error message,
+    which is None if the member is a valid image. Errors are returned rather than
+    raised since they have to be pickled back to the parent process.
+    """
+    zip_path, filename = args
+    with zipfile.ZipFile(zip_path) as zf:
+        try:
+            spool, length, digest = spool_member(zf, filename)
+        except (zipfile.BadZipfile, zlib.error):
+            return filename, None, None, '"{0}" in the .zip file is corrupt.'.format(filename)
+    try:
+        return filename, read_image_size(spool), digest, None
+    except Exception:  # PIL doesn't recognize file as an image
+        return filename, None, None, 'Image failed to validate: {0}'.format(filename)
+    finally:
+        spool.close()
+
+
+def upload_member(zip_path, filename, storage):
+    """
+    Runs in the upload pool's threads
+
+    Saves a member of the zip file to storage and returns the name it was
+    saved under. Failed uploads are tried again GALLERY_UPLOAD_RETRIES times.
+    """
+    retries = getattr(settings, 'GALLERY_UPLOAD_RETRIES', 2)
+    for attempt in range(retries + 1):
+        try:
+            return _upload_member(zip_path, filename, storage)
+        except (zipfile.BadZipfile, zlib.error):
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+
+
+def _upload_member(zip_path, filename, storage):
+    image_field = Photo._meta.get_field('image')
+    with zipfile.ZipFile(zip_path) as zf:
+        spool, length, digest = spool_member(zf, filename)
+    try:
+        content = File(spool, name=filename)
+        content.size = length
+        return storage.save(image_field.generate_filename(None, filename), content)
+    finally:
+        spool.close()
+
+
+def ingest_zipfile(zip_path, title, gallery=None, progress=None):
+    """
+    Adds every image in the zip file to gallery as a Photo, creating a new
+    gallery called title if one isn't given
+
+    Photos are titled after the gallery and numbered in filename order.
+    Images whose title already exists are skipped, and images with the same
+    content as an existing Photo add that Photo to the gallery instead.
+
+    If any image is corrupt, fails to validate or fails to upload, nothing is
+    written to the database and every image already uploaded is deleted from
+    storage again.
+
+    progress, if given, is called with the number of images done so far and
+    the total number of images after each batch is decoded and as they
+    finish uploading
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        # don't process meta files, directories, or empty files
+        filenames = sorted(info.filename for info in zf.infolist()
+                           if not info.filename.startswith('__') and info.file_size)
+
+    titles = [title + ' ' + str(count).zfill(2) for count in range(1, len(filenames) + 1)]
+    existing = set(Photo.objects.filter(title__in=titles).values_list('title', flat=True))
+    members = [(photo_title, filename) for photo_title, filename in zip(titles, filenames)
+               if photo_title not in existing]
+    titles_by_filename = dict((filename, photo_title) for photo_title, filename in members)
+    if progress is None:
+        progress = lambda done, total: None
+    progress(0, len(members))
+
+    storage = Photo._meta.get_field('image').storage
+    processes = getattr(settings, 'GALLERY_DECODE_PROCESSES', 2)
+    decode_pool = multiprocessing.Pool(processes) if processes > 0 else None
+    upload_pool = ThreadPool(getattr(settings, 'GALLERY_UPLOAD_THREADS', 4))
+    mapper = decode_pool.imap if decode_pool else itertools.imap
+    uploads = []
+    reused_ids = []
+    seen_digests = set()
+    decoded_count = 0
+    try:
+        decoded = mapper(validate_member, [(zip_path, filename) for photo_title, filename in members])
+        for batch in _batches(decoded, DIGEST_BATCH_SIZE):
+            for filename, size, digest, error in batch:
+                if error:
+                    raise ValidationError(error)
+            known = dict(Photo.objects.filter(digest__in=[digest for filename, size, digest, error in batch])
+                                      .values_list('digest', 'pk'))
+            for filename, size, digest, error in batch:
+                if digest in seen_digests:  # same image twice in this zip
+                    continue
+                seen_digests.add(digest)
+                if digest in known:
+                    reused_ids.append(known[digest])
+                else:
+                    uploads.append((titles_by_filename[filename], size, digest, upload_pool.apply_async(
+                        upload_member, (zip_path, filename, storage))))
+            # Images that don't need uploading are done once they're decoded
+            decoded_count += len(batch)
+            progress(decoded_count - len(uploads), len(members))
+        photos = []
+        for photo_title, size, digest, result in uploads:
+            photos.append((photo_title, size, digest, result.get()))
+            progress(len(members) - len(uploads) + len(photos), len(members))
+        if not uploads:
+            progress(len(members), len(members))
+
+        with transaction.commit_on_success():
+            if gallery is None:
+                gallery = Gallery.objects.create(title=title)
+            _add_photos(gallery, photos, reused_ids)
+    except:
+        _delete_uploads(storage, [result for photo_title, size, digest, result in uploads])
+        raise
+    finally:
+        if decode_pool:
+            decode_pool.terminate()
+            decode_pool.join()
+        upload_pool.close()
+        upload_pool.join()
+    return gallery
+
+
+def _batches(iterable, size):
+    """
+    Yields lists of up to size items from iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _add_photos(gallery, photos, reused_ids=()):
+    """
+    Creates Photos from (title, (width, height), digest, image name) tuples
+    and adds them, along with the existing Photos in reused_ids, to gallery
+    with a fixed number of queries, however many there are
+    """
+    photo_ids = []
+    if photos:
+        Photo.objects.bulk_create([Photo(title=photo_title, image=name, digest=digest,
+                                         width=width, height=height)
+                                   for photo_title, (width, height), digest, name in photos])
+        # bulk_create doesn't set primary keys, but every image was stored
+        # under a name of its own, e.g. with MediaToS3Storage's uuid suffix
+        photo_ids.extend(Photo.objects.filter(image__in=[photo[3] for photo in photos])
+                                      .values_list('pk', flat=True))
+    if reused_ids:
+        in_gallery = set(gallery.photos.filter(pk__in=reused_ids).values_list('pk', flat=True))
+        photo_ids.extend(pk for pk in reused_ids if pk not in in_gallery)
+    if photo_ids:
+        Through = Gallery.photos.through
+        Through.objects.bulk_create([Through(gallery_id=gallery.pk, photo_id=photo_id)
+                                     for photo_id in photo_ids])
+        # bulk_create doesn't send m2m_changed, so update the covers and pages here
+        gallery.refresh_landscape_photos()
+        touch_galleries([gallery.pk])
+
+
+def _delete_uploads(storage, results):
+    """
+    Waits for uploads that are still running, then deletes every one that
+    succeeded so failed ingests don't leave orphaned files in storage
+    """
+    for result in results:
+        result.wait()
+        if result.successful():
+            storage.delete(result.get())
@@ -0,0 +1,53 @@
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from blog_wind.ingest import copy_and_hash
+from blog_wind.models import Photo
+
+
+def _hash_photo(photo):
+    """
+    Runs in the pool's threads, since reading images back from S3 is bound by
+    network round trips
+    """
+    image = photo.image.storage.open(photo.image.name, 'rb')
+    try:
+        return photo.pk, copy_and_hash(image)[1]
+    finally:
+        image.close()
+
+
+class Command(BaseCommand):
+    help = ("Records the digest of photos uploaded before digests were kept, "
+            "and reports photos with identical images")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=4,
+                    help='Number of photos read from storage at a time'),
+    )
+
+    def handle(self, *args, **options):
+        # Loaded up front, since the pool consumes its input on another thread
+        photos = list(Photo.objects.filter(digest='').exclude(image='').only('pk', 'image'))
+        pool = ThreadPool(options['threads'])
+        count = 0
+        try:
+            for pk, digest in pool.imap_unordered(_hash_photo, photos):
+                Photo.objects.filter(pk=pk).update(digest=digest)
+                count += 1
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write('Recorded digests for {0} photos\n'.format(count))
+
+        duplicates = (Photo.objects.exclude(digest='').order_by().values('digest')
+                      .annotate(copies=Count('pk')).filter(copies__gt=1))
+        for duplicate in duplicates:
+            titles = Photo.objects.filter(digest=duplicate['digest']).values_list('title', flat=True)
+            self.stdout.write('{0} copies of {1}: {2}\n'.format(
+                duplicate['copies'], duplicate['digest'], ', '.join(titles)))
+        if not duplicates:
+            self.stdout.write('No duplicate photos found\n')
@@ -0,0 +1,230 @@
+import cPickle as pickle
+import datetime
+import random
+import time
+from optparse import make_option
+
+from bs4 import BeautifulSoup
+from django.core.management.base import BaseCommand, CommandError
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import Q
+from django.http import HttpResponse
+from django.middleware.gzip import GZipMiddleware
+from django.test.client import RequestFactory
+
+from blog_wind.highlighting import highlight_block, highlight_body, highlight_body_with_soup
+from blog_wind.middleware import add_gzip_variant, select_variant
+from blog_wind.models import Post, PostToken
+from blog_wind.pagination import encode_cursor, keyset_page
+from blog_wind.search import post_tokens
+
+CODE_SAMPLE = '''def fib(n):
+    """Returns the nth fibonacci number &amp; prints it"""
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, a + b
+    if a &lt; 10 and b &gt; 2:
+        print "small"
+    return a
+'''
+
+PARAGRAPH_SAMPLE = ('<p>Some <a class="article-link" href="/about">linked</a> '
+                    'prose with <code>inline code</code> and a few more words '
+                    'to make the paragraph a realistic length.</p>\n')
+
+
+def _timed(func, repeat):
+    """
+    Returns the best wall clock time of running func repeat times
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _cpu_per_call(func, calls):
+    """
+    Returns the average CPU time of calling func
+    """
+    start = time.clock()
+    for i in range(calls):
+        func()
+    return (time.clock() - start) / calls
+
+
+class Command(BaseCommand):
+    args = '<suite suite ...>'
+    help = "Benchmarks hot paths of the blog. Suites: highlight, pagination, gzip, search"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--size', type='int', default=200,
+                    help='Number of <pre> blocks (and paragraphs) in the body'),
+        make_option('--repeat', type='int', default=5,
+                    help='Number of runs, the best of which is reported'),
+        make_option('--posts', default='10000,100000',
+                    help='Comma separated numbers of posts to paginate through or search'),
+    )
+
+    def handle(self, *suites, **options):
+        suites = suites or ('highlight',)
+        for suite in suites:
+            bench = getattr(self, 'bench_{0}'.format(suite), None)
+            if bench is None:
+                raise CommandError('Unknown benchmark suite: {0}'.format(suite))
+            bench(**options)
+
+    def bench_highlight(self, size, repeat, **options):
+        """
+        Compares highlight_body to the BeautifulSoup round-trip it replaced
+
+        Runs each with pygments, then with a no-op highlighter to isolate the
+        cost of finding and splicing the <pre> blocks
+        """
+        body = u''.join([PARAGRAPH_SAMPLE * 5 + u'<pre class="python">' + CODE_SAMPLE + u'</pre>\n'
+                         for i in range(size)])
+        self.stdout.write('Body: {0} bytes, {1} <pre> blocks\n'.format(len(body), size))
+
+        streamed = highlight_body(body)
+        souped = highlight_body_with_soup(body)
+        if BeautifulSoup(streamed).decode() != BeautifulSoup(souped).decode():
+            raise CommandError('highlight_body output differs from the BeautifulSoup output')
+
+        noop = lambda code, lexer_name: u'<div class="highlight"><pre>{0}</pre></div>'.format(len(code))
+        for label, highlighter in (('pygments', highlight_block), ('no-op', noop)):
+            soup_time = _timed(lambda: highlight_body_with_soup(body, highlighter), repeat)
+            stream_time = _timed(lambda: highlight_body(body, highlighter), repeat)
+            self.stdout.write('{0:>9} highlighter: soup {1:.4f}s, streaming {2:.4f}s ({3:.1f}x)\n'
+                              .format(label, soup_time, stream_time, soup_time / stream_time))
+
+    def bench_pagination(self, repeat, posts, **options):
+        """
+        Compares numbered pages to keyset pages of the home page's posts
+
+        Runs against a throwaway test database, filled with each number of
+        posts in turn, timing the first page and the deepest page
+        """
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            created = 0
+            for count in [int(count) for count in posts.split(',')]:
+                self.create_posts(created, count)
+                created = count
+                all_posts = Post.objects.get_posted()
+                last_page = (count - 1) // 5 + 1
+                newer = all_posts.order_by('-publish_at', '-pk')[(last_page - 1) * 5 - 1]
+                cursor = encode_cursor(newer)
+
+                def offset(number):
+                    paginator = Paginator(all_posts, 5)
+                    list(paginator.page(number))
+                for label, number, older_than in (('first', 1, None), ('last', last_page, cursor)):
+                    offset_time = _timed(lambda: offset(number), repeat)
+                    keyset_time = _timed(lambda: list(keyset_page(all_posts, 5, older_than)), repeat)
+                    self.stdout.write('{0:>7} posts, {1:>5} page: offset {2:.4f}s, keyset {3:.4f}s ({4:.1f}x)\n'
+                                      .format(count, label, offset_time, keyset_time, offset_time / keyset_time))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    @transaction.commit_on_success
+    def create_posts(self, start, stop):
+        """
+        Inserts posts numbered start to stop, an hour apart, without highlighting them
+        """
+        now = datetime.datetime.now()
+        for first in range(start, stop, 50):
+            Post.objects.bulk_create([
+                Post(title='Post {0}'.format(i), slug='post-{0}'.format(i), body='<p>Post</p>',
+                     body_highlighted='<p>Post</p>', publish_at=now - datetime.timedelta(hours=i))
+                for i in range(first, min(first + 50, stop))])
+
+    def bench_gzip(self, size, repeat, **options):
+        """
+        Compares serving a cached page of highlighted code gzipped on every
+        response, as GZipMiddleware would, to serving the gzipped variant made
+        once as the page was cached
+
+        Every request unpickles the page, as a cache hit does, and reports the
+        bytes sent and the CPU time per request
+        """
+        body = highlight_body(u''.join([PARAGRAPH_SAMPLE + u'<pre class="python">' + CODE_SAMPLE + u'</pre>\n'
+                                        for i in range(size)]))
+        html = u'<html><body>{0}</body></html>'.format(body).encode('utf-8')
+        plain = pickle.dumps(HttpResponse(html), pickle.HIGHEST_PROTOCOL)
+        precompressed = pickle.dumps(add_gzip_variant(HttpResponse(html)), pickle.HIGHEST_PROTOCOL)
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        identity_request = RequestFactory().get('/')
+        gzip_middleware = GZipMiddleware()
+
+        calls = repeat * 20
+        for label, serve in (
+                ('identity', lambda: pickle.loads(plain)),
+                ('gzip per response', lambda: gzip_middleware.process_response(request, pickle.loads(plain))),
+                ('precompressed', lambda: select_variant(request, pickle.loads(precompressed))),
+                ('precompressed, identity client',
+                 lambda: select_variant(identity_request, pickle.loads(precompressed)))):
+            sent = len(serve().content)
+            self.stdout.write('{0:>31}: {1:>7} bytes, {2:.3f}ms CPU per request\n'
+                              .format(label, sent, _cpu_per_call(serve, calls) * 1000))
+
+    def bench_search(self, repeat, posts, **options):
+        """
+        Compares searching posts' titles and bodies with LIKE, as the admin
+        used to, to looking them up in the PostToken index
+
+        Runs against a throwaway test database, filled with each number of
+        posts of random words in turn, searching for a common word, a rare
+        word and both together
+        """
+        random.seed(0)
+        vocabulary = ['word{0:04}'.format(i) for i in range(5000)]
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            created = 0
+            for count in [int(count) for count in posts.split(',')]:
+                self.create_worded_posts(created, count, vocabulary)
+                created = count
+                posted = Post.objects.get_posted()
+
+                def like(query):
+                    matches = posted
+                    for word in query.split():
+                        matches = matches.filter(Q(title__icontains=word) | Q(body__icontains=word))
+                    return list(matches[:20])
+                for label, query in (('common', 'word0000'), ('rare', 'word4999'), ('both', 'word0000 word4999')):
+                    like_time = _timed(lambda: like(query), repeat)
+                    index_time = _timed(lambda: PostToken.objects.search(query, posted, 20), repeat)
+                    self.stdout.write('{0:>7} posts, {1:>6} query: LIKE {2:.4f}s, index {3:.4f}s ({4:.1f}x)\n'
+                                      .format(count, label, like_time, index_time, like_time / index_time))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    @transaction.commit_on_success
+    def create_worded_posts(self, start, stop, vocabulary):
+        """
+        Inserts posts numbered start to stop, with bodies of 100 words picked
+        from vocabulary so earlier words are more common, and indexes them
+        """
+        now = datetime.datetime.now()
+        for first in range(start, stop, 50):
+            numbers = range(first, min(first + 50, stop))
+            Post.objects.bulk_create([
+                Post(title='Post {0}'.format(i), slug='post-{0}'.format(i),
+                     body='<p>{0}</p>'.format(' '.join(
+                         vocabulary[min(int(random.paretovariate(1)), len(vocabulary)) - 1] for j in range(100))),
+                     publish_at=now - datetime.timedelta(hours=i))
+                for i in numbers])
+            # bulk_create doesn't set the pks, so the posts are read back to index them
+            indexed = Post.objects.filter(slug__in=['post-{0}'.format(i) for i in numbers])
+            tokens = [PostToken(post_id=pk, token=token, weight=weight)
+                      for pk, title, body in indexed.values_list('pk', 'title', 'body')
+                      for token, weight in post_tokens(title, body).iteritems()]
+            for token_start in range(0, len(tokens), PostToken.objects.batch_size):
+                PostToken.objects.bulk_create(tokens[token_start:token_start + PostToken.objects.batch_size])
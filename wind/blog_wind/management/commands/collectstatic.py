@@ -0,0 +1,35 @@
+from django.contrib.staticfiles.management.commands import collectstatic
+
+
+class Command(collectstatic.Command):
+    """
+    Django's collectstatic, going by the contents of files rather than when
+    they were modified for storages that keep hashes of what they've saved,
+    like ManifestStaticToS3Storage
+
+    Files whose contents are unchanged are skipped however recently they
+    were touched, e.g. by a checkout, and changed files are saved over the
+    old ones instead of being deleted first. The storage's manifest is
+    written once at the end, rather than after every file
+    """
+    def collect(self):
+        try:
+            return super(Command, self).collect()
+        finally:
+            if getattr(self.storage, 'key_manifest', None):
+                self.storage.save_keys()
+
+    def delete_file(self, path, prefixed_path, source_storage):
+        if not getattr(self.storage, 'key_manifest', None):
+            return super(Command, self).delete_file(path, prefixed_path, source_storage)
+        source = source_storage.open(path)
+        try:
+            unchanged = self.storage.unchanged(prefixed_path, source)
+        finally:
+            source.close()
+        if unchanged:
+            if prefixed_path not in self.unmodified_files:
+                self.unmodified_files.append(prefixed_path)
+            self.log(u"Skipping '%s' (not modified)" % path)
+            return False
+        return True
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from blog_wind.models import Post, PostToken
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the search index of every post, e.g. after changing "
+            "how posts are tokenized")
+
+    def handle(self, *args, **options):
+        count = 0
+        for post in Post.objects.all().iterator():
+            PostToken.objects.index(post)
+            count += 1
+        self.stdout.write('Indexed {0} posts\n'.format(count))
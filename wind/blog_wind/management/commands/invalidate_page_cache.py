@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from blog_wind.cache import SITE, invalidate_pages
+
+
+class Command(BaseCommand):
+    args = '<namespace namespace ...>'
+    help = ("Invalidates cached pages, e.g. after deploying new templates. "
+            "Defaults to every page, or give namespaces like listing or post:<slug>")
+
+    def handle(self, *namespaces, **options):
+        namespaces = namespaces or (SITE,)
+        invalidate_pages(*namespaces)
+        self.stdout.write('Invalidated {0}\n'.format(', '.join(namespaces)))
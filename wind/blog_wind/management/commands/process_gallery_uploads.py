@@ -0,0 +1,38 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from blog_wind.models import GalleryUpload
+
+
+class Command(BaseCommand):
+    help = "Works through the queue of gallery uploads saved in the admin"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', default=False,
+                    help='Exit once the queue is empty instead of waiting for more'),
+        make_option('--poll-interval', dest='poll_interval', type='float', default=5,
+                    help='Seconds to wait between checks of an empty queue'),
+        make_option('--max-attempts', dest='max_attempts', type='int', default=3,
+                    help='Times an upload is tried before it is marked failed'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            upload = GalleryUpload.objects.claim_next(options['max_attempts'])
+            if upload is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write('Processing "{0}" (attempt {1})\n'.format(upload.title, upload.attempts))
+            try:
+                upload.run(max_attempts=options['max_attempts'])
+            except Exception:
+                # run() has recorded the traceback on the upload, keep working
+                sys.stderr.write(GalleryUpload.objects.get(pk=upload.pk).error)
+            else:
+                self.stdout.write('Finished "{0}"\n'.format(upload.title))
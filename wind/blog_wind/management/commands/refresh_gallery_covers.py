@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from blog_wind.cache import LISTING, invalidate_pages
+from blog_wind.models import Gallery
+
+
+class Command(BaseCommand):
+    help = ("Recomputes every gallery's landscape photos and cover, e.g. for "
+            "galleries created before they were kept")
+
+    def handle(self, *args, **options):
+        count = 0
+        for gallery in Gallery.objects.all():
+            gallery.refresh_landscape_photos()
+            count += 1
+        invalidate_pages(LISTING)
+        self.stdout.write('Refreshed {0} galleries\n'.format(count))
@@ -0,0 +1,14 @@
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the key manifest of the static files storage from one "
+            "listing of its bucket, e.g. after files were changed on S3 directly")
+
+    def handle(self, *args, **options):
+        if not getattr(staticfiles_storage, 'key_manifest', None):
+            raise CommandError('The static files storage has no key manifest. '
+                               'Use wind.storage.ManifestStaticToS3Storage')
+        staticfiles_storage.refresh_keys()
+        self.stdout.write('Listed {0} keys\n'.format(len(staticfiles_storage.keys)))
@@ -0,0 +1,112 @@
+import datetime
+import itertools
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from blog_wind.cache import LISTING, invalidate_pages, post_namespace
+from blog_wind.highlighting import highlight_body
+from blog_wind.models import Post
+
+
+def _highlight(item):
+    """
+    Runs in the pool's worker processes, so it can't touch the database
+    """
+    pk, body = item
+    return pk, highlight_body(body)
+
+
+class Command(BaseCommand):
+    help = ("Regenerates body_highlighted for posts, e.g. after upgrading "
+            "pygments or changing the HtmlFormatter style")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+                    help='Only posts modified on or after this date (YYYY-MM-DD)'),
+        make_option('--slug', dest='slugs', action='append', default=[],
+                    help='Only the post with this slug. Can be given more than once'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                    help="Highlight and report, but don't write anything"),
+        make_option('--processes', type='int', default=multiprocessing.cpu_count(),
+                    help='Number of worker processes. 1 highlights in this process'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=50,
+                    help='Number of posts loaded into memory at a time'),
+    )
+
+    def handle(self, *args, **options):
+        posts = Post.objects.all()
+        if options['since']:
+            try:
+                since = datetime.datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--since should be a date like 2013-01-31')
+            posts = posts.filter(modified__gte=since)
+        if options['slugs']:
+            posts = posts.filter(slug__in=options['slugs'])
+
+        pool = None
+        if options['processes'] > 1:
+            # Workers are forked, so don't let them inherit our db connection
+            connection.close()
+            pool = multiprocessing.Pool(options['processes'])
+        mapper = pool.imap if pool else itertools.imap
+
+        seen = changed = 0
+        start = time.time()
+        try:
+            for chunk in self.chunks(posts, options['chunk_size']):
+                current = dict((pk, highlighted) for pk, body, highlighted in chunk)
+                results = mapper(_highlight, [(pk, body) for pk, body, highlighted in chunk])
+                updates = [(pk, html) for pk, html in results if html != current[pk]]
+                if not options['dry_run'] and updates:
+                    self.write(updates)
+                    self.invalidate(updates)
+                seen += len(chunk)
+                changed += len(updates)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        elapsed = time.time() - start
+        self.stdout.write('{0} {1} of {2} posts in {3:.2f}s ({4:.1f} posts/s)\n'.format(
+            'Would update' if options['dry_run'] else 'Updated',
+            changed, seen, elapsed, seen / elapsed if elapsed else 0))
+
+    def chunks(self, posts, size):
+        """
+        Yields lists of (pk, body, body_highlighted) walking the posts by pk,
+        so only one chunk of bodies is held in memory at a time
+        """
+        last_pk = 0
+        while True:
+            chunk = list(posts.filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', 'body', 'body_highlighted')[:size])
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1][0]
+
+    @transaction.commit_on_success
+    def write(self, updates):
+        """
+        Writes a chunk of highlighted bodies in one transaction
+
+        Queryset updates don't touch 'modified', so it's set here, which
+        changes the ETag and Last-Modified of the pages showing the posts
+        """
+        modified = datetime.datetime.now()
+        for pk, html in updates:
+            Post.objects.filter(pk=pk).update(body_highlighted=html, modified=modified)
+
+    def invalidate(self, updates):
+        """
+        Invalidates the cached pages showing the updated posts, since
+        queryset updates don't send the signals that would
+        """
+        slugs = Post.objects.filter(pk__in=[pk for pk, html in updates]).values_list('slug', flat=True)
+        invalidate_pages(LISTING, *[post_namespace(slug) for slug in slugs])
@@ -0,0 +1,187 @@
+import hashlib
+import itertools
+import json
+import os
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve, reverse
+from django.test.client import RequestFactory
+
+from blog_wind.feeds import RecentFeed
+from blog_wind.models import Post
+from blog_wind.pagination import encode_cursor
+from blog_wind.views import POSTS_PER_PAGE
+from wind.storage import StaticToS3Storage
+
+MANIFEST_NAME = 'manifest.json'
+
+# Pages that don't show any posts, only rendered when missing or with --all
+STATIC_PAGES = ('about', 'resume')
+
+
+def _state(post, with_gallery=True):
+    """
+    Returns what a page showing post depends on
+    """
+    state = [post.pk, post.slug, str(post.modified), str(post.publish_at)]
+    if with_gallery:
+        state.append(str(post.gallery.modified) if post.gallery else None)
+    return state
+
+
+def _fingerprint(posts, *extra, **kwargs):
+    states = [_state(post, **kwargs) for post in posts]
+    return hashlib.sha1(json.dumps([states] + list(extra))).hexdigest()
+
+
+def export_name(path, content_type):
+    """
+    Returns the name of the file a page is written to, relative to the output
+    directory, e.g. index.html for / and feeds/recent.xml for /feeds/recent
+    """
+    name = path.strip('/') or 'index'
+    return name + ('.xml' if 'xml' in content_type else '.html')
+
+
+def render_page(path):
+    """
+    Runs in the pool's threads
+
+    Renders path through its view, as an anonymous visitor would see it, and
+    returns the response's content and content type
+    """
+    request = RequestFactory().get(path)
+    request.user = AnonymousUser()
+    match = resolve(path)
+    response = match.func(request, *match.args, **match.kwargs)
+    if hasattr(response, 'render') and callable(response.render):
+        response.render()
+    if response.status_code != 200:
+        raise CommandError('{0} responded with {1}'.format(path, response.status_code))
+    return response.content, response['Content-Type'].split(';')[0]
+
+
+class Command(BaseCommand):
+    help = ("Renders the public pages to files, so the site can be served "
+            "from disk or the CDN. Only pages whose posts changed since the "
+            "last build are rendered again")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', default=None,
+                    help='Directory the pages are written to. Defaults to STATIC_EXPORT_ROOT'),
+        make_option('--all', dest='all', action='store_true', default=False,
+                    help='Render every page, e.g. after changing templates'),
+        make_option('--upload', dest='upload', action='store_true', default=False,
+                    help='Also upload changed pages to S3, under STATIC_EXPORT_S3_PREFIX'),
+        make_option('--threads', type='int', default=4,
+                    help='Number of pages rendered at a time'),
+    )
+
+    def handle(self, *args, **options):
+        output = options['output'] or settings.STATIC_EXPORT_ROOT
+        if not os.path.exists(output):
+            os.makedirs(output)
+        manifest_path = os.path.join(output, MANIFEST_NAME)
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        pages = self.pages()
+        stale = [path for path, fingerprint in pages.iteritems()
+                 if options['all'] or path not in manifest or manifest[path]['fingerprint'] != fingerprint]
+        removed = [path for path in manifest if path not in pages]
+        storage = StaticToS3Storage() if options['upload'] else None
+
+        def render(path):
+            content, content_type = render_page(path)
+            name = export_name(path, content_type)
+            self.write(output, name, content)
+            if storage:
+                upload = ContentFile(content)
+                upload.content_type = content_type
+                storage.save(self.s3_name(path), upload)
+            return path, name
+
+        pool = ThreadPool(options['threads']) if options['threads'] > 1 else None
+        mapper = pool.imap_unordered if pool else itertools.imap
+        try:
+            for path, name in mapper(render, sorted(stale)):
+                manifest[path] = {'fingerprint': pages[path], 'name': name}
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        for path in removed:
+            name = os.path.join(output, manifest.pop(path)['name'])
+            if os.path.exists(name):
+                os.remove(name)
+        if storage and removed:
+            storage.delete_many([self.s3_name(path) for path in removed])
+
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        self.stdout.write('Rendered {0} of {1} pages, removed {2}\n'.format(len(stale), len(pages), len(removed)))
+
+    def pages(self):
+        """
+        Returns the path of every public page, mapped to a fingerprint of the
+        posts it shows
+        """
+        posts = list(Post.objects.get_posted().select_related('gallery'))
+        pages = {}
+        for post in posts:
+            pages[reverse('post', args=[post.slug])] = _fingerprint([post])
+        pages[reverse('writing')] = _fingerprint([post for post in posts if not post.gallery])
+        pages[reverse('galleries')] = _fingerprint([post for post in posts if post.gallery])
+        pages[reverse('feed')] = _fingerprint(RecentFeed().items(), with_gallery=False)
+        for name in STATIC_PAGES:
+            pages[reverse(name)] = ''
+
+        if getattr(settings, 'HOME_PAGINATION', 'offset') == 'keyset':
+            posts.sort(key=lambda post: (post.publish_at, post.pk), reverse=True)
+        chunks = [posts[i:i + POSTS_PER_PAGE] for i in range(0, len(posts), POSTS_PER_PAGE)] or [[]]
+        # Which pages are either side of a page is part of its fingerprint,
+        # since they're linked to
+        fingerprints = [_fingerprint(chunk, number, number == len(chunks) - 1)
+                        for number, chunk in enumerate(chunks)]
+        for number, chunk in enumerate(chunks):
+            if number == 0:
+                pages[reverse('home')] = fingerprints[number]
+            elif getattr(settings, 'HOME_PAGINATION', 'offset') == 'keyset':
+                pages[reverse('older_home', args=[encode_cursor(chunks[number - 1][-1])])] = fingerprints[number]
+                # Older pages link back to their newer page by their own first
+                # post, so it's rendered at that path too
+                pages[reverse('newer_home', args=[encode_cursor(chunk[0])])] = fingerprints[number - 1]
+            else:
+                pages[reverse('paged_home', args=[number + 1])] = fingerprints[number]
+        return pages
+
+    def write(self, output, name, content):
+        """
+        Writes a page, replacing the old file in one step so a web server
+        serving the directory never sees half a page
+        """
+        path = os.path.join(output, name)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # made by another thread in the meantime
+                pass
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.rename(path + '.tmp', path)
+
+    def s3_name(self, path):
+        """
+        Returns the key a page is uploaded to, which is its path so the CDN
+        can serve it at the same URL
+        """
+        return getattr(settings, 'STATIC_EXPORT_S3_PREFIX', 'site/') + (path.strip('/') or 'index.html')
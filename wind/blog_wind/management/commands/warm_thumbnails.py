@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from blog_wind.models import Photo
+from blog_wind.thumbnails import warm_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Generates any photo thumbnails the templates use that don't exist yet"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--gallery', dest='galleries', action='append', type='int', default=[],
+                    help='Only photos in the gallery with this id. Can be given more than once'),
+        make_option('--threads', type='int', default=None,
+                    help='Number of thumbnails generated at a time. Defaults to THUMBNAIL_WARM_THREADS'),
+    )
+
+    def handle(self, *args, **options):
+        photos = Photo.objects.exclude(image='')
+        if options['galleries']:
+            photos = photos.filter(galleries__in=options['galleries']).distinct()
+        photos = list(photos)
+        count = warm_thumbnails(photos, options['threads'], include_sources=not options['galleries'])
+        self.stdout.write('Generated {0} thumbnails for {1} photos\n'.format(count, len(photos)))
@@ -0,0 +1,107 @@
+from django.conf import settings
+from django.middleware import cache
+from django.utils.cache import (get_cache_key, get_max_age, learn_cache_key, patch_response_headers,
+                                patch_vary_headers)
+
+from blog_wind.cache import accepts_gzip_re, compress, page_key_prefix
+
+# Responses smaller than this aren't worth a gzipped variant
+MIN_COMPRESS_LENGTH = 200
+
+
+def add_gzip_variant(response):
+    """
+    Compresses a response that's about to be cached, keeping the gzipped
+    body on it alongside the identity body, and marks it as varying on
+    Accept-Encoding
+    """
+    if response.has_header('Content-Encoding') or len(response.content) < MIN_COMPRESS_LENGTH:
+        return response
+    content_type = response.get('Content-Type', '').split(';')[0]
+    if not content_type.startswith('text/') and not content_type.endswith('xml'):
+        return response
+    response.gzip_content = compress(response.content)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def select_variant(request, response):
+    """
+    Switches a response with a gzipped variant to it if the client accepts gzip
+    """
+    gzip_content = getattr(response, 'gzip_content', None)
+    if gzip_content is None or not accepts_gzip_re.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        return response
+    response.content = gzip_content
+    response.gzip_content = None
+    response['Content-Encoding'] = 'gzip'
+    response['Content-Length'] = str(len(gzip_content))
+    # The ETag stays the same for both bodies, so it's only a weak one
+    if response.has_header('ETag') and not response['ETag'].startswith('W/'):
+        response['ETag'] = 'W/' + response['ETag']
+    return response
+
+
+class UpdateCacheMiddleware(cache.UpdateCacheMiddleware):
+    """
+    Django's UpdateCacheMiddleware, caching pages under the versions of the
+    namespaces they're in
+
+    Pages stay in the cache for CACHE_MIDDLEWARE_SECONDS, since they're
+    invalidated as soon as they change, but browsers can't be told when that
+    happens so are only allowed to keep them for PAGE_CACHE_MAX_AGE
+
+    Pages are gzipped once, as they're cached, and stored with both bodies,
+    so cache hits don't compress them again
+    """
+    def process_response(self, request, response):
+        if not self._should_update_cache(request, response):
+            return response
+        if not response.status_code == 200:
+            return response
+        timeout = get_max_age(response)
+        if timeout is None:
+            timeout = self.cache_timeout
+        elif timeout == 0:
+            return response
+        patch_response_headers(response, min(timeout, getattr(settings, 'PAGE_CACHE_MAX_AGE', 300)))
+        key_prefix = getattr(request, '_cache_key_prefix', None) or page_key_prefix(request)
+        # Learnt before Vary: Accept-Encoding is added, so both bodies are under one key
+        cache_key = learn_cache_key(request, response, timeout, key_prefix, cache=self.cache)
+        if hasattr(response, 'render') and callable(response.render):
+            response.add_post_render_callback(
+                lambda r: self.cache.set(cache_key, add_gzip_variant(r), timeout))
+            return response
+        self.cache.set(cache_key, add_gzip_variant(response), timeout)
+        return select_variant(request, response)
+
+
+class FetchFromCacheMiddleware(cache.FetchFromCacheMiddleware):
+    """
+    Django's FetchFromCacheMiddleware, looking pages up under the versions
+    of the namespaces they're in, and serving their gzipped body to clients
+    that accept it
+    """
+    def process_request(self, request):
+        if not request.method in ('GET', 'HEAD'):
+            request._cache_update_cache = False
+            return None
+
+        # Kept for UpdateCacheMiddleware, so the page is stored under the
+        # versions it was looked up with even if they change while it renders
+        request._cache_key_prefix = key_prefix = page_key_prefix(request)
+        cache_key = get_cache_key(request, key_prefix, 'GET', cache=self.cache)
+        if cache_key is None:
+            request._cache_update_cache = True
+            return None
+        response = self.cache.get(cache_key, None)
+        if response is None and request.method == 'HEAD':
+            cache_key = get_cache_key(request, key_prefix, 'HEAD', cache=self.cache)
+            response = self.cache.get(cache_key, None)
+
+        if response is None:
+            request._cache_update_cache = True
+            return None
+
+        request._cache_update_cache = False
+        return select_variant(request, response)
@@ -1,21 +1,21 @@
 from __future__ import with_statement
 import datetime
+import hashlib
 import os
-import zipfile
-from cStringIO import StringIO
+import random
+import traceback
 
-from boto.exception import S3ResponseError
-from boto.s3.connection import S3Connection, SubdomainCallingFormat
-from bs4 import BeautifulSoup
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.core.files.base import ContentFile
-from django.db import models
-from PIL import Image
-from pygments import highlight, lexers
-from pygments.formatters import HtmlFormatter
+from django.db import models, transaction
+import pygments
 from sorl.thumbnail import ImageField
 
+from blog_wind.cache import LISTING, forget_next_publish_at, get_next_publish_at, invalidate_pages, post_namespace
+from blog_wind.highlighting import FORMATTER_OPTIONS, highlight_block, highlight_body
+from blog_wind.search import MAX_TOKEN_LENGTH, post_tokens, tokenize
+from blog_wind.thumbnails import pop_thumbnails, warm_thumbnails
+
 body_help_text = """
                  Main body text for post.
 
@@ -43,14 +43,24 @@ class CommonManager(models.Manager):
         return self.get_query_set().filter(active=True)
 
     def get_posted(self):
-        return self.get_query_set().filter(publish_at__lte=datetime.datetime.now(), active=True)
+        """
+        Returns the active objects whose publish_at has passed
+
+        They're filtered on the next scheduled publish_at rather than the
+        current time, so the query only changes when something goes live
+        """
+        posted = self.get_query_set().filter(active=True)
+        next_publish_at = get_next_publish_at(self.model)
+        if next_publish_at is not None:
+            posted = posted.filter(publish_at__lt=next_publish_at)
+        return posted
 
 
 class CommonInfo(models.Model):
     """
     Abstract model for Post, Gallery, and Photo that provides common fields
     """
-    title = models.CharField(max_length=120,
+    title = models.CharField(max_length=120, db_index=True,
                              help_text="Can be up to 120 characters.")
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
@@ -63,10 +73,59 @@ class CommonInfo(models.Model):
         abstract = True
 
 
+def delete_files(storage, names):
+    """
+    Deletes files from storage, in bulk if the storage supports it
+    """
+    if hasattr(storage, 'delete_many'):
+        storage.delete_many(names)
+    else:
+        for name in names:
+            storage.delete(name)
+
+
+class PhotoManager(CommonManager):
+    """
+    Manager for Photos
+
+    Adds deleting photos along with their files
+    """
+    def delete_with_files(self, photos):
+        """
+        Deletes photos, then their images and thumbnails off of storage in one
+        batch
+
+        Galleries the photos were in get their covers updated
+        """
+        photos = list(photos)
+        if not photos:
+            return
+        photo_ids = [photo.pk for photo in photos]
+        Through = Gallery.photos.through
+        with transaction.commit_on_success():
+            gallery_ids = list(Through.objects.filter(photo__in=photo_ids)
+                                              .values_list('gallery', flat=True).distinct())
+            self.get_query_set().filter(pk__in=photo_ids).delete()
+            for gallery in Gallery.objects.filter(pk__in=gallery_ids):
+                gallery.refresh_landscape_photos()
+        touch_galleries(gallery_ids)
+
+        names = []
+        for photo in photos:
+            if photo.image:
+                names.append(photo.image.name)
+                names.extend(pop_thumbnails(photo.image))
+        delete_files(self.model._meta.get_field('image').storage, names)
+
+
 class Photo(CommonInfo):
     image = ImageField(upload_to="galleries/photos/%Y/%m/%d")
     height = models.PositiveIntegerField(blank=True, null=True)
     width = models.PositiveIntegerField(blank=True, null=True)
+    digest = models.CharField(max_length=40, blank=True, db_index=True, editable=False,
+                              help_text="SHA-1 of the image file, used to spot duplicate uploads")
+
+    objects = PhotoManager()
 
     class Meta:
         ordering = ['title']
@@ -76,42 +135,174 @@ class Photo(CommonInfo):
 
     def delete(self, *args, **kwargs):
         """
-        Deletes the photo off of s3 before instance of Photo is deleted
+        Deletes the photo off of storage, along with its thumbnails, when the
+        instance of Photo is deleted
         """
-        try:
-            path = self.image.path
-            os.remove(path)
-        except NotImplementedError:  # This is live server, where images are on S3, and thus no absolute file path
-            conn = S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY, calling_format=SubdomainCallingFormat())
-            try:
-                bucket = conn.get_bucket(settings.AWS_STORAGE_BUCKET_NAME)
-                bucket.delete_key(self.image.name)
-            except S3ResponseError:  # bucket doesn't exist for some reason
-                pass
-        super(Photo, self).delete(*args, **kwargs)
+        Photo.objects.delete_with_files([self])
+
+
+class GalleryManager(CommonManager):
+    """
+    Manager for Galleries
+
+    Adds choosing the cover photos shown for galleries on the photos page
+    """
+    def attach_covers(self, galleries, mode=None):
+        """
+        Sets cover_photo on each gallery with a single query for all of them
+
+        In 'random' mode a random landscape photo is picked from each gallery's
+        landscape_photo_ids, so no sorting happens in the database. In 'cover'
+        mode each gallery's cover is used, so the page stays the same between
+        requests. Defaults to the GALLERY_COVER_MODE setting.
+        """
+        mode = mode or getattr(settings, 'GALLERY_COVER_MODE', 'random')
+        chosen = {}
+        for gallery in galleries:
+            landscape_ids = gallery.get_landscape_photo_ids()
+            if mode == 'random' and landscape_ids:
+                chosen[gallery.pk] = random.choice(landscape_ids)
+            else:
+                chosen[gallery.pk] = gallery.cover_id
+        photos = Photo.objects.in_bulk([pk for pk in chosen.values() if pk])
+        for gallery in galleries:
+            gallery.cover_photo = photos.get(chosen[gallery.pk])
+        return galleries
+
+    def delete_with_photos(self, galleries):
+        """
+        Deletes galleries along with the photos that aren't in any other gallery
+
+        The orphaned photos are found with one query, and their files deleted
+        from storage in one batch
+        """
+        gallery_ids = [gallery.pk for gallery in galleries]
+        Through = Gallery.photos.through
+        orphans = list(Photo.objects.filter(pk__in=Through.objects.filter(gallery__in=gallery_ids).values('photo'))
+                                    .exclude(pk__in=Through.objects.exclude(gallery__in=gallery_ids).values('photo')))
+        with transaction.commit_on_success():
+            self.get_query_set().filter(pk__in=gallery_ids).delete()
+        Photo.objects.delete_with_files(orphans)
 
 
 class Gallery(CommonInfo):
     photos = models.ManyToManyField(Photo, related_name='galleries', null=True, blank=True)
+    cover = models.ForeignKey(Photo, related_name='+', null=True, blank=True, on_delete=models.SET_NULL,
+                              help_text="Photo shown for the gallery on the photos page. "
+                                        "Defaults to the first landscape photo.")
+    landscape_photo_ids = models.TextField(blank=True, editable=False)
+
+    objects = GalleryManager()
 
     def __unicode__(self):
         return self.title
 
+    def get_landscape_photo_ids(self):
+        return [int(pk) for pk in self.landscape_photo_ids.split(',') if pk]
+
+    def refresh_landscape_photos(self):
+        """
+        Recomputes the ids of the gallery's landscape photos, and picks the
+        first of them as cover if the gallery doesn't have a cover among its
+        photos
+        """
+        landscape_ids = list(self.photos.filter(width__gt=models.F('height'))
+                                        .order_by('title', 'pk').values_list('pk', flat=True))
+        self.landscape_photo_ids = ','.join(str(pk) for pk in landscape_ids)
+        if self.cover_id is None or not self.photos.filter(pk=self.cover_id).exists():
+            self.cover_id = landscape_ids[0] if landscape_ids else None
+        # Updated directly so saving doesn't count as an edit of the gallery
+        Gallery.objects.filter(pk=self.pk).update(landscape_photo_ids=self.landscape_photo_ids,
+                                                   cover=self.cover_id)
+
     def delete(self, *args, **kwargs):
         """
         Deletes the photos that are only associated with this gallery
         """
-        for photo in self.photos.all():
-            if photo.galleries.count() == 1:
-                photo.delete()
-        super(Gallery, self).delete(*args, **kwargs)
+        Gallery.objects.delete_with_photos([self])
+
+
+class HighlightCacheManager(models.Manager):
+    """
+    Manager for HighlightedBlocks
+
+    Looks up previously highlighted code blocks by content so unchanged
+    <pre> blocks don't have to be lexed again, and keeps count of hits and
+    misses for the life of the process
+    """
+    def __init__(self, *args, **kwargs):
+        super(HighlightCacheManager, self).__init__(*args, **kwargs)
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, code, lexer_name, formatter_options):
+        """
+        Key is a digest of the lexer, formatter options, pygments version
+        and the unescaped code itself
+        """
+        options = repr(sorted(formatter_options.items()))
+        digest = hashlib.sha1()
+        for part in (pygments.__version__, lexer_name, options):
+            digest.update(part.encode('utf-8'))
+            digest.update('\0')
+        digest.update(code.encode('utf-8'))
+        return digest.hexdigest()
+
+    def highlight(self, code, lexer_name, formatter_options=None):
+        """
+        Returns highlighted markup for code, only calling pygments if this
+        block has never been seen before
+        """
+        if formatter_options is None:
+            formatter_options = FORMATTER_OPTIONS
+        key = self.make_key(code, lexer_name, formatter_options)
+        now = datetime.datetime.now()
+        try:
+            block = self.get_query_set().get(key=key)
+        except self.model.DoesNotExist:
+            self.misses += 1
+            html = highlight_block(code, lexer_name, formatter_options)
+            self.create(key=key, html=html, last_used=now)
+            self.evict()
+            return html
+        self.hits += 1
+        self.get_query_set().filter(pk=block.pk).update(last_used=now)
+        return block.html
+
+    def evict(self):
+        """
+        Deletes the least recently used blocks past HIGHLIGHT_CACHE_MAX_ENTRIES
+        """
+        max_entries = getattr(settings, 'HIGHLIGHT_CACHE_MAX_ENTRIES', 2000)
+        stale = self.get_query_set().order_by('-last_used', '-pk')[max_entries:]
+        stale_ids = list(stale.values_list('pk', flat=True))
+        if stale_ids:
+            self.get_query_set().filter(pk__in=stale_ids).delete()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+class HighlightedBlock(models.Model):
+    """
+    Cached pygments output for a single <pre> block of a Post
+    """
+    key = models.CharField(max_length=40, unique=True)
+    html = models.TextField()
+    last_used = models.DateTimeField(db_index=True)
+
+    objects = HighlightCacheManager()
+
+    def __unicode__(self):
+        return self.key
 
 
 class Post(CommonInfo):
     slug = models.SlugField(unique=True)
     body = models.TextField(blank=True, help_text=body_help_text)
     body_highlighted = models.TextField(blank=True)
-    publish_at = models.DateTimeField(default=datetime.datetime.now(),
+    publish_at = models.DateTimeField(default=datetime.datetime.now(), db_index=True,
                                       help_text="Date and time post should become active.")
     gallery = models.ForeignKey(Gallery, related_name="post", blank=True, null=True)
 
@@ -124,6 +315,7 @@ class Post(CommonInfo):
     def save(self, *args, **kwargs):
         self.body_highlighted = self.highlight_code(self.body)
         super(Post, self).save(*args, **kwargs)
+        PostToken.objects.index(self)
 
     @models.permalink
     def get_absolute_url(self):
@@ -135,42 +327,160 @@ class Post(CommonInfo):
         """
         Highlight code in all <pre> elements of body
 
-        BeautifulSoup parses the HTML and extracts all <pre> blocks
-        Contents of each <pre> are converted to unicode
-        with '<', '>', and '&' unescaped since BeatifulSoup might think
-        and '<....>' is a tag and try and close it, etc.
-
-        Then send that unicode through pygments to lex, format, and style it
+        Each <pre> block is found by a single scan of the body, its contents
+        unescaped, and sent through pygments to lex, format, and style it,
+        unless the same code has been highlighted before, in which case the
+        markup comes from the HighlightedBlock cache
 
         The lexer is chosen based on the class of the <pre> (ie 'python', etc)
 
-        Finally replace those <pre> blocks with the new highlighted markup
-        and return it as unicode
+        Finally those <pre> blocks are replaced with the new highlighted markup,
+        leaving the rest of the body untouched, and it is returned as unicode
         """
-        soup = BeautifulSoup(body)
-        preblocks = soup.findAll('pre')
-        for pre in preblocks:
-            if hasattr(pre, 'class'):
-                try:
-                    code = ''.join([unicode(item) for item in pre.contents])
-                    code = self.unescape_html(code)
-                    lexer = lexers.get_lexer_by_name(pre['class'][0])
-                    code_hl = highlight(code, lexer, HtmlFormatter())
-                    pre.replaceWith(BeautifulSoup(code_hl))
-                except:
-                    raise
-        return unicode(soup)
+        return highlight_body(body, HighlightedBlock.objects.highlight)
 
-    def unescape_html(self, html):
-        return html.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+class PostTokenManager(models.Manager):
+    """
+    Manager for PostTokens
+
+    Keeps the search index of posts, and looks posts up by the words in them
+    """
+    batch_size = 200
+
+    def index(self, post):
+        """
+        Replaces the tokens of post with those of its current title and body
+        """
+        tokens = [PostToken(post=post, token=token, weight=weight)
+                  for token, weight in post_tokens(post.title, post.body).iteritems()]
+        with transaction.commit_on_success():
+            self.get_query_set().filter(post=post).delete()
+            # In batches, as sqlite only takes so many rows in one insert
+            for start in range(0, len(tokens), self.batch_size):
+                self.bulk_create(tokens[start:start + self.batch_size])
+
+    def matching(self, query):
+        """
+        Returns the ids of the posts containing every word of query, as a
+        query to be used as a subquery
+        """
+        tokens = set(tokenize(query))
+        return (self.get_query_set().filter(token__in=tokens).values('post')
+                    .annotate(matched=models.Count('token')).filter(matched=len(tokens)).values('post'))
+
+    def search(self, query, posts, limit=None):
+        """
+        Returns the posts among posts containing every word of query, most
+        relevant first
+
+        Posts are ranked by the weight of the query's words in them, so words
+        in the title count for more than words in the body, then newest first
+
+        Ranking only reads the index, then the ranked posts are looked up in
+        posts in batches until there are enough, so the query doesn't have to
+        go through every post to leave out drafts
+        """
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+        ranked = (self.get_query_set().filter(token__in=tokens).values('post')
+                      .annotate(matched=models.Count('token'), score=models.Sum('weight'))
+                      .filter(matched=len(tokens)).order_by('-score', '-post'))
+        batch_size = min(limit, self.batch_size) if limit else self.batch_size
+        results = []
+        start = 0
+        while limit is None or len(results) < limit:
+            ids = [row['post'] for row in ranked[start:start + batch_size]]
+            found = posts.in_bulk(ids)
+            results.extend(found[pk] for pk in ids if pk in found)
+            if len(ids) < batch_size:
+                break
+            start += batch_size
+        return results[:limit]
+
+
+class PostToken(models.Model):
+    """
+    A word of a Post, in the search index
+
+    Weight is how many times the word appears in the post, with words in the
+    title counting for more
+    """
+    post = models.ForeignKey(Post, related_name='tokens')
+    token = models.CharField(max_length=MAX_TOKEN_LENGTH, db_index=True)
+    weight = models.PositiveIntegerField()
+
+    objects = PostTokenManager()
+
+    class Meta:
+        unique_together = ('token', 'post')
+
+    def __unicode__(self):
+        return self.token
+
+
+class GalleryUploadManager(models.Manager):
+    """
+    Manager for GalleryUploads, which double as a queue of ingest jobs
+    """
+    def stalled(self):
+        """
+        Returns the running uploads that haven't made progress for
+        GALLERY_UPLOAD_LEASE_MINUTES, e.g. because their worker was killed
+        """
+        lease = datetime.timedelta(minutes=getattr(settings, 'GALLERY_UPLOAD_LEASE_MINUTES', 15))
+        return self.get_query_set().filter(models.Q(heartbeat__lt=datetime.datetime.now() - lease) |
+                                           models.Q(heartbeat__isnull=True),
+                                           status=GalleryUpload.RUNNING)
+
+    def requeue_stalled(self, max_attempts=3):
+        """
+        Puts stalled uploads back in the queue, or marks them failed once
+        they've been tried max_attempts times
+        """
+        stalled = self.stalled()
+        error = 'Made no progress for too long, the worker processing it may have stopped'
+        stalled.filter(attempts__gte=max_attempts).update(status=GalleryUpload.FAILED, error=error)
+        stalled.update(status=GalleryUpload.PENDING, error=error)
+
+    def claim_next(self, max_attempts=3):
+        """
+        Marks the oldest pending upload as running and returns it, or None if
+        there aren't any, after putting stalled uploads back in the queue
+
+        Claiming is a conditional update, so two workers never get the same one
+        """
+        self.requeue_stalled(max_attempts)
+        pending = self.get_query_set().filter(status=GalleryUpload.PENDING)
+        for pk in pending.order_by('pk').values_list('pk', flat=True)[:10]:
+            claimed = pending.filter(pk=pk).update(status=GalleryUpload.RUNNING,
+                                                   attempts=models.F('attempts') + 1,
+                                                   heartbeat=datetime.datetime.now())
+            if claimed:
+                return self.get_query_set().get(pk=pk)
+        return None
 
 
 class GalleryUpload(models.Model):
     """
     Used to easily create Galleries in admin section
 
-    Provided a .zip file of photos it creates a gallery
+    Provided a .zip file of photos it creates a gallery. Saving only stores
+    the .zip file; the photos are processed by the process_gallery_uploads
+    command, which records its progress here
     """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
     zip_file = models.FileField(upload_to='temp',
                                 storage=settings.LOCAL_FILE_STORAGE,
                                 help_text="Select a .zip file of images to upload")
@@ -178,64 +488,167 @@ class GalleryUpload(models.Model):
                             help_text="Select a gallery to add these images to. Leave blank to create new gallery.")
     title = models.CharField(max_length=120,
                              help_text="Can be up to 120 characters.")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING,
+                              db_index=True, editable=False)
+    photos_done = models.PositiveIntegerField(default=0, editable=False)
+    photos_total = models.PositiveIntegerField(default=0, editable=False)
+    attempts = models.PositiveIntegerField(default=0, editable=False)
+    error = models.TextField(blank=True, editable=False)
+    # When a worker claimed the upload or last recorded progress on it
+    heartbeat = models.DateTimeField(null=True, blank=True, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
 
-    def save(self, *args, **kwargs):
-        super(GalleryUpload, self).save(*args, **kwargs)
-        self.process_zipfile()
-        self.delete()
+    objects = GalleryUploadManager()
+
+    class Meta:
+        ordering = ['-created']
+
+    def __unicode__(self):
+        return self.title
 
     def delete(self, *args, **kwargs):
         """
         Deletes the zip file used to create the gallery since it is no longer needed
         """
-        os.remove(self.zip_file.path)
+        self.remove_zipfile()
         super(GalleryUpload, self).delete(*args, **kwargs)
 
+    def remove_zipfile(self):
+        if self.zip_file and os.path.isfile(self.zip_file.path):
+            os.remove(self.zip_file.path)
+
     def process_zipfile(self):
+        # Imported here since ingest needs the models defined above
+        from blog_wind.ingest import ingest_zipfile
+
         if os.path.isfile(self.zip_file.path):
-            with zipfile.ZipFile(self.zip_file.path) as zf:
-                bad_file = zf.testzip()
-                if bad_file:
-                    raise ValidationError('"{0}" in the .zip file is corrupt.'.format(bad_file))
-                if self.gallery:
-                    gallery = self.gallery
-                else:
-                    gallery = Gallery.objects.create(title=self.title)
-                count = 1
-                for filename in sorted(zf.namelist()):
-                    if filename.startswith('__'):  # don't process meta files
-                        continue
-                    data = zf.read(filename)
-                    if len(data):
-                        img_file = StringIO(data)
-                        try:
-                            # load() can spot a truncated JPEG
-                            trial_image = Image.open(img_file)
-                            trial_image.load()
-
-                            # Since we're about to use the file again we have to reset the
-                            # file object if possible.
-                            if hasattr(img_file, 'reset'):
-                                img_file.reset()
-
-                            # verify() can spot a corrupt PNG
-                            # but it must be called immediately after the constructor
-                            trial_image = Image.open(img_file)
-                            trial_image.verify()
-                        except:  # PIL doesn't recognize file as an image
-                            raise ValidationError('Image failed to validate: {0}'.format(filename))
-
-                        # Rewind image pointers back to start of file
-                        if hasattr(data, 'seek') and callable(data.seek):
-                            data.seek(0)
-
-                        title = self.title + ' ' + str(count).zfill(2)
-                        try:
-                            photo = Photo.objects.get(title=title)
-                        except Photo.DoesNotExist:
-                            photo = Photo.objects.create(title=title)
-                            photo.width = trial_image.size[0]
-                            photo.height = trial_image.size[1]
-                            photo.image.save(filename, ContentFile(data))
-                            gallery.photos.add(photo)
-                        count += 1
+            return ingest_zipfile(self.zip_file.path, self.title, self.gallery,
+                                  progress=self.record_progress)
+
+    def claimed(self):
+        """
+        Returns a queryset of this upload for as long as this claim on it
+        holds, which is empty once it's been put back in the queue and
+        claimed again
+        """
+        return GalleryUpload.objects.filter(pk=self.pk, status=self.RUNNING, attempts=self.attempts)
+
+    def record_progress(self, done, total):
+        # update() doesn't touch modified, so the time is set explicitly
+        self.claimed().update(photos_done=done, photos_total=total, heartbeat=datetime.datetime.now())
+
+    def record_heartbeat(self):
+        self.claimed().update(heartbeat=datetime.datetime.now())
+
+    def run(self, max_attempts=3):
+        """
+        Processes the zip file of a claimed upload, then generates the
+        thumbnails the templates need for the gallery's photos
+
+        Failures are put back in the queue until max_attempts is reached,
+        except for invalid .zip files, which will fail the same way every time.
+        A worker whose upload stalled and was claimed by another one leaves
+        the outcome to that one
+        """
+        try:
+            gallery = self.process_zipfile()
+            if gallery:
+                # Recorded first so a retry adds to this gallery instead of making another
+                GalleryUpload.objects.filter(pk=self.pk).update(gallery=gallery)
+                self.record_heartbeat()
+                warm_thumbnails(gallery.photos.all(), progress=lambda done, total: self.record_heartbeat())
+        except Exception as e:
+            retry = self.attempts < max_attempts and not isinstance(e, ValidationError)
+            self.claimed().update(status=self.PENDING if retry else self.FAILED,
+                                  error=traceback.format_exc())
+            raise
+        if self.claimed().update(status=self.DONE, error=''):
+            self.remove_zipfile()
+
+
+def invalidate_gallery_pages(gallery_ids):
+    """
+    Invalidates the cached listings, and the pages of the posts showing any
+    of the galleries
+    """
+    slugs = Post.objects.filter(gallery__in=list(gallery_ids)).values_list('slug', flat=True) if gallery_ids else []
+    invalidate_pages(LISTING, *[post_namespace(slug) for slug in slugs])
+
+
+def touch_galleries(gallery_ids):
+    """
+    Marks galleries as modified as their photos change, and invalidates the
+    cached pages showing them
+    """
+    if gallery_ids:
+        Gallery.objects.filter(pk__in=list(gallery_ids)).update(modified=datetime.datetime.now())
+    invalidate_gallery_pages(gallery_ids)
+
+
+def remember_post_slug(sender, instance, raw, **kwargs):
+    """
+    Remembers the slug a post had, so its old page is invalidated if it changes
+    """
+    if instance.pk and not raw:
+        instance._old_slugs = list(Post.objects.filter(pk=instance.pk).values_list('slug', flat=True))
+
+models.signals.pre_save.connect(remember_post_slug, sender=Post)
+
+
+def invalidate_post_pages(sender, instance, **kwargs):
+    """
+    Invalidates the cached pages showing a post as it's saved or deleted
+    """
+    slugs = set(getattr(instance, '_old_slugs', []) + [instance.slug])
+    forget_next_publish_at(Post)
+    invalidate_pages(LISTING, *[post_namespace(slug) for slug in slugs])
+
+models.signals.post_save.connect(invalidate_post_pages, sender=Post)
+models.signals.post_delete.connect(invalidate_post_pages, sender=Post)
+
+
+def invalidate_gallery(sender, instance, **kwargs):
+    """
+    Invalidates the cached pages showing a gallery as it's saved or deleted
+    """
+    invalidate_gallery_pages([instance.pk])
+
+models.signals.post_save.connect(invalidate_gallery, sender=Gallery)
+models.signals.post_delete.connect(invalidate_gallery, sender=Gallery)
+
+
+def refresh_gallery_photos(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keeps landscape photos and covers up to date as photos are added to or
+    removed from galleries
+    """
+    if action == 'pre_clear' and reverse:
+        # post_clear isn't told which galleries the photo was in
+        instance._cleared_gallery_ids = list(instance.galleries.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:  # photo.galleries was changed
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_gallery_ids', None)
+        galleries = Gallery.objects.filter(pk__in=pk_set) if pk_set else Gallery.objects.none()
+    else:
+        galleries = [instance]
+    for gallery in galleries:
+        gallery.refresh_landscape_photos()
+    touch_galleries([gallery.pk for gallery in galleries])
+
+models.signals.m2m_changed.connect(refresh_gallery_photos, sender=Gallery.photos.through)
+
+
+def refresh_photo_galleries(sender, instance, **kwargs):
+    """
+    Keeps landscape photos and covers up to date as photos change size
+    """
+    galleries = list(Gallery.objects.filter(photos=instance))
+    for gallery in galleries:
+        gallery.refresh_landscape_photos()
+    touch_galleries([gallery.pk for gallery in galleries])
+
+models.signals.post_save.connect(refresh_photo_galleries, sender=Photo)
@@ -0,0 +1,81 @@
+"""
+Keyset pagination of posts
+
+Pages are found by the (publish_at, id) of the post they start after rather
+than by their number, so showing a page takes one query however deep into
+the archive it is, instead of a COUNT(*) and an OFFSET that both have to
+walk every newer post.
+"""
+import datetime
+
+from django.db.models import Q
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(post):
+    """
+    Returns the cursor of a post, used in the URLs of the pages either side of it
+    """
+    return '{0}-{1}'.format(post.publish_at.strftime(CURSOR_FORMAT), post.pk)
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (publish_at, id) in a cursor, raising ValueError if it's malformed
+    """
+    publish_at, pk = cursor.split('-')
+    return datetime.datetime.strptime(publish_at, CURSOR_FORMAT), int(pk)
+
+
+class KeysetPage(object):
+    """
+    A page of posts, which knows whether there are older and newer posts
+    either side of it
+    """
+    def __init__(self, object_list, has_older, has_newer):
+        self.object_list = object_list
+        self.has_older = has_older and bool(object_list)
+        self.has_newer = has_newer and bool(object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_older or self.has_newer
+
+    @property
+    def older_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.has_older else None
+
+    @property
+    def newer_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.has_newer else None
+
+
+def keyset_page(posts, per_page, older_than=None, newer_than=None):
+    """
+    Returns the KeysetPage of per_page posts older than the cursor older_than,
+    or newer than the cursor newer_than, or the newest posts if neither is given
+
+    One more post than the page holds is fetched, to tell whether there's
+    another page beyond it without counting
+    """
+    if newer_than:
+        publish_at, pk = decode_cursor(newer_than)
+        posts = posts.filter(Q(publish_at__gt=publish_at) | Q(publish_at=publish_at, pk__gt=pk))
+        object_list = list(posts.order_by('publish_at', 'pk')[:per_page + 1])
+        has_newer = len(object_list) > per_page
+        object_list = object_list[:per_page]
+        object_list.reverse()
+        return KeysetPage(object_list, has_older=True, has_newer=has_newer)
+
+    if older_than:
+        publish_at, pk = decode_cursor(older_than)
+        posts = posts.filter(Q(publish_at__lt=publish_at) | Q(publish_at=publish_at, pk__lt=pk))
+    object_list = list(posts.order_by('-publish_at', '-pk')[:per_page + 1])
+    return KeysetPage(object_list[:per_page], has_older=len(object_list) > per_page,
+                      has_newer=bool(older_than))
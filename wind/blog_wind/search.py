@@ -0,0 +1,47 @@
+"""
+Tokenizing posts for the search index
+
+Posts are indexed by the words of their title and the text of their body,
+with tags removed and entities unescaped, so searches look up the PostToken
+rows of a few words instead of scanning every body with LIKE '%term%'.
+"""
+import re
+from collections import defaultdict
+
+from blog_wind.highlighting import unescape_html
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Tags are replaced with a space, so the words either side of </p><p> aren't run together
+TAG_RE = re.compile(r'<[^>]*>')
+
+# Longest token kept, matching PostToken.token
+MAX_TOKEN_LENGTH = 40
+
+# A word in the title counts as much as this many in the body
+TITLE_WEIGHT = 3
+
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have i if in into is it its of on
+    or that the their there this to was we were will with you your
+""".split())
+
+
+def tokenize(text):
+    """
+    Returns the words of text that are worth indexing, lowercased, in order
+    """
+    return [word[:MAX_TOKEN_LENGTH] for word in WORD_RE.findall(text.lower())
+            if len(word) > 1 and word not in STOP_WORDS]
+
+
+def post_tokens(title, body):
+    """
+    Returns the weight of each token of a post, from its title and its body
+    """
+    weights = defaultdict(int)
+    for token in tokenize(title):
+        weights[token] += TITLE_WEIGHT
+    for token in tokenize(unescape_html(TAG_RE.sub(' ', body))):
+        weights[token] += 1
+    return dict(weights)
@@ -1,6 +1,10 @@
+import random
+
 from django import template
 from django.db.models import F
 
+from blog_wind.models import Gallery, Photo
+
 register = template.Library()
 
 @register.filter
@@ -8,7 +12,18 @@ def random_image(photos):
     """
     Chooses a random photo from the gallery to display
 
-    Makes sure the photo is of landscape orientation
+    Makes sure the photo is of landscape orientation. Takes a gallery, its
+    photos manager, or a queryset of photos such as gallery.photos.all. For
+    a gallery it picks from the gallery's list of landscape photos, and for
+    a queryset from the ids of its landscape photos, rather than sorting
+    them randomly in the database. Returns None if there are no landscape
+    photos.
     """
-    random_photo = photos.filter(width__gt=F('height')).order_by('?')[0]
-    return random_photo
+    gallery = getattr(photos, 'instance', photos)
+    if isinstance(gallery, Gallery):
+        Gallery.objects.attach_covers([gallery], mode='random')
+        return gallery.cover_photo
+    landscape_ids = list(photos.filter(width__gt=F('height')).values_list('pk', flat=True))
+    if not landscape_ids:
+        return None
+    return Photo.objects.get(pk=random.choice(landscape_ids))
@@ -5,7 +5,52 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import datetime
+import gzip
+import hashlib
+import imp
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+import mock
+from bs4 import BeautifulSoup
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.contrib.auth.models import User
+from django.contrib.staticfiles import finders
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import connection, reset_queries
 from django.test import TestCase
+from django.test.utils import override_settings
+from PIL import Image
+from sorl.thumbnail import default as thumbnail_default
+
+from blog_wind.highlighting import highlight_body, highlight_body_with_soup
+from blog_wind.ingest import ingest_zipfile, upload_member
+from blog_wind.feeds import RecentFeed
+from blog_wind.cache import LISTING, get_page_cache, post_namespace
+from blog_wind.models import Gallery, GalleryUpload, Photo, Post, PostToken, HighlightedBlock
+from blog_wind.pagination import keyset_page
+from blog_wind.search import tokenize
+from blog_wind.templatetags.gallery_tags import random_image
+from blog_wind.thumbnails import SOURCE_THUMBNAILS, THUMBNAIL_GEOMETRIES
+from wind.storage import ManifestStaticToS3Storage, MediaToS3Storage, StaticToS3Storage
 
 
 class SimpleTest(TestCase):
@@ -14,3 +59,1349 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class HighlightCacheTest(TestCase):
+    body = ('<p>Intro</p><pre class="python">print 1 &lt; 2</pre>'
+            '<p>Middle</p><pre class="python">x = "a" &amp; "b"</pre>')
+
+    def setUp(self):
+        HighlightedBlock.objects.reset_stats()
+
+    def test_unchanged_blocks_are_not_lexed_again(self):
+        post = Post(title='Code', slug='code', body=self.body)
+        post.save()
+        self.assertEqual(HighlightedBlock.objects.misses, 2)
+        self.assertEqual(HighlightedBlock.objects.hits, 0)
+        self.assertIn('class="highlight"', post.body_highlighted)
+
+        post.body = post.body.replace('Intro', 'Introduction')
+        post.save()
+        self.assertEqual(HighlightedBlock.objects.misses, 2)
+        self.assertEqual(HighlightedBlock.objects.hits, 2)
+
+    @override_settings(HIGHLIGHT_CACHE_MAX_ENTRIES=1)
+    def test_least_recently_used_blocks_are_evicted(self):
+        Post(title='Code', slug='code', body=self.body).save()
+        self.assertEqual(HighlightedBlock.objects.count(), 1)
+
+
+class HighlightBodyTest(TestCase):
+    def test_output_matches_beautifulsoup_implementation(self):
+        body = (u'<h3 class="section-header">Setup</h3>'
+                u'<pre class="python">if a &lt; b &amp;&amp; c &gt; d:\n    print "&quot;hi&quot;"</pre>'
+                u"<p>Then run <code>./manage.py</code>:</p><pre class='bash extra'>echo $HOME</pre>")
+        self.assertEqual(BeautifulSoup(highlight_body(body)).decode(),
+                         BeautifulSoup(highlight_body_with_soup(body)).decode())
+
+    def test_text_outside_of_pre_blocks_is_untouched(self):
+        body = u'<p>Unclosed <b>tags<br>stay as written</p><pre>no class</pre>'
+        self.assertEqual(highlight_body(body), body)
+
+
+class RehighlightPostsTest(TestCase):
+    def test_rewrites_stale_highlighting_and_invalidates_its_pages(self):
+        post = Post(title='Code', slug='code', body=u'<pre class="python">x = 1</pre>')
+        post.save()
+        modified = datetime.datetime.now() - datetime.timedelta(days=1)
+        Post.objects.filter(pk=post.pk).update(body_highlighted=u'stale', modified=modified)
+
+        out = StringIO()
+        call_command('rehighlight_posts', dry_run=True, processes=1, stdout=out)
+        self.assertIn('Would update 1 of 1 posts', out.getvalue())
+        self.assertEqual(Post.objects.get(pk=post.pk).body_highlighted, u'stale')
+
+        with mock.patch('blog_wind.management.commands.rehighlight_posts.invalidate_pages') as invalidate:
+            call_command('rehighlight_posts', slugs=['code'], processes=1, stdout=StringIO())
+        invalidate.assert_called_once_with(LISTING, post_namespace('code'))
+        post = Post.objects.get(pk=post.pk)
+        self.assertIn('class="highlight"', post.body_highlighted)
+        self.assertTrue(post.modified > modified)
+
+
+class FakeBucket(object):
+    """
+    Stands in for a boto S3 bucket, keeping keys in memory
+    """
+    def __init__(self, names=()):
+        self.keys = set(names)
+        self.requests = []
+        self.contents = {}
+        # Number of times the next part uploads fail
+        self.failing_parts = 0
+
+    def delete_keys(self, keys, quiet=False):
+        self.requests.append(('delete_keys', list(keys)))
+        self.keys.difference_update(keys)
+        return mock.Mock(errors=[])
+
+    def get_key(self, name):
+        self.requests.append(('get_key', name))
+        if name not in self.keys:
+            return None
+        key = mock.Mock(etag='"{0}"'.format(hashlib.md5(self.contents.get(name, '')).hexdigest()))
+        key.name = name
+        return key
+
+    def new_key(self, name):
+        key = mock.Mock(etag=None)
+
+        def set_contents_from_file(fp, headers=None, **kwargs):
+            fp.seek(0)
+            self.requests.append(('put', name, headers))
+            self.keys.add(name)
+            self.contents[name] = fp.read()
+            key.etag = '"{0}"'.format(hashlib.md5(self.contents[name]).hexdigest())
+        key.set_contents_from_file = set_contents_from_file
+        key.set_contents_from_string = lambda s, headers=None, **kwargs: set_contents_from_file(
+            StringIO(s), headers=headers, **kwargs)
+        return key
+
+    def delete_key(self, name):
+        self.requests.append(('delete_key', name))
+        self.keys.discard(name)
+
+    def list(self):
+        self.requests.append(('list',))
+        keys = []
+        for name in sorted(self.keys):
+            key = mock.Mock(etag='"{0}"'.format(hashlib.md5(self.contents.get(name, '')).hexdigest()),
+                            last_modified='2013-01-31T12:00:00.000Z')
+            # Mock takes name as its own argument
+            key.name = name
+            keys.append(key)
+        return keys
+
+    def initiate_multipart_upload(self, name, headers=None, **kwargs):
+        self.requests.append(('initiate_multipart_upload', name, headers))
+        parts = {}
+
+        def upload_part_from_file(fp, number, **kwargs):
+            if self.failing_parts:
+                self.failing_parts -= 1
+                raise socket.error('Connection reset by peer')
+            self.requests.append(('upload_part', number))
+            parts[number] = fp.read()
+
+        def complete_upload():
+            self.requests.append(('complete_upload', name))
+            self.keys.add(name)
+            self.contents[name] = ''.join(parts[number] for number in sorted(parts))
+            return mock.Mock(etag='"{0}-{1}"'.format(hashlib.md5(self.contents[name]).hexdigest(), len(parts)))
+
+        def cancel_upload():
+            self.requests.append(('cancel_upload', name))
+
+        return mock.Mock(key_name=name, upload_part_from_file=upload_part_from_file,
+                         complete_upload=complete_upload, cancel_upload=cancel_upload)
+
+
+def import_fabfile():
+    """
+    Imports the fabfile, which lives beside the Django project rather than in it
+    """
+    if 'fabfile' not in sys.modules:
+        imp.load_source('fabfile', os.path.join(settings.LOCAL_PROJECT_ROOT, '..', 'fabfile.py'))
+    return sys.modules['fabfile']
+
+
+def fake_s3_storage(bucket, storage_class=StaticToS3Storage, **kwargs):
+    storage = storage_class(access_key='key', secret_key='secret', **kwargs)
+    storage._bucket = bucket
+    return storage
+
+
+class QueryBudgetMixin(object):
+    """
+    Lets tests cap the number of queries a block of code makes
+    """
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        """
+        Fails if the block makes more than budget queries
+
+        Thumbnail lookups are left out, since they go to sorl's key value
+        store, which is served from memcached in production
+        """
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        # Requests made by the test client would otherwise clear the log
+        request_started.disconnect(reset_queries)
+        start = len(connection.queries)
+        try:
+            yield
+        finally:
+            request_started.connect(reset_queries)
+            connection.use_debug_cursor = old_debug_cursor
+        queries = [query['sql'] for query in connection.queries[start:]
+                   if 'thumbnail_kvstore' not in query['sql']]
+        self.assertTrue(len(queries) <= budget, '{0} queries made, {1} allowed:\n{2}'.format(
+            len(queries), budget, '\n'.join(queries)))
+
+
+def use_temp_feed_cache(test):
+    """
+    Keeps the rendered feeds a test makes out of FEED_CACHE_ROOT
+    """
+    root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, root)
+    feed_cache = override_settings(FEED_CACHE_ROOT=root)
+    feed_cache.enable()
+    test.addCleanup(feed_cache.disable)
+    return root
+
+
+def make_image(size=(30, 20), format='JPEG', color=(200, 40, 40)):
+    buf = StringIO()
+    Image.new('RGB', size, color).save(buf, format)
+    return buf.getvalue()
+
+
+class GalleryIngestTest(TestCase):
+    """
+    Ingests zip files into a throwaway local storage instead of S3
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=os.path.join(self.temp_dir, 'media'))
+        patcher = mock.patch.object(Photo._meta.get_field('image'), 'storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def make_zip(self, members, compression=zipfile.ZIP_DEFLATED):
+        path = os.path.join(self.temp_dir, 'upload.zip')
+        with zipfile.ZipFile(path, 'w', compression) as zf:
+            for name, data in members:
+                zf.writestr(name, data)
+        return path
+
+    def stored_files(self):
+        found = []
+        for root, dirs, files in os.walk(self.storage.location):
+            found.extend(files)
+        return found
+
+    @override_settings(GALLERY_DECODE_PROCESSES=1)
+    def test_photos_are_titled_in_filename_order(self):
+        path = self.make_zip([('b.jpg', make_image((20, 30))), ('a.png', make_image(format='PNG')),
+                              ('__MACOSX/a.png', 'meta'), ('empty/', '')])
+        gallery = ingest_zipfile(path, 'Trip')
+        photos = list(gallery.photos.order_by('title'))
+        self.assertEqual([(p.title, p.width, p.height) for p in photos],
+                         [('Trip 01', 30, 20), ('Trip 02', 20, 30)])
+        self.assertTrue(photos[0].image.name.endswith('a.png'))
+        self.assertEqual(len(self.stored_files()), 2)
+
+    @override_settings(GALLERY_DECODE_PROCESSES=0)
+    def test_tiny_images_are_ingested(self):
+        members = [('a.jpg', make_image((4, 3))), ('b.jpg', make_image((30, 2)))]
+        gallery = ingest_zipfile(self.make_zip(members), 'Trip')
+        self.assertEqual([(photo.width, photo.height) for photo in gallery.photos.order_by('title')],
+                         [(4, 3), (30, 2)])
+
+    @override_settings(GALLERY_DECODE_PROCESSES=0)
+    def test_invalid_member_aborts_without_orphaned_files(self):
+        path = self.make_zip([('a.jpg', make_image()), ('b.jpg', make_image()[:200])])
+        self.assertRaises(ValidationError, ingest_zipfile, path, 'Trip')
+        self.assertFalse(Photo.objects.exists())
+        self.assertFalse(Gallery.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    @override_settings(GALLERY_DECODE_PROCESSES=0, GALLERY_UPLOAD_SPOOL_SIZE=100)
+    def test_corrupt_member_is_caught_while_streaming(self):
+        image = make_image()
+        path = self.make_zip([('a.jpg', image)], compression=zipfile.ZIP_STORED)
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = data.index(image) + len(image) - 10
+        with open(path, 'wb') as f:
+            f.write(data[:offset] + chr(ord(data[offset]) ^ 0xff) + data[offset + 1:])
+        try:
+            ingest_zipfile(path, 'Trip')
+        except ValidationError, e:
+            self.assertIn('corrupt', e.messages[0])
+        else:
+            self.fail('Corrupt member was ingested')
+        self.assertEqual(self.stored_files(), [])
+
+    @override_settings(GALLERY_DECODE_PROCESSES=0)
+    def test_member_that_cant_be_decompressed_fails_without_retrying(self):
+        path = self.make_zip([('a.jpg', make_image())])
+        with zipfile.ZipFile(path) as zf:
+            info = zf.getinfo('a.jpg')
+        offset = info.header_offset + 30 + len(info.filename) + len(info.extra)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # A deflate block of the reserved type
+        with open(path, 'wb') as f:
+            f.write(data[:offset] + chr(7) + data[offset + 1:])
+        try:
+            ingest_zipfile(path, 'Trip')
+        except ValidationError, e:
+            self.assertIn('corrupt', e.messages[0])
+        else:
+            self.fail('Corrupt member was ingested')
+
+        with mock.patch('blog_wind.ingest._upload_member', side_effect=zlib.error('invalid block type')) as upload:
+            self.assertRaises(zlib.error, upload_member, path, 'a.jpg', self.storage)
+        self.assertEqual(upload.call_count, 1)
+
+    @override_settings(GALLERY_DECODE_PROCESSES=0)
+    def test_photos_are_written_with_a_fixed_number_of_queries(self):
+        members = [('{0}.jpg'.format(i), make_image(color=(i * 50, 0, 0))) for i in range(5)]
+        Photo.objects.create(title='Trip 03', image='existing.jpg')
+        # titles lookup, digests lookup, gallery and its posts, photos, photo ids,
+        # gallery photos, landscape photos, cover, gallery modified, posts showing it
+        with self.assertNumQueries(11):
+            gallery = ingest_zipfile(self.make_zip(members), 'Trip')
+        self.assertEqual(list(gallery.photos.values_list('title', flat=True)),
+                         ['Trip 01', 'Trip 02', 'Trip 04', 'Trip 05'])
+        self.assertTrue(all(photo.created and photo.width == 30 for photo in gallery.photos.all()))
+
+    @override_settings(GALLERY_DECODE_PROCESSES=0)
+    def test_images_with_the_same_name_are_stored_apart_on_s3(self):
+        bucket = FakeBucket()
+        image_field = Photo._meta.get_field('image')
+        with mock.patch.object(image_field, 'storage', fake_s3_storage(bucket, MediaToS3Storage)):
+            old = Photo.objects.create(title='Old', image=image_field.generate_filename(None, 'x.jpg'))
+            gallery = ingest_zipfile(self.make_zip([('a/x.jpg', make_image()),
+                                                    ('b/x.jpg', make_image(color=(0, 0, 0)))]), 'Trip')
+        names = [photo.image.name for photo in gallery.photos.order_by('title')]
+        self.assertEqual(sorted(names), sorted(bucket.keys))
+        self.assertEqual(len(set(names + [old.image.name])), 3)
+        self.assertTrue(all(name.endswith('.jpg') for name in names))
+        self.assertFalse(gallery.photos.filter(pk=old.pk).exists())
+
+    @override_settings(GALLERY_DECODE_PROCESSES=0)
+    def test_duplicate_images_reuse_existing_photos(self):
+        first = ingest_zipfile(self.make_zip([('a.jpg', make_image()),
+                                              ('b.jpg', make_image(color=(0, 0, 0)))]), 'First')
+        second = ingest_zipfile(self.make_zip([('c.jpg', make_image()), ('d.jpg', make_image()),
+                                               ('e.jpg', make_image(color=(0, 0, 90)))]), 'Second')
+        self.assertEqual(Photo.objects.count(), 3)
+        self.assertEqual(len(self.stored_files()), 3)
+        self.assertEqual(list(second.photos.values_list('title', flat=True)), ['First 01', 'Second 03'])
+        self.assertEqual(first.photos.get(title='First 01').galleries.count(), 2)
+
+    @override_settings(GALLERY_DECODE_PROCESSES=0)
+    def test_backfill_photo_digests_reports_duplicates(self):
+        ingest_zipfile(self.make_zip([('a.jpg', make_image())]), 'First')
+        image = Photo.objects.get().image.name
+        Photo.objects.update(digest='')
+        Photo.objects.create(title='Copy', image=image)
+
+        out = StringIO()
+        call_command('backfill_photo_digests', stdout=out)
+        self.assertIn('Recorded digests for 2 photos', out.getvalue())
+        self.assertIn('2 copies of', out.getvalue())
+        self.assertEqual(Photo.objects.exclude(digest='').count(), 2)
+
+
+@override_settings(GALLERY_DECODE_PROCESSES=0, THUMBNAIL_WARM_THREADS=1)
+class GalleryUploadQueueTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        for obj, attr, location in ((Photo._meta.get_field('image'), 'storage', 'media'),
+                                    (GalleryUpload._meta.get_field('zip_file'), 'storage', 'uploads'),
+                                    (thumbnail_default, 'storage', 'thumbnails')):
+            patcher = mock.patch.object(obj, attr, FileSystemStorage(location=os.path.join(self.temp_dir, location)))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def queue(self, members):
+        buf = StringIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            for name, data in members:
+                zf.writestr(name, data)
+        upload = GalleryUpload(title='Trip')
+        upload.zip_file.save('trip.zip', ContentFile(buf.getvalue()))
+        return upload
+
+    def test_saving_only_queues_the_upload(self):
+        upload = self.queue([('a.jpg', make_image()), ('b.jpg', make_image(color=(0, 0, 0)))])
+        self.assertEqual(upload.status, GalleryUpload.PENDING)
+        self.assertFalse(Photo.objects.exists())
+
+        claimed = GalleryUpload.objects.claim_next()
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (upload.pk, GalleryUpload.RUNNING, 1))
+        self.assertEqual(GalleryUpload.objects.claim_next(), None)
+
+        claimed.run()
+        upload = GalleryUpload.objects.get(pk=upload.pk)
+        self.assertEqual((upload.status, upload.photos_done, upload.photos_total), (GalleryUpload.DONE, 2, 2))
+        self.assertEqual(upload.gallery.photos.count(), 2)
+        self.assertFalse(os.path.exists(upload.zip_file.path))
+
+        # Both photos are landscape, so need gallery and cover thumbnails
+        for photo in upload.gallery.photos.all():
+            for geometry, landscape_only in THUMBNAIL_GEOMETRIES:
+                self.assertTrue(thumbnail_default.backend.get_cached_thumbnail(photo.image, geometry))
+
+    def test_invalid_uploads_fail_without_retrying(self):
+        self.queue([('a.jpg', 'not an image')])
+        upload = GalleryUpload.objects.claim_next()
+        self.assertRaises(ValidationError, upload.run)
+        upload = GalleryUpload.objects.get(pk=upload.pk)
+        self.assertEqual(upload.status, GalleryUpload.FAILED)
+        self.assertIn('Image failed to validate', upload.error)
+
+    def test_stalled_uploads_are_claimed_again(self):
+        upload = self.queue([('a.jpg', make_image())])
+        GalleryUpload.objects.claim_next().record_progress(0, 1)
+        self.assertEqual(GalleryUpload.objects.claim_next(), None)
+
+        # The worker was killed, and nothing has happened for a while since
+        long_ago = datetime.datetime.now() - datetime.timedelta(minutes=30)
+        GalleryUpload.objects.filter(pk=upload.pk).update(heartbeat=long_ago)
+        claimed = GalleryUpload.objects.claim_next()
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (upload.pk, GalleryUpload.RUNNING, 2))
+        self.assertTrue(claimed.heartbeat > long_ago)
+
+        GalleryUpload.objects.filter(pk=upload.pk).update(heartbeat=long_ago)
+        self.assertEqual(GalleryUpload.objects.claim_next(max_attempts=2), None)
+        self.assertEqual(GalleryUpload.objects.get(pk=upload.pk).status, GalleryUpload.FAILED)
+
+    def test_worker_that_lost_its_claim_leaves_the_outcome_to_the_new_one(self):
+        upload = self.queue([('a.jpg', make_image())])
+        first = GalleryUpload.objects.claim_next()
+        long_ago = datetime.datetime.now() - datetime.timedelta(minutes=30)
+        GalleryUpload.objects.filter(pk=upload.pk).update(heartbeat=long_ago)
+        second = GalleryUpload.objects.claim_next()
+
+        first.run()
+        upload = GalleryUpload.objects.get(pk=upload.pk)
+        self.assertEqual((upload.status, upload.attempts), (GalleryUpload.RUNNING, 2))
+        self.assertTrue(os.path.exists(upload.zip_file.path))
+
+        second.run()
+        self.assertEqual(GalleryUpload.objects.get(pk=upload.pk).status, GalleryUpload.DONE)
+
+    def test_heartbeat_is_kept_up_while_decoding_and_warming_thumbnails(self):
+        # The same image twice, so one is done as soon as it's decoded
+        self.queue([('a.jpg', make_image()), ('b.jpg', make_image())])
+        upload = GalleryUpload.objects.claim_next()
+        with mock.patch.object(GalleryUpload, 'record_progress', autospec=True) as record_progress:
+            with mock.patch.object(GalleryUpload, 'record_heartbeat', autospec=True) as record_heartbeat:
+                upload.run()
+        self.assertEqual([call[0][1:] for call in record_progress.call_args_list], [(0, 2), (1, 2), (2, 2)])
+        # Once the gallery is recorded, then for each of its photo's two thumbnails
+        self.assertEqual(record_heartbeat.call_count, 3)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_retries_failed_and_stalled_uploads(self):
+        failed, stalled, running = [self.queue([('a.jpg', make_image())]) for i in range(3)]
+        long_ago = datetime.datetime.now() - datetime.timedelta(minutes=30)
+        GalleryUpload.objects.filter(pk=failed.pk).update(status=GalleryUpload.FAILED, attempts=3)
+        GalleryUpload.objects.filter(pk=stalled.pk).update(status=GalleryUpload.RUNNING, attempts=1,
+                                                           heartbeat=long_ago)
+        GalleryUpload.objects.filter(pk=running.pk).update(status=GalleryUpload.RUNNING, attempts=1,
+                                                           heartbeat=datetime.datetime.now())
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        self.client.post('/admin/blog_wind/galleryupload/', {
+            'action': 'retry', '_selected_action': [failed.pk, stalled.pk, running.pk]})
+        self.assertEqual(dict(GalleryUpload.objects.values_list('pk', 'status')), {
+            failed.pk: GalleryUpload.PENDING, stalled.pk: GalleryUpload.PENDING, running.pk: GalleryUpload.RUNNING})
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_reports_progress(self):
+        upload = self.queue([('a.jpg', make_image())])
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        response = self.client.get('/admin/blog_wind/galleryupload/{0}/'.format(upload.pk))
+        self.assertContains(response, 'id="upload-status"')
+        response = self.client.get('/admin/blog_wind/galleryupload/{0}/status/'.format(upload.pk))
+        self.assertEqual(json.loads(response.content)['status'], GalleryUpload.PENDING)
+
+
+class ThumbnailTest(TestCase):
+    def test_templates_only_use_registered_geometries(self):
+        registered = set(geometry for geometry, landscape_only in THUMBNAIL_GEOMETRIES)
+        registered.update('"{0}" "{1}"'.format(source, geometry) for source, geometry, options in SOURCE_THUMBNAILS)
+        used = set()
+        template_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates')
+        for name in os.listdir(template_dir):
+            if name.endswith('.html'):
+                with open(os.path.join(template_dir, name)) as f:
+                    template = f.read()
+                used.update(re.findall(r'{% thumbnail photo\.image "([^"]+)"', template))
+                used.update(re.findall(r'{% thumbnail ("[^"]+" "[^"]+")', template))
+        self.assertEqual(used, registered)
+
+    def test_missing_thumbnails_fall_back_to_the_original(self):
+        photo = Photo(title='Wide', image='galleries/photos/wide.jpg', width=1000, height=500)
+        thumbnail = thumbnail_default.backend.get_thumbnail(photo.image, '348x232')
+        self.assertEqual(thumbnail.name, 'galleries/photos/wide.jpg')
+        self.assertEqual(thumbnail.size, [348, 174])
+
+
+@override_settings(GALLERY_COVER_MODE='cover')
+class GalleryCoverTest(TestCase):
+    def setUp(self):
+        self.gallery = Gallery.objects.create(title='Trip')
+        self.tall = Photo.objects.create(title='Trip 01', image='tall.jpg', width=20, height=30)
+        self.wide = Photo.objects.create(title='Trip 02', image='wide.jpg', width=30, height=20)
+        self.wider = Photo.objects.create(title='Trip 03', image='wider.jpg', width=60, height=20)
+
+    def test_covers_follow_gallery_photos(self):
+        self.gallery.photos.add(self.tall, self.wide, self.wider)
+        gallery = Gallery.objects.get(pk=self.gallery.pk)
+        self.assertEqual(gallery.get_landscape_photo_ids(), [self.wide.pk, self.wider.pk])
+        self.assertEqual(gallery.cover_id, self.wide.pk)
+
+        with mock.patch.object(Photo._meta.get_field('image'), 'storage', fake_s3_storage(FakeBucket())):
+            Photo.objects.delete_with_files([self.wide])
+        gallery = Gallery.objects.get(pk=self.gallery.pk)
+        self.assertEqual((gallery.get_landscape_photo_ids(), gallery.cover_id), ([self.wider.pk], self.wider.pk))
+
+        self.wider.width = 10
+        self.wider.save()
+        gallery = Gallery.objects.get(pk=self.gallery.pk)
+        # Covers are kept as long as they're in the gallery, since they can be chosen
+        self.assertEqual((gallery.get_landscape_photo_ids(), gallery.cover_id), ([], self.wider.pk))
+
+    def test_clearing_a_photos_galleries_refreshes_them(self):
+        self.gallery.photos.add(self.wide)
+        other = Gallery.objects.create(title='Other')
+        other.photos.add(self.wide, self.wider)
+        self.wide.galleries.clear()
+        self.assertEqual(Gallery.objects.get(pk=self.gallery.pk).cover_id, None)
+        other = Gallery.objects.get(pk=other.pk)
+        self.assertEqual((other.get_landscape_photo_ids(), other.cover_id), ([self.wider.pk], self.wider.pk))
+
+    def test_covers_for_all_galleries_take_one_query(self):
+        self.gallery.photos.add(self.tall, self.wide)
+        other = Gallery.objects.create(title='Other')
+        other.photos.add(self.wider)
+        empty = Gallery.objects.create(title='Empty')
+        galleries = list(Gallery.objects.all())
+        with self.assertNumQueries(1):
+            Gallery.objects.attach_covers(galleries)
+        self.assertEqual(dict((gallery.pk, gallery.cover_photo) for gallery in galleries),
+                         {self.gallery.pk: self.wide, other.pk: self.wider, empty.pk: None})
+
+    def test_random_mode_picks_a_landscape_photo(self):
+        self.gallery.photos.add(self.tall, self.wide, self.wider)
+        gallery = Gallery.objects.get(pk=self.gallery.pk)
+        for i in range(10):
+            Gallery.objects.attach_covers([gallery], mode='random')
+            self.assertIn(gallery.cover_photo, [self.wide, self.wider])
+
+    def test_random_image_filter_takes_galleries_and_querysets(self):
+        self.gallery.photos.add(self.tall, self.wide, self.wider)
+        for photos in (self.gallery, self.gallery.photos, self.gallery.photos.all()):
+            self.assertIn(random_image(photos), [self.wide, self.wider])
+        self.assertEqual(random_image(self.gallery.photos.filter(pk=self.tall.pk)), None)
+
+
+class DeleteGalleryTest(TestCase):
+    def setUp(self):
+        self.bucket = FakeBucket(['a.jpg', 'b.jpg', 'shared.jpg', 'cache/a-748.jpg'])
+        patcher = mock.patch.object(Photo._meta.get_field('image'), 'storage', fake_s3_storage(self.bucket))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.gallery = Gallery.objects.create(title='Trip')
+        self.other = Gallery.objects.create(title='Other')
+        self.a, self.b, self.shared = [Photo.objects.create(title=name, image=name, width=30, height=20)
+                                       for name in ('a.jpg', 'b.jpg', 'shared.jpg')]
+        self.gallery.photos.add(self.a, self.b, self.shared)
+        self.other.photos.add(self.shared)
+
+    def test_orphaned_photos_are_deleted_in_one_batch(self):
+        with mock.patch('blog_wind.models.pop_thumbnails', lambda image: ['cache/a-748.jpg'] if image.name == 'a.jpg' else []):
+            self.gallery.delete()
+        self.assertEqual(list(Photo.objects.all()), [self.shared])
+        self.assertEqual(self.bucket.requests, [('delete_keys', ['a.jpg', 'cache/a-748.jpg', 'b.jpg'])])
+        self.assertEqual(self.bucket.keys, set(['shared.jpg']))
+        self.assertEqual(Gallery.objects.get(pk=self.other.pk).cover_id, self.shared.pk)
+
+    def test_orphans_are_found_without_a_query_per_photo(self):
+        for i in range(10):
+            self.gallery.photos.add(Photo.objects.create(title=str(i), image='{0}.jpg'.format(i)))
+        # The key value store is looked up per image, so leave it out of the count
+        with mock.patch('blog_wind.models.pop_thumbnails', lambda image: []):
+            with self.assertNumQueries(12):
+                self.gallery.delete()
+        self.assertEqual(len(self.bucket.requests), 1)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_deletes_after_confirmation(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        with mock.patch('blog_wind.models.pop_thumbnails', lambda image: []):
+            for path, pk in (('/admin/blog_wind/photo/', self.b.pk), ('/admin/blog_wind/gallery/', self.gallery.pk)):
+                data = {'action': 'delete_selected', '_selected_action': [pk]}
+                photos = Photo.objects.count()
+                self.assertContains(self.client.post(path, data), 'Are you sure?')
+                self.assertEqual(Photo.objects.count(), photos)
+                data['post'] = 'yes'
+                self.assertEqual(self.client.post(path, data).status_code, 302)
+        self.assertEqual(list(Photo.objects.all()), [self.shared])
+        self.assertEqual(self.bucket.keys, set(['shared.jpg', 'cache/a-748.jpg']))
+        self.assertEqual(list(Gallery.objects.all()), [self.other])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'query-budget-tests'}})
+class ViewQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """
+    The number of queries a page makes mustn't grow with the number of posts,
+    galleries or photos on it
+    """
+    def setUp(self):
+        publish_at = datetime.datetime.now() - datetime.timedelta(days=1)
+        for i in range(6):
+            gallery = Gallery.objects.create(title='Trip {0}'.format(i))
+            for j in range(3):
+                gallery.photos.add(Photo.objects.create(title='Trip {0} {1:02}'.format(i, j),
+                                                        image='{0}-{1}.jpg'.format(i, j), width=30, height=20))
+            Post.objects.create(title='Trip {0}'.format(i), slug='trip-{0}'.format(i), body='<p>Photos</p>',
+                                publish_at=publish_at, gallery=gallery)
+        Post.objects.create(title='Essay', slug='essay', body='<p>Words</p>', publish_at=publish_at)
+        get_page_cache().clear()
+        # Looked up once until the next post is due, not per request
+        Post.objects.get_posted()
+
+    def test_home(self):
+        with self.assertMaxQueries(3):  # validators, posts with galleries, photos
+            response = self.client.get('/')
+        self.assertContains(response, 'class="gallery-img', count=12)
+
+    @override_settings(HOME_PAGINATION='offset')
+    def test_numbered_home(self):
+        with self.assertMaxQueries(4):  # validators, count, posts with galleries, photos
+            response = self.client.get('/page/2')
+        self.assertContains(response, 'class="gallery-img', count=6)
+
+    def test_post(self):
+        with self.assertMaxQueries(3):  # validators, post with gallery, photos
+            response = self.client.get('/trip-0')
+        self.assertContains(response, 'class="gallery-img', count=3)
+
+    def test_preview(self):
+        with self.assertMaxQueries(2):
+            response = self.client.get('/preview/trip-0')
+        self.assertContains(response, 'class="gallery-img', count=3)
+
+    def test_galleries(self):
+        with self.assertMaxQueries(3):  # validators, posts with galleries, covers
+            response = self.client.get('/photos')
+        self.assertContains(response, 'class="gallery-preview-img', count=6)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+                   HOME_PAGINATION='keyset')
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        # Pairs of posts share a publish_at, so ties have to be broken by id
+        for i in range(12):
+            Post.objects.create(title='Post {0}'.format(i), slug='post-{0}'.format(i), body='<p>Hi</p>',
+                                publish_at=now - datetime.timedelta(days=12 - i // 2))
+        self.newest_first = list(Post.objects.order_by('-publish_at', '-pk').values_list('slug', flat=True))
+
+    def test_walking_older_then_newer_sees_every_post_once(self):
+        posts = Post.objects.get_posted()
+        pages = [keyset_page(posts, 5)]
+        while pages[-1].has_older:
+            pages.append(keyset_page(posts, 5, older_than=pages[-1].older_cursor))
+        self.assertEqual([post.slug for page in pages for post in page], self.newest_first)
+        self.assertEqual([len(page) for page in pages], [5, 5, 2])
+        self.assertFalse(pages[0].has_newer)
+
+        newer = keyset_page(posts, 5, newer_than=pages[-1].newer_cursor)
+        self.assertEqual([post.slug for post in newer], [post.slug for post in pages[1]])
+        newer = keyset_page(posts, 5, newer_than=newer.newer_cursor)
+        self.assertEqual([post.slug for post in newer], [post.slug for post in pages[0]])
+        self.assertFalse(newer.has_newer)
+
+    def test_pages_link_to_each_other(self):
+        response = self.client.get('/')
+        older_url = response.context['older_url']
+        self.assertEqual(response.context['newer_url'], None)
+        response = self.client.get(older_url)
+        self.assertEqual([post.slug for post in response.context['posts']], self.newest_first[5:10])
+        response = self.client.get(response.context['newer_url'])
+        self.assertEqual([post.slug for post in response.context['posts']], self.newest_first[:5])
+
+    def test_numbered_pages_redirect_to_the_same_posts(self):
+        response = self.client.get('/page/3')
+        self.assertEqual(response.status_code, 301)
+        response = self.client.get(response['Location'])
+        self.assertEqual([post.slug for post in response.context['posts']], self.newest_first[10:])
+        self.assertEqual(self.client.get('/page/1').status_code, 301)
+        self.assertEqual(self.client.get('/page/9').status_code, 404)
+        self.assertEqual(self.client.get('/older/99999999999999999999-1').status_code, 404)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'page-cache-tests'}})
+class PageCacheTest(TestCase):
+    def setUp(self):
+        get_page_cache().clear()
+        publish_at = datetime.datetime.now() - datetime.timedelta(days=1)
+        self.gallery = Gallery.objects.create(title='Trip')
+        self.post = Post.objects.create(title='Trip', slug='trip', body='<p>Photos</p>',
+                                        publish_at=publish_at, gallery=self.gallery)
+        self.essay = Post.objects.create(title='Essay', slug='essay', body='<p>Words</p>', publish_at=publish_at)
+
+    def assertCached(self, path):
+        self.client.get(path)
+        with self.assertNumQueries(0):
+            return self.client.get(path)
+
+    def test_saving_a_post_invalidates_its_page_and_the_listings(self):
+        self.assertCached('/')
+        self.assertCached('/essay')
+        self.assertCached('/trip')
+        self.essay.title = 'Revised essay'
+        self.essay.save()
+        self.assertContains(self.client.get('/'), 'Revised essay')
+        self.assertContains(self.client.get('/essay'), 'Revised essay')
+        with self.assertNumQueries(0):
+            self.client.get('/trip')
+
+    def test_deactivating_a_post_removes_its_page(self):
+        self.assertCached('/essay')
+        self.essay.active = False
+        self.essay.save()
+        self.assertEqual(self.client.get('/essay').status_code, 404)
+        self.assertNotContains(self.client.get('/writing'), 'Essay')
+
+    def test_changing_a_gallery_invalidates_the_pages_showing_it(self):
+        self.assertCached('/trip')
+        self.assertCached('/essay')
+        self.gallery.photos.add(Photo.objects.create(title='Trip 01', image='trip.jpg', width=30, height=20))
+        self.assertContains(self.client.get('/trip'), 'alt="Trip 01"')
+        with self.assertNumQueries(0):
+            self.client.get('/essay')
+
+    def test_pages_are_gzipped_once_and_served_to_clients_that_accept_it(self):
+        self.essay.body = '<pre class="python">' + 'print "hello"\n' * 100 + '</pre>'
+        self.essay.save()
+        identity = self.client.get('/essay')
+        self.assertFalse(identity.has_header('Content-Encoding'))
+        with mock.patch('blog_wind.middleware.compress') as compress:
+            with self.assertNumQueries(0):
+                gzipped = self.client.get('/essay', HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertFalse(compress.called)
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertEqual(gzipped['Content-Length'], str(len(gzipped.content)))
+        self.assertIn('Accept-Encoding', gzipped['Vary'])
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(gzipped.content)).read(), identity.content)
+        self.assertTrue(len(gzipped.content) * 5 < len(identity.content))
+        self.assertEqual(gzipped['ETag'], 'W/' + identity['ETag'])
+        self.assertEqual(self.client.get('/essay', HTTP_IF_NONE_MATCH=gzipped['ETag'],
+                                         HTTP_ACCEPT_ENCODING='gzip').status_code, 304)
+        self.assertFalse(self.client.get('/essay').has_header('Content-Encoding'))
+
+    def test_browsers_only_keep_pages_briefly(self):
+        response = self.client.get('/')
+        self.assertEqual(response['Cache-Control'], 'max-age=300')
+
+    def test_command_invalidates_every_page(self):
+        self.assertCached('/essay')
+        # Queryset updates don't send signals, so the cached page is stale
+        Post.objects.filter(pk=self.essay.pk).update(title='Quietly revised')
+        self.assertNotContains(self.client.get('/essay'), 'Quietly revised')
+        call_command('invalidate_page_cache', stdout=StringIO())
+        self.assertContains(self.client.get('/essay'), 'Quietly revised')
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'scheduled-post-tests'}})
+class ScheduledPostTest(TestCase):
+    def setUp(self):
+        get_page_cache().clear()
+        self.now = datetime.datetime.now()
+        Post.objects.create(title='Old news', slug='old-news', body='<p>Hi</p>',
+                            publish_at=self.now - datetime.timedelta(days=1))
+        Post.objects.create(title='Coming soon', slug='coming-soon', body='<p>Hi</p>',
+                            publish_at=self.now + datetime.timedelta(hours=1))
+
+    def later(self, **delta):
+        """
+        Moves the clock the posted cutoff is checked against forward by delta
+        """
+        now = self.now + datetime.timedelta(**delta)
+
+        class Later(datetime.datetime):
+            @classmethod
+            def now(cls):
+                return now
+        return mock.patch('blog_wind.cache.datetime', mock.Mock(datetime=Later))
+
+    def test_posted_is_worked_out_once_until_the_next_post_is_due(self):
+        self.assertEqual([post.slug for post in Post.objects.get_posted()], ['old-news'])
+        with self.assertNumQueries(0):
+            Post.objects.get_posted()
+        with self.later(minutes=59):
+            with self.assertNumQueries(0):
+                Post.objects.get_posted()
+        with self.later(hours=1, seconds=1):
+            self.assertEqual([post.slug for post in Post.objects.get_posted()], ['coming-soon', 'old-news'])
+
+    def test_scheduled_posts_go_live_on_cached_pages(self):
+        self.assertNotContains(self.client.get('/'), 'Coming soon')
+        with self.assertNumQueries(0):
+            self.assertNotContains(self.client.get('/'), 'Coming soon')
+        with self.later(hours=1, seconds=1):
+            self.assertContains(self.client.get('/'), 'Coming soon')
+
+    def test_scheduling_a_post_resets_the_cutoff(self):
+        Post.objects.get_posted()
+        Post.objects.create(title='Sooner', slug='sooner', body='<p>Hi</p>',
+                            publish_at=self.now + datetime.timedelta(minutes=30))
+        with self.later(minutes=31):
+            self.assertEqual([post.slug for post in Post.objects.get_posted()], ['sooner', 'old-news'])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+                   HOME_PAGINATION='keyset')
+class RenderStaticTest(TestCase):
+    def setUp(self):
+        use_temp_feed_cache(self)
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+        publish_at = datetime.datetime.now() - datetime.timedelta(days=30)
+        self.posts = [Post.objects.create(title='Post {0}'.format(i), slug='post-{0}'.format(i), body='<p>Hi</p>',
+                                          publish_at=publish_at + datetime.timedelta(days=i))
+                      for i in range(7)]
+
+    def render(self, **options):
+        out = StringIO()
+        call_command('render_static', output=self.output, threads=1, stdout=out, **options)
+        return out.getvalue()
+
+    def read(self, name):
+        with open(os.path.join(self.output, name)) as f:
+            return f.read()
+
+    def test_renders_every_public_page(self):
+        self.assertEqual(self.render(), 'Rendered 15 of 15 pages, removed 0\n')
+        self.assertIn('Post 6', self.read('index.html'))
+        self.assertIn('Post 3', self.read('post-3.html'))
+        self.assertIn('<rss', self.read('feeds/recent.xml'))
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'about.html')))
+        older = re.search(r'href="/(older/[^"]+)"', self.read('index.html')).group(1)
+        self.assertIn('Post 0', self.read(older + '.html'))
+        newer = re.search(r'href="/(newer/[^"]+)"', self.read(older + '.html')).group(1)
+        self.assertEqual(self.read(newer + '.html'), self.read('index.html'))
+
+    def test_only_pages_showing_changed_posts_are_rendered_again(self):
+        self.render()
+        self.assertEqual(self.render(), 'Rendered 0 of 15 pages, removed 0\n')
+
+        self.posts[0].title = 'Revised'
+        self.posts[0].save()
+        # its page, the older home page, writing and the feed
+        self.assertEqual(self.render(), 'Rendered 4 of 15 pages, removed 0\n')
+        self.assertIn('Revised', self.read('post-0.html'))
+
+        self.posts[0].delete()
+        self.render()
+        self.assertFalse(os.path.exists(os.path.join(self.output, 'post-0.html')))
+        self.assertEqual(self.render(all=True), 'Rendered 14 of 14 pages, removed 0\n')
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'conditional-get-tests'}})
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        use_temp_feed_cache(self)
+        get_page_cache().clear()
+        publish_at = datetime.datetime.now() - datetime.timedelta(days=1)
+        self.gallery = Gallery.objects.create(title='Trip')
+        self.post = Post.objects.create(title='Trip', slug='trip', body='<p>Photos</p>',
+                                        publish_at=publish_at, gallery=self.gallery)
+        Post.objects.create(title='Essay', slug='essay', body='<p>Words</p>', publish_at=publish_at)
+        Post.objects.get_posted()
+
+    def revalidate(self, path, response):
+        return self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_matching_requests_get_a_304_without_rendering(self):
+        for path in ('/', '/trip', '/writing', '/photos', '/feeds/recent'):
+            response = self.client.get(path)
+            self.assertTrue(response.has_header('Last-Modified'))
+            # Skip the page cache, so the view answers
+            with mock.patch('blog_wind.middleware.get_cache_key', return_value=None):
+                with mock.patch('django.template.loader.render_to_string') as render:
+                    with self.assertNumQueries(1):
+                        revalidated = self.revalidate(path, response)
+            self.assertEqual(revalidated.status_code, 304, path)
+            self.assertFalse(render.called)
+
+    def test_cached_pages_get_a_304_without_queries(self):
+        response = self.client.get('/')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.revalidate('/', response).status_code, 304)
+
+    def test_changes_change_the_etag(self):
+        response = self.client.get('/trip')
+        self.gallery.photos.add(Photo.objects.create(title='Trip 01', image='trip.jpg', width=30, height=20))
+        self.assertEqual(self.revalidate('/trip', response).status_code, 200)
+
+        response = self.client.get('/')
+        Post.objects.filter(slug='essay').delete()
+        self.assertEqual(self.revalidate('/', response).status_code, 200)
+
+    def test_deactivating_an_older_post_changes_last_modified(self):
+        response = self.client.get('/')
+        essay = Post.objects.get(slug='essay')
+        essay.active = False
+        # A second on, since Last-Modified only counts whole seconds
+        with mock.patch('blog_wind.cache.datetime') as later:
+            later.datetime.now.return_value = datetime.datetime.now() + datetime.timedelta(seconds=1)
+            essay.save()
+        revalidated = self.client.get('/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(revalidated.status_code, 200)
+        self.assertNotEqual(revalidated['Last-Modified'], response['Last-Modified'])
+
+    def test_pages_of_the_same_posts_have_different_etags(self):
+        self.assertNotEqual(self.client.get('/writing')['ETag'], self.client.get('/photos')['ETag'])
+        self.assertNotEqual(self.client.get('/')['ETag'], self.client.get('/feeds/recent')['ETag'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'feed-tests'}})
+class FeedTest(TestCase):
+    def setUp(self):
+        self.root = use_temp_feed_cache(self)
+        get_page_cache().clear()
+        now = datetime.datetime.now()
+        self.post = Post.objects.create(title='Code', slug='code', publish_at=now - datetime.timedelta(days=1),
+                                        body='<p>One two three four five</p><pre class="python">x = 1</pre>')
+        Post.objects.create(title='Scheduled', slug='scheduled', body='<p>Soon</p>',
+                            publish_at=now + datetime.timedelta(days=1))
+
+    def get(self, **headers):
+        # Skip the page cache, so the view answers
+        with mock.patch('blog_wind.middleware.get_cache_key', return_value=None):
+            return self.client.get('/feeds/recent', **headers)
+
+    def test_feed_is_served_gzipped_with_highlighted_posted_bodies(self):
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        content = gzip.GzipFile(fileobj=StringIO(response.content)).read()
+        self.assertEqual(content, self.get().content)
+        self.assertIn('class="highlight"', content)
+        self.assertNotIn('Scheduled', content)
+
+    def test_feed_is_only_rendered_once_per_change(self):
+        self.get()
+        with mock.patch.object(RecentFeed, '__call__') as render:
+            self.get()
+            get_page_cache().clear()
+            # From disk once the cache loses it
+            self.assertIn('Code', self.get().content)
+            self.assertFalse(render.called)
+        self.assertEqual(len(os.listdir(self.root)), 1)
+
+        self.post.title = 'Revised code'
+        self.post.save()
+        self.assertIn('Revised code', self.get().content)
+        self.assertEqual(len(os.listdir(self.root)), 1)
+
+    def test_gzipped_feed_has_a_weak_etag(self):
+        identity = self.get()
+        gzipped = self.get(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(gzipped['ETag'], 'W/' + identity['ETag'])
+        self.assertEqual(self.get(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzipped['ETag']).status_code, 304)
+
+    def test_documents_moved_or_removed_by_another_process_are_left_alone(self):
+        gone = os.path.join(self.root, 'recent-gone.xml.gz')
+        with mock.patch('blog_wind.feeds.glob.glob', return_value=[gone]):
+            self.assertEqual(self.get().status_code, 200)
+        get_page_cache().clear()
+        self.post.title = 'Revised code'
+        self.post.save()
+        # The directory exists already
+        self.assertIn('Revised code', self.get().content)
+        self.assertEqual([name for name in os.listdir(self.root) if not name.startswith('recent-')], [])
+
+    @override_settings(FEED_SUMMARY_ONLY=True, FEED_SUMMARY_WORDS=3)
+    def test_summary_only(self):
+        content = self.get().content
+        self.assertIn('One two three ...', content)
+        self.assertNotIn('four', content)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class SearchTest(TestCase):
+    def setUp(self):
+        now = datetime.datetime.now()
+        self.essay = Post.objects.create(title='Tuning Django', slug='tuning', publish_at=now,
+                                         body='<p>Caching pages in Django &amp; Python</p>'
+                                              '<pre class="python">import django</pre>')
+        self.aside = Post.objects.create(title='An aside', slug='aside', publish_at=now,
+                                         body='<p>More on <a class="article-link" href="/tuning">django</a></p>')
+        Post.objects.create(title='Django drafts', slug='drafts', body='<p>Django</p>', active=False)
+
+    def slugs(self, query):
+        return [post.slug for post in PostToken.objects.search(query, Post.objects.get_posted())]
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize(u'The Caf\xe9 & a <b>bold</b> x-ray'), [u'caf\xe9', u'bold', u'ray'])
+
+    def test_posts_are_indexed_without_markup(self):
+        tokens = set(self.essay.tokens.values_list('token', flat=True))
+        self.assertEqual(tokens, set(['tuning', 'django', 'caching', 'pages', 'python', 'import']))
+        self.assertFalse(self.aside.tokens.filter(token__in=['article', 'link', 'href']).exists())
+
+    def test_results_are_ranked_and_posted_only(self):
+        self.assertEqual(self.slugs('django'), ['tuning', 'aside'])
+        self.assertEqual(self.slugs('Django caching'), ['tuning'])
+        self.assertEqual(self.slugs('django nothing'), [])
+        self.assertEqual(self.slugs('the'), [])
+
+    def test_index_follows_edits(self):
+        self.aside.body = '<p>Nothing to see</p>'
+        self.aside.save()
+        self.assertEqual(self.slugs('django'), ['tuning'])
+        self.assertEqual(self.slugs('nothing'), ['aside'])
+
+    def test_search_page(self):
+        response = self.client.get('/search', {'q': 'django'})
+        self.assertContains(response, 'href="/tuning"')
+        self.assertNotContains(response, 'drafts')
+        self.assertContains(self.client.get('/search', {'q': 'missing'}), 'No posts found')
+
+    def test_admin_search_uses_index(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        response = self.client.get('/admin/blog_wind/post/', {'q': 'django'})
+        self.assertEqual(set(post.slug for post in response.context['cl'].result_list),
+                         set(['tuning', 'aside', 'drafts']))
+        response = self.client.get('/admin/blog_wind/post/', {'q': 'aside'})
+        self.assertEqual([post.slug for post in response.context['cl'].result_list], ['aside'])
+        response = self.client.get('/admin/blog_wind/post/', {'q': 'the'})
+        self.assertEqual(list(response.context['cl'].result_list), [])
+
+
+class StaticToS3StorageTest(TestCase):
+    def setUp(self):
+        self.bucket = FakeBucket()
+        self.storage = fake_s3_storage(self.bucket, gzip=True, multipart_threshold=100 * 1024,
+                                       multipart_chunk_size=32 * 1024, multipart_retries=3)
+        # Random enough not to compress to a single part
+        self.css = ''.join('.c{0} {{ color: #{1:06x}; }}\n'.format(i, (i * 7919) ** 3 % 0xffffff)
+                           for i in range(20000))
+
+    def save(self, name, content):
+        upload = ContentFile(content)
+        upload.content_type = 'text/css'
+        return self.storage.save(name, upload)
+
+    def decompress(self, name):
+        return gzip.GzipFile(fileobj=StringIO(self.bucket.contents[name])).read()
+
+    def test_small_files_are_gzipped_in_one_request(self):
+        self.save('css/small.css', 'body { color: red; }')
+        self.assertEqual([request[0] for request in self.bucket.requests], ['put'])
+        self.assertEqual(self.bucket.requests[-1][2]['Content-Encoding'], 'gzip')
+        self.assertEqual(self.decompress('css/small.css'), 'body { color: red; }')
+        # No timestamp in the gzip header, so the same file uploads the same bytes
+        first = self.bucket.contents['css/small.css']
+        self.save('css/small.css', 'body { color: red; }')
+        self.assertEqual(self.bucket.contents['css/small.css'], first)
+
+    def test_large_files_are_streamed_in_parts(self):
+        self.save('css/large.css', self.css)
+        requests = [request[0] for request in self.bucket.requests]
+        self.assertEqual(requests[0], 'initiate_multipart_upload')
+        self.assertGreater(requests.count('upload_part'), 1)
+        self.assertEqual(requests[-1], 'complete_upload')
+        self.assertEqual(self.bucket.requests[0][2]['Content-Type'], 'text/css')
+        self.assertEqual(self.decompress('css/large.css'), self.css)
+
+    def test_failed_parts_are_retried(self):
+        self.bucket.failing_parts = 2
+        self.save('css/large.css', self.css)
+        self.assertEqual(self.decompress('css/large.css'), self.css)
+
+        self.bucket.failing_parts = 3
+        self.assertRaises(socket.error, self.save, 'css/broken.css', self.css)
+        self.assertEqual(self.bucket.requests[-1], ('cancel_upload', 'css/broken.css'))
+        self.assertNotIn('css/broken.css', self.bucket.keys)
+
+
+class KeyManifestTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.manifest = os.path.join(self.root, 's3_keys.json')
+        self.bucket = FakeBucket()
+        self.bucket.contents['css/old.css'] = 'old'
+        self.bucket.keys.add('css/old.css')
+
+        self.static = os.path.join(self.root, 'static')
+        os.makedirs(os.path.join(self.static, 'css'))
+        for name in ('a', 'b', 'c'):
+            self.write('css/{0}.css'.format(name), '.{0} {{ color: red; }}'.format(name))
+
+    def storage(self):
+        return fake_s3_storage(self.bucket, ManifestStaticToS3Storage, key_manifest=self.manifest)
+
+    def write(self, name, content):
+        with open(os.path.join(self.static, name), 'w') as f:
+            f.write(content)
+
+    def collectstatic(self):
+        self.bucket.requests = []
+        finders._finders.clear()
+        with mock.patch('django.contrib.staticfiles.storage.staticfiles_storage', self.storage()):
+            with override_settings(STATICFILES_DIRS=(self.static,),
+                                   STATICFILES_FINDERS=('django.contrib.staticfiles.finders.FileSystemFinder',)):
+                call_command('collectstatic', interactive=False, verbosity=0)
+        finders._finders.clear()
+        return self.bucket.requests
+
+    def test_keys_are_listed_once_and_answered_locally(self):
+        storage = self.storage()
+        self.assertTrue(storage.exists('css/old.css'))
+        self.assertFalse(storage.exists('css/new.css'))
+        self.assertEqual(storage.modified_time('css/old.css'),
+                         datetime.datetime.fromtimestamp(1359633600))
+        self.assertEqual(self.bucket.requests, [('list',)])
+
+        storage = self.storage()
+        self.assertTrue(storage.exists('css/old.css'))
+        self.assertEqual(self.bucket.requests, [('list',)])
+
+    def test_only_changed_contents_are_uploaded(self):
+        storage = self.storage()
+        storage.save('css/a.css', ContentFile('.a {}'))
+        storage.save('css/a.css', ContentFile('.a {}'))
+        self.assertEqual([request[0] for request in self.bucket.requests], ['list', 'put'])
+        storage.save_keys()
+        self.storage().save('css/a.css', ContentFile('.a { color: red; }'))
+        self.assertEqual([request[0] for request in self.bucket.requests], ['list', 'put', 'put'])
+
+        storage.delete('css/a.css')
+        self.assertFalse(self.storage().exists('css/a.css'))
+
+    def test_refreshing_keeps_hashes_of_keys_that_didnt_change(self):
+        storage = self.storage()
+        storage.save('css/a.css', ContentFile('.a {}'))
+        storage.save('css/b.css', ContentFile('.b {}'))
+        # Changed on S3 by something else
+        self.bucket.contents['css/b.css'] = 'changed'
+        storage.refresh_keys()
+        self.assertTrue(storage.unchanged('css/a.css', ContentFile('.a {}')))
+        self.assertFalse(storage.unchanged('css/b.css', ContentFile('.b {}')))
+
+    def test_collectstatic_only_uploads_changed_files(self):
+        self.assertEqual(sorted(request[1] for request in self.collectstatic() if request[0] == 'put'),
+                         ['css/a.css', 'css/b.css', 'css/c.css'])
+        self.assertEqual(self.collectstatic(), [])
+
+        # Touched by a checkout, but the same
+        os.utime(os.path.join(self.static, 'css/a.css'), None)
+        self.write('css/b.css', '.b { color: blue; }')
+        self.assertEqual([request[:2] for request in self.collectstatic()], [('put', 'css/b.css')])
+
+    def test_collectstatic_writes_the_manifest_once(self):
+        write_keys = ManifestStaticToS3Storage._write_keys
+        with mock.patch.object(ManifestStaticToS3Storage, '_write_keys', autospec=True,
+                               side_effect=write_keys) as mock_write_keys:
+            self.collectstatic()
+        # Once after listing the bucket, and once at the end
+        self.assertEqual(mock_write_keys.call_count, 2)
+        self.assertEqual(sorted(self.storage().keys), ['css/a.css', 'css/b.css', 'css/c.css', 'css/old.css'])
+
+    def test_saves_from_threads_share_one_listing(self):
+        storage = self.storage()
+        pool = ThreadPool(4)
+        try:
+            pool.map(lambda i: storage.save('css/{0}.css'.format(i), ContentFile('.x{0} {{}}'.format(i))),
+                     range(20))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual([request for request in self.bucket.requests if request[0] == 'list'], [('list',)])
+        storage.save_keys()
+        self.assertEqual(len(self.storage().keys), 21)
+
+    def test_storage_needs_a_manifest(self):
+        with override_settings(AWS_S3_KEY_MANIFEST=None):
+            self.assertRaises(ImproperlyConfigured, fake_s3_storage, self.bucket, ManifestStaticToS3Storage)
+
+
+class S3UploaderTest(TestCase):
+    """
+    Uploads static bundles with the fabfile's S3Uploader over a fake connection
+    """
+    def setUp(self):
+        self.fabfile = import_fabfile()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.manifest = os.path.join(self.root, 's3_uploads.json')
+        self.bucket = FakeBucket(['existing.css'])
+
+        def get_bucket(name, **kwargs):
+            self.bucket.requests.append(('get_bucket', name))
+            # Slow enough for uploads on several threads to race to it
+            time.sleep(0.01)
+            return self.bucket
+        self.connection = mock.Mock()
+        self.connection.get_bucket.side_effect = get_bucket
+
+    def uploader(self):
+        return self.fabfile.S3Uploader('bucket', manifest_path=self.manifest, threads=4,
+                                       connection=self.connection)
+
+    def test_keys_in_the_manifest_are_skipped_without_connecting(self):
+        files = [('a.css', '.a {}', 'text/css'), ('a.js', 'var a;', 'application/javascript')]
+        self.assertEqual(sorted(self.uploader().upload_many(files)), ['a.css', 'a.js'])
+        self.bucket.requests = []
+        self.assertEqual(self.uploader().upload_many(files), [])
+        self.assertEqual(self.bucket.requests, [])
+
+    def test_keys_already_in_the_bucket_arent_uploaded(self):
+        files = [('existing.css', '.e {}', 'text/css'), ('b.css', '.b {}', 'text/css')]
+        self.assertEqual(self.uploader().upload_many(files), ['b.css'])
+        self.assertEqual([request[:2] for request in self.bucket.requests if request[0] == 'put'],
+                         [('put', 'b.css')])
+        with open(self.manifest) as f:
+            self.assertEqual(json.load(f), {'bucket': ['b.css', 'existing.css']})
+
+    def test_uploads_have_headers_of_their_own(self):
+        headers = dict(self.fabfile.HEADERS)
+        files = [('{0}.{1}'.format(i, extension), 'content', content_type) for i in range(10)
+                 for extension, content_type in (('css', 'text/css'), ('js', 'application/javascript'))]
+        self.uploader().upload_many(files)
+        content_types = dict((name, content_type) for name, content, content_type in files)
+        puts = [request for request in self.bucket.requests if request[0] == 'put']
+        self.assertEqual(len(puts), len(files))
+        for request, name, put_headers in puts:
+            self.assertEqual(put_headers['Content-Type'], content_types[name])
+        self.assertEqual(self.fabfile.HEADERS, headers)
+
+    def test_bucket_is_looked_up_once_before_uploading(self):
+        files = [('{0}.css'.format(i), '.a {}', 'text/css') for i in range(20)]
+        self.uploader().upload_many(files)
+        self.assertEqual(self.bucket.requests[0], ('get_bucket', 'bucket'))
+        self.assertEqual(self.connection.get_bucket.call_count, 1)
+
+
+def fake_lessc(args, stdout):
+    """
+    Stands in for lessc, copying the LESS file through as its CSS unless it's
+    named broken.less
+    """
+    filename = args[-1]
+    if os.path.basename(filename) == 'broken.less':
+        raise subprocess.CalledProcessError(1, args)
+    with open(filename) as f:
+        stdout.write(f.read())
+
+
+class StaticBuildTest(TestCase):
+    """
+    Builds bundles with the fabfile from a temporary base.html and static files
+    """
+    def setUp(self):
+        self.fabfile = import_fabfile()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for directory in ('templates', 'static/css', 'static/less'):
+            os.makedirs(os.path.join(self.root, directory))
+        self.write('static/less/site.less', '@import "colors";\n.site { margin: 0; }\n')
+        self.write('static/less/colors.less', '.colors { color: red; }\n')
+        self.write_base_html(['less/site.less'])
+
+        self.uploads = []
+        patcher = mock.patch.multiple(self.fabfile, LOCAL_PROJECT_ROOT=self.root,
+                                      TEMPLATE_DIRS=(os.path.join(self.root, 'templates'),),
+                                      STATIC_DIRS=(os.path.join(self.root, 'static'),),
+                                      BASE_HTML_FILENAME='base.html', STATIC_BUILD_MANIFEST=None,
+                                      STATIC_BUILD_PROCESSES=1, S3Uploader=mock.DEFAULT,
+                                      puts=mock.DEFAULT)
+        self.S3Uploader = patcher.start()['S3Uploader']
+        self.addCleanup(patcher.stop)
+        self.S3Uploader.return_value.upload_many.side_effect = self.upload_many
+        patcher = mock.patch.object(self.fabfile.subprocess, 'check_call', fake_lessc)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, path, content):
+        with open(os.path.join(self.root, path), 'w') as f:
+            f.write(content)
+
+    def write_base_html(self, hrefs, minified='css/old.min.css'):
+        links = ''.join('<link class="minify-css" href="{{{{ STATIC_URL }}}}{0}"/>'.format(href)
+                        for href in hrefs)
+        self.write('templates/base.html', '<head>{0}<link class="minified-css" '
+                   'href="{{{{ STATIC_URL }}}}{1}"/></head>'.format(links, minified))
+
+    def upload_many(self, files):
+        self.uploads.extend(files)
+        return [name for name, content, content_type in files]
+
+    def build(self, force=False):
+        self.uploads = []
+        self.fabfile._update_static(('css',), force)
+        return [name for name, content, content_type in self.uploads]
+
+    def linked_name(self):
+        with open(os.path.join(self.root, 'templates', 'base.html')) as f:
+            soup = BeautifulSoup(f.read(), 'html.parser')
+        return soup.select('.minified-css')[0]['href']
+
+    def test_unchanged_bundle_is_skipped(self):
+        name, = self.build()
+        self.assertEqual(self.linked_name(), '{{ STATIC_URL }}' + name)
+        with mock.patch.object(self.fabfile, '_read_source') as read_source:
+            self.assertEqual(self.build(), [])
+        self.assertFalse(read_source.called)
+        self.assertEqual(self.linked_name(), '{{ STATIC_URL }}' + name)
+
+    def test_bundle_is_rebuilt_when_an_imported_less_file_changes(self):
+        self.build()
+        self.write('static/less/colors.less', '.colors { color: blue; }\n')
+        self.assertEqual(len(self.build()), 1)
+        self.assertEqual(self.build(), [])
+
+    def test_bundle_is_rebuilt_when_base_html_links_another_name(self):
+        name, = self.build()
+        # As if base.html had been checked out from before the last build
+        self.write_base_html(['less/site.less'])
+        self.assertEqual(self.build(), [name])
+        self.assertEqual(self.linked_name(), '{{ STATIC_URL }}' + name)
+
+    def test_force_rebuilds_an_unchanged_bundle(self):
+        name, = self.build()
+        self.assertEqual(self.build(force=True), [name])
+
+    def test_pool_concatenates_files_in_base_html_order(self):
+        self.write('static/css/b.css', '.b { top: 0; }\n')
+        self.write('static/css/a.css', '.a { left: 0; }\n')
+        self.write_base_html(['css/b.css', 'less/site.less', 'css/a.css'])
+        with mock.patch.object(self.fabfile, 'STATIC_BUILD_PROCESSES', 3):
+            with mock.patch.object(self.fabfile.multiprocessing, 'Pool',
+                                   wraps=multiprocessing.Pool) as pool:
+                self.build()
+        pool.assert_called_once_with(3)
+        (name, content, content_type), = self.uploads
+        positions = [content.index(selector) for selector in ('.b{', '.site{', '.a{')]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_lessc_failure_is_raised_and_the_build_directory_removed(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.write('static/less/broken.less', '.broken {\n')
+        self.write_base_html(['less/site.less', 'less/broken.less'])
+        with mock.patch.object(self.fabfile, 'STATIC_BUILD_PROCESSES', 2):
+            with mock.patch.object(tempfile, 'tempdir', temp_dir):
+                self.assertRaises(RuntimeError, self.build)
+        self.assertEqual(os.listdir(temp_dir), [])
+        self.assertEqual(self.uploads, [])
@@ -0,0 +1,156 @@
+"""
+Thumbnails of Photos used by the templates
+
+Thumbnails are generated ahead of time, when photos are ingested or by the
+warm_thumbnails command, so public pages never have to download an original
+from S3, resize it and upload the result in the middle of a request.
+"""
+import itertools
+import logging
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from sorl.thumbnail import default
+from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.conf import defaults as default_settings, settings as thumbnail_settings
+from sorl.thumbnail.helpers import toint
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.parsers import parse_geometry
+
+logger = logging.getLogger(__name__)
+
+# Every geometry the templates pass to {% thumbnail %}, and whether only
+# landscape photos are shown at it
+THUMBNAIL_GEOMETRIES = (
+    ('748', False),      # gallery photos in home.html and post.html
+    ('348x232', True),   # gallery covers in galleries.html
+)
+
+# Thumbnails of images that aren't Photos, as (source, geometry, options)
+SOURCE_THUMBNAILS = (
+    ('http://d2blg18fh6tpw9.cloudfront.net/images/brian.jpg', '240x245', {'crop': 'center'}),  # about.html
+)
+
+
+def geometries_for(photo):
+    """
+    Returns the geometries a photo's thumbnails are needed at
+    """
+    landscape = photo.width > photo.height
+    return [geometry for geometry, landscape_only in THUMBNAIL_GEOMETRIES
+            if landscape or not landscape_only]
+
+
+class PrewarmedThumbnailBackend(ThumbnailBackend):
+    """
+    Thumbnail backend for THUMBNAIL_BACKEND that never generates thumbnails
+    while rendering a page
+
+    A thumbnail that hasn't been generated yet falls back to the original
+    image, sized as the thumbnail would be, and is logged so the gap can be
+    filled by the warm_thumbnails command
+    """
+    def get_thumbnail(self, file_, geometry_string, **options):
+        thumbnail = self.get_cached_thumbnail(file_, geometry_string, **options)
+        if thumbnail:
+            return thumbnail
+        logger.warning('Thumbnail "%s" of %s has not been generated', geometry_string, file_)
+        return self.get_fallback(file_, geometry_string)
+
+    def get_cached_thumbnail(self, file_, geometry_string, **options):
+        """
+        Returns the thumbnail from the key value store, or None
+        """
+        source = ImageFile(file_)
+        for key, value in self.default_options.iteritems():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(thumbnail_settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+        name = self._get_thumbnail_filename(source, geometry_string, options)
+        return default.kvstore.get(ImageFile(name, default.storage))
+
+    def generate(self, file_, geometry_string, **options):
+        """
+        Returns the thumbnail, generating it if it doesn't exist yet
+        """
+        return super(PrewarmedThumbnailBackend, self).get_thumbnail(file_, geometry_string, **options)
+
+    def get_fallback(self, file_, geometry_string):
+        """
+        Returns the original image with the size a thumbnail of it would have,
+        worked out from the Photo's width and height
+        """
+        image = ImageFile(file_)
+        photo = getattr(file_, 'instance', None)
+        width, height = getattr(photo, 'width', None), getattr(photo, 'height', None)
+        if width and height:
+            geometry = parse_geometry(geometry_string, float(width) / height)
+            factor = min(float(geometry[0]) / width, float(geometry[1]) / height)
+            image.set_size((toint(width * factor), toint(height * factor)))
+        else:
+            image.set_size(parse_geometry(geometry_string, 1))
+        return image
+
+
+def pop_thumbnails(image):
+    """
+    Removes an image and its thumbnails from the key value store and returns
+    the names of the thumbnail files, leaving the files for the caller to
+    delete in bulk
+    """
+    source = ImageFile(image)
+    names = []
+    for key in default.kvstore._get(source.key, identity='thumbnails') or []:
+        thumbnail = default.kvstore._get(key)
+        if thumbnail:
+            names.append(thumbnail.name)
+            default.kvstore._delete(key)
+    default.kvstore._delete(source.key, identity='thumbnails')
+    default.kvstore._delete(source.key)
+    return names
+
+
+def _generate(args):
+    """
+    Runs in the pool's threads. Returns whether the thumbnail had to be made.
+    """
+    image, geometry, options = args
+    if default.backend.get_cached_thumbnail(image, geometry, **options):
+        return False
+    default.backend.generate(image, geometry, **options)
+    return True
+
+
+def warm_thumbnails(photos, threads=None, include_sources=False, progress=None):
+    """
+    Generates any of the photos' thumbnails, and the SOURCE_THUMBNAILS if
+    include_sources is True, that don't exist yet
+
+    Generating is bound by reading originals from and writing thumbnails to
+    S3, so it runs on THUMBNAIL_WARM_THREADS threads. Returns the number of
+    thumbnails generated.
+
+    progress, if given, is called with the number of thumbnails done so far
+    and the total number of thumbnails as each one is done
+    """
+    if threads is None:
+        threads = getattr(settings, 'THUMBNAIL_WARM_THREADS', 4)
+    jobs = [(photo.image, geometry, {}) for photo in photos if photo.image
+            for geometry in geometries_for(photo)]
+    if include_sources:
+        jobs.extend(SOURCE_THUMBNAILS)
+    pool = ThreadPool(threads) if threads > 1 else None
+    results = pool.imap_unordered(_generate, jobs) if pool else itertools.imap(_generate, jobs)
+    generated = 0
+    try:
+        for done, made in enumerate(results, 1):
+            generated += made
+            if progress:
+                progress(done, len(jobs))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return generated
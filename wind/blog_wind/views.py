@@ -1,35 +1,81 @@
+from django.conf import settings
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.http import Http404
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponsePermanentRedirect
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
 
-from blog_wind.models import Post
+from blog_wind.conditional import conditional_on
+from blog_wind.models import Gallery, Post, PostToken
+from blog_wind.pagination import encode_cursor, keyset_page
 
+POSTS_PER_PAGE = 5
+SEARCH_RESULT_COUNT = 20
 
-def home(request, page=1):
+
+@conditional_on(lambda page=None, older_than=None, newer_than=None: Post.objects.get_posted())
+def home(request, page=None, older_than=None, newer_than=None):
     """
     Home page for blog
 
     Will display most recents posts regardless of
     if they are essays or galleries
-    """
-
-    all_posts = Post.objects.get_posted()
 
-    paginator = Paginator(all_posts, 5)
+    With HOME_PAGINATION = 'keyset', pages are linked by the posts either side
+    of them, and numbered pages redirect to the same posts' keyset page
+    """
 
-    # if page number out of range, give last page
-    try:
-        posts = paginator.page(page)
-    except (EmptyPage, InvalidPage):
-        posts = paginator.page(paginator.num_pages)
+    # Galleries and their photos are loaded for the whole page at once,
+    # instead of once per post as the template follows them
+    all_posts = Post.objects.get_posted().select_related('gallery').prefetch_related('gallery__photos')
+
+    if older_than or newer_than:
+        try:
+            posts = keyset_page(all_posts, POSTS_PER_PAGE, older_than, newer_than)
+        except ValueError:
+            raise Http404
+        older_url = posts.has_older and reverse('older_home', args=[posts.older_cursor])
+        newer_url = posts.has_newer and reverse('newer_home', args=[posts.newer_cursor])
+    elif getattr(settings, 'HOME_PAGINATION', 'offset') == 'keyset':
+        if page is not None:
+            return paged_home_redirect(all_posts, int(page))
+        posts = keyset_page(all_posts, POSTS_PER_PAGE)
+        older_url = posts.has_older and reverse('older_home', args=[posts.older_cursor])
+        newer_url = None
+    else:
+        paginator = Paginator(all_posts, POSTS_PER_PAGE)
+
+        # if page number out of range, give last page
+        try:
+            posts = paginator.page(page or 1)
+        except (EmptyPage, InvalidPage):
+            posts = paginator.page(paginator.num_pages)
+        older_url = posts.has_next() and reverse('paged_home', args=[posts.next_page_number()])
+        newer_url = posts.has_previous() and reverse('paged_home', args=[posts.previous_page_number()])
 
     variables = RequestContext(request, {
-        'posts': posts
+        'posts': posts,
+        'older_url': older_url,
+        'newer_url': newer_url,
     })
     return render_to_response('home.html', variables)
 
 
+def paged_home_redirect(all_posts, page):
+    """
+    Permanently redirects a numbered page to the keyset page with the same
+    posts, so old links and crawlers move over to URLs that stay cheap
+    """
+    if page <= 1:
+        return HttpResponsePermanentRedirect(reverse('home'))
+    try:
+        newer = all_posts.order_by('-publish_at', '-pk')[(page - 1) * POSTS_PER_PAGE - 1]
+    except IndexError:
+        raise Http404
+    return HttpResponsePermanentRedirect(reverse('older_home', args=[encode_cursor(newer)]))
+
+
+@conditional_on(lambda slug: Post.objects.get_posted().filter(slug=slug))
 def post(request, slug):
     """
     Displays an individual post
@@ -38,7 +84,8 @@ def post(request, slug):
     """
 
     try:
-        post = Post.objects.get_posted().get(slug=slug)
+        post = (Post.objects.get_posted().select_related('gallery').prefetch_related('gallery__photos')
+                .get(slug=slug))
     except Post.DoesNotExist:
         raise Http404
 
@@ -55,7 +102,8 @@ def preview(request, slug):
     Post does not need to be active and publish date can be in future
     """
 
-    post = get_object_or_404(Post, slug=slug)
+    post = get_object_or_404(Post.objects.select_related('gallery').prefetch_related('gallery__photos'),
+                             slug=slug)
 
     variables = RequestContext(request, {
         'post': post
@@ -63,6 +111,7 @@ def preview(request, slug):
     return render_to_response('preview.html', variables)
 
 
+@conditional_on(lambda: Post.objects.get_posted().filter(gallery__isnull=True))
 def writing(request):
     """
     A page that will list all of the posts that are writing only
@@ -76,14 +125,34 @@ def writing(request):
     return render_to_response('writing.html', variables)
 
 
+@conditional_on(lambda: Post.objects.get_posted().filter(gallery__isnull=False))
 def galleries(request):
     """
     A page that will list all of the posts that are galleries only
     """
 
-    galleries = Post.objects.get_posted().filter(gallery__isnull=False)
+    galleries = list(Post.objects.get_posted().filter(gallery__isnull=False).select_related('gallery'))
+    Gallery.objects.attach_covers([gallery_post.gallery for gallery_post in galleries])
 
     variables = RequestContext(request, {
         'galleries': galleries
     })
     return render_to_response('galleries.html', variables)
+
+
+def search(request):
+    """
+    Lists the posts containing every word searched for, most relevant first
+
+    Posts are looked up in the PostToken index, so only the rows of the
+    words searched for are read
+    """
+
+    query = request.GET.get('q', '').strip()
+    results = PostToken.objects.search(query, Post.objects.get_posted(), SEARCH_RESULT_COUNT) if query else []
+
+    variables = RequestContext(request, {
+        'query': query,
+        'results': results
+    })
+    return render_to_response('search.html', variables)
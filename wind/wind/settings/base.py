@@ -43,13 +43,15 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
-    'django.middleware.cache.UpdateCacheMiddleware',
+    # First, so cached pages are answered with a 304 when they match too
+    'django.middleware.http.ConditionalGetMiddleware',
+    'blog_wind.middleware.UpdateCacheMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
+    'blog_wind.middleware.FetchFromCacheMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -123,13 +125,19 @@ RUN_TESTS = True
 TEST_APPS = ['blog_wind']
 APPS_TO_MIGRATE = ['blog_wind']
 REQUIREMENTS_FILE_PATH = "../requirements.txt"
+# Records what the static bundles were last built from, so unchanged ones
+# are skipped
+STATIC_BUILD_MANIFEST = "%s/static_build.json" % PROJECT_ROOT
 
 # Grappelli settings
 GRAPPELLI_ADMIN_TITLE = "Brian Holdefehr"
 
 CACHE_MIDDLEWARE_ALIAS = 'default'
-CACHE_MIDDLEWARE_SECONDS = (60 * 60)
+# Cached pages are invalidated when what they show changes, see blog_wind.cache
+CACHE_MIDDLEWARE_SECONDS = (60 * 60 * 24 * 7)
 CACHE_MIDDLEWARE_PREFIX = ''
+# How long browsers may keep a page, since they can't be told it changed
+PAGE_CACHE_MAX_AGE = (60 * 5)
 
 SECRET_KEY = os.environ['FISH_SECRET_KEY']
 
@@ -146,12 +154,64 @@ AWS_HEADERS = {
     'Cache-Control': 'max-age=31536000, public'
 }
 
-# Uploaded media, and static files via collectstatic both use this backend to
-# send files to s3
-DEFAULT_FILE_STORAGE = STATICFILES_STORAGE = 'wind.storage.StaticToS3Storage'
+# Uploaded media, and static files via collectstatic both use these backends to
+# send files to s3. Uploads are given unique names, while static files and
+# thumbnails, whose names sorl-thumbnail works out itself, overwrite the old file
+DEFAULT_FILE_STORAGE = 'wind.storage.MediaToS3Storage'
+STATICFILES_STORAGE = THUMBNAIL_STORAGE = 'wind.storage.StaticToS3Storage'
 
 # Toggles showing photos header link
 SHOW_PHOTOS = False
 
 # Toggles showing github links
 SHOW_GITHUB = False
+
+# Max number of highlighted <pre> blocks kept before least recently used ones
+# are evicted
+HIGHLIGHT_CACHE_MAX_ENTRIES = 2000
+
+# Gallery uploads decode and validate images on this many processes (0 decodes
+# in the request's own process) and upload them to storage on this many threads
+GALLERY_DECODE_PROCESSES = 2
+GALLERY_UPLOAD_THREADS = 4
+
+# Images from gallery uploads are streamed out of the .zip file into memory up
+# to this many bytes, and spooled to disk past it. Peak memory use is roughly
+# this times (GALLERY_DECODE_PROCESSES + GALLERY_UPLOAD_THREADS)
+GALLERY_UPLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Times a failed upload of a single gallery image is retried before the whole
+# gallery upload fails
+GALLERY_UPLOAD_RETRIES = 2
+
+# Running gallery uploads that record no progress for this many minutes are
+# put back in the queue, e.g. after their worker was killed
+GALLERY_UPLOAD_LEASE_MINUTES = 15
+
+# Thumbnails are generated when galleries are uploaded, or by the
+# warm_thumbnails command, on this many threads and never while rendering pages
+THUMBNAIL_BACKEND = 'blog_wind.thumbnails.PrewarmedThumbnailBackend'
+THUMBNAIL_WARM_THREADS = 4
+
+# How the photo shown for each gallery on the photos page is chosen: 'random'
+# picks one of its landscape photos on every request, 'cover' always shows the
+# gallery's cover so the page can be cached
+GALLERY_COVER_MODE = 'random'
+
+# How the home page is paginated: 'offset' numbers the pages, which costs a
+# COUNT(*) and an OFFSET that grow with the archive, 'keyset' links each page
+# by the posts either side of it and redirects numbered pages there
+HOME_PAGINATION = 'keyset'
+
+# Where render_static writes the public pages, and the prefix of their keys
+# on S3 when it uploads them
+STATIC_EXPORT_ROOT = '%s/export' % PROJECT_ROOT
+STATIC_EXPORT_S3_PREFIX = 'site/'
+
+# The feed's number of posts, and whether it only has the first
+# FEED_SUMMARY_WORDS words of each
+FEED_ITEM_COUNT = 10
+FEED_SUMMARY_ONLY = False
+FEED_SUMMARY_WORDS = 50
+# Where the rendered feed is kept, for when it isn't in the cache
+FEED_CACHE_ROOT = '%s/feeds' % PROJECT_ROOT
@@ -15,6 +15,11 @@ DATABASES = {
     }
 }
 
+# collectstatic is run from here, so the keys in the static files bucket are
+# kept track of here too, so it only asks S3 about files that changed
+STATICFILES_STORAGE = 'wind.storage.ManifestStaticToS3Storage'
+AWS_S3_KEY_MANIFEST = '%s/s3_keys.json' % PROJECT_ROOT
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
@@ -1,31 +1,356 @@
+import calendar
+import hashlib
+import httplib
+import json
+import logging
 import mimetypes
+import os
+import posixpath
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from gzip import GzipFile
+from StringIO import StringIO
+from tempfile import SpooledTemporaryFile, mkstemp
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from storages.backends.s3boto import S3BotoStorage
+from boto.exception import BotoServerError
 from boto.s3.key import Key
 
+logger = logging.getLogger(__name__)
+
+# Size of the pieces files are read and compressed in
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class _PartWriter(object):
+    """
+    File-like object for GzipFile to write to, which collects what's written
+    into parts that can be taken off one at a time
+    """
+    def __init__(self):
+        self.part = StringIO()
+
+    def write(self, data):
+        self.part.write(data)
+
+    def flush(self):
+        pass
+
+    def size(self):
+        return self.part.tell()
+
+    def take(self):
+        part, self.part = self.part, StringIO()
+        part.seek(0)
+        return part
+
 
 class StaticToS3Storage(S3BotoStorage):
     """
     Staticfile storage class to files to s3
 
     Needed to override save() in order to set rewind to True in set_contents_from_file call
+
+    Files are gzipped a chunk at a time. Ones of AWS_S3_MULTIPART_THRESHOLD
+    bytes or more are sent with a multipart upload, in parts of at least
+    AWS_S3_MULTIPART_CHUNK_SIZE bytes that are compressed as they're read,
+    so only about one part is held in memory, and a part that fails is
+    retried up to AWS_S3_MULTIPART_RETRIES times on its own
     """
+    def __init__(self, *args, **kwargs):
+        self.multipart_threshold = kwargs.pop('multipart_threshold', getattr(
+            settings, 'AWS_S3_MULTIPART_THRESHOLD', 16 * 1024 * 1024))
+        # S3 doesn't take parts smaller than 5MB, except for the last one
+        self.multipart_chunk_size = kwargs.pop('multipart_chunk_size', getattr(
+            settings, 'AWS_S3_MULTIPART_CHUNK_SIZE', 5 * 1024 * 1024))
+        self.multipart_retries = kwargs.pop('multipart_retries', getattr(
+            settings, 'AWS_S3_MULTIPART_RETRIES', 3))
+        super(StaticToS3Storage, self).__init__(*args, **kwargs)
+
+    def _content_type(self, name, content):
+        return getattr(content, 'content_type', mimetypes.guess_type(name)[0] or Key.DefaultContentType)
+
+    def _should_gzip(self, name, content):
+        return self.gzip and self._content_type(name, content) in self.gzip_content_types
+
     def save(self, name, content):
-        cleaned_name = self._clean_name(name)
-        name = self._normalize_name(cleaned_name)
+        cleaned_name = self._clean_name(self.get_available_name(name))
+        self._upload(self._normalize_name(cleaned_name), cleaned_name, content)
+        return cleaned_name
+
+    def _upload(self, name, cleaned_name, content):
+        """
+        Uploads content to the key name, and returns its etag
+        """
         headers = self.headers.copy()
-        content_type = getattr(content, 'content_type', mimetypes.guess_type(name)[0] or Key.DefaultContentType)
+        content_type = self._content_type(name, content)
+        gzip = self._should_gzip(name, content)
+        if gzip:
+            headers['Content-Encoding'] = 'gzip'
 
-        if self.gzip and content_type in self.gzip_content_types:
+        if content.size >= self.multipart_threshold:
+            headers['Content-Type'] = content_type
+            return self._multipart_upload(self._encode_name(name), content, headers, gzip)
+
+        if gzip:
             content = self._compress_content(content)
-            headers['Content-Encoding'] = 'gzip'
 
         content.name = cleaned_name
-        k = self.bucket.get_key(self._encode_name(name))
-        if not k:
-            k = self.bucket.new_key(self._encode_name(name))
-
+        # Keys are overwritten, so there's no need to look the old one up first
+        k = self.bucket.new_key(self._encode_name(name))
         k.set_metadata('Content-Type', content_type)
         k.set_contents_from_file(content, headers=headers, policy=self.acl,
                                  reduced_redundancy=self.reduced_redundancy, rewind=True)
+        return k.etag
+
+    def _compress_content(self, content):
+        """
+        Gzips content a chunk at a time, into a temporary file that's only
+        kept in memory while it's smaller than a multipart chunk
+        """
+        zbuf = SpooledTemporaryFile(max_size=self.multipart_chunk_size)
+        # mtime is left out so the same file always compresses the same
+        zfile = GzipFile(mode='wb', compresslevel=6, fileobj=zbuf, mtime=0)
+        for chunk in content.chunks(READ_CHUNK_SIZE):
+            zfile.write(chunk)
+        zfile.close()
+        zbuf.seek(0)
+        content.file = zbuf
+        return content
+
+    def _iter_parts(self, content, gzip):
+        """
+        Yields the parts content is uploaded in, gzipping it on the way if
+        gzip is set
+        """
+        writer = _PartWriter()
+        zfile = GzipFile(mode='wb', compresslevel=6, fileobj=writer, mtime=0) if gzip else None
+        parts = 0
+        for chunk in content.chunks(READ_CHUNK_SIZE):
+            (zfile or writer).write(chunk)
+            if writer.size() >= self.multipart_chunk_size:
+                parts += 1
+                yield writer.take()
+        if zfile:
+            zfile.close()
+        if writer.size() or not parts:
+            yield writer.take()
+
+    def _multipart_upload(self, name, content, headers, gzip):
+        """
+        Uploads content in parts, cancelling the upload if a part can't be
+        sent, so S3 doesn't keep the parts that were
+
+        Returns the etag of the uploaded key
+        """
+        upload = self.bucket.initiate_multipart_upload(name, headers=headers, policy=self.acl,
+                                                       reduced_redundancy=self.reduced_redundancy)
+        try:
+            for number, part in enumerate(self._iter_parts(content, gzip), 1):
+                self._upload_part(upload, part, number)
+            return upload.complete_upload().etag
+        except Exception:
+            upload.cancel_upload()
+            raise
+
+    def _upload_part(self, upload, part, number):
+        for attempt in range(1, self.multipart_retries + 1):
+            try:
+                upload.upload_part_from_file(part, number, size=part.len)
+                return
+            except (BotoServerError, socket.error, httplib.HTTPException):
+                if attempt == self.multipart_retries:
+                    raise
+                logger.warning('Retrying part %s of %s to S3 after attempt %s failed',
+                               number, upload.key_name, attempt, exc_info=True)
+                part.seek(0)
+
+    def delete_many(self, names):
+        """
+        Deletes files with S3's multi-object delete, which takes up to 1000 keys
+        per request, over the storage's one connection
+        """
+        keys = [self._encode_name(self._normalize_name(self._clean_name(name))) for name in names]
+        if not keys:
+            return
+        result = self.bucket.delete_keys(keys, quiet=True)
+        for error in result.errors:
+            logger.warning('Failed to delete %s from S3: %s', error.key, error.message)
+
+
+class MediaToS3Storage(StaticToS3Storage):
+    """
+    Storage class for uploaded media, which never overwrites a file with
+    another uploaded under the same name, e.g. two IMG_0001.jpg on one day
+    """
+    def get_available_name(self, name):
+        """
+        Adds a random suffix to name
+
+        Unlike Django's numbered names this doesn't ask S3 whether the name is
+        taken, which two threads uploading at once could both be told it isn't
+        """
+        dir_name, file_name = posixpath.split(self._clean_name(name))
+        file_root, file_ext = posixpath.splitext(file_name)
+        return posixpath.join(dir_name, '{0}_{1}{2}'.format(file_root, uuid.uuid4().hex[:8], file_ext))
+
+
+class ManifestStaticToS3Storage(StaticToS3Storage):
+    """
+    Static files storage that keeps the keys in the bucket in the file
+    AWS_S3_KEY_MANIFEST, along with a hash of their contents, built from one
+    listing of the bucket
+
+    exists() and modified_time() are answered from it, and saving a file
+    whose contents haven't changed doesn't upload it again. Saves only change
+    the manifest in memory, call save_keys() to write it, as collectstatic
+    does once it's done
+    """
+    def __init__(self, *args, **kwargs):
+        self.key_manifest = kwargs.pop('key_manifest', getattr(settings, 'AWS_S3_KEY_MANIFEST', None))
+        if not self.key_manifest:
+            raise ImproperlyConfigured('ManifestStaticToS3Storage needs AWS_S3_KEY_MANIFEST to be set')
+        self._keys = None
+        self._keys_changed = False
+        # Saves may come from several threads at once
+        self._keys_lock = threading.RLock()
+        super(ManifestStaticToS3Storage, self).__init__(*args, **kwargs)
+
+    @property
+    def keys(self):
+        """
+        The keys in the bucket, mapped to the hash of their contents, their
+        etag and when they were modified, loaded from the key manifest or
+        listed from the bucket if there isn't one for this bucket yet
+        """
+        with self._keys_lock:
+            if self._keys is None:
+                keys = self._read_keys()
+                if keys is None:
+                    self.refresh_keys()
+                else:
+                    self._keys = keys
+            return self._keys
+
+    def _read_keys(self):
+        if not os.path.exists(self.key_manifest):
+            return None
+        with open(self.key_manifest) as f:
+            manifest = json.load(f)
+        return manifest['keys'] if manifest.get('bucket') == self.bucket_name else None
+
+    def _write_keys(self):
+        # Written to a file of its own and renamed over the manifest in one
+        # step, so an interrupted or concurrent write doesn't lose it
+        directory, filename = os.path.split(os.path.abspath(self.key_manifest))
+        fd, temp_path = mkstemp(prefix=filename + '.', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'bucket': self.bucket_name, 'keys': self._keys}, f, indent=1, sort_keys=True)
+            os.rename(temp_path, self.key_manifest)
+        except:
+            os.remove(temp_path)
+            raise
+        self._keys_changed = False
+
+    def save_keys(self):
+        """
+        Writes the key manifest if saves or deletes changed it
+        """
+        with self._keys_lock:
+            if self._keys_changed:
+                self._write_keys()
+
+    def refresh_keys(self):
+        """
+        Rebuilds the key manifest from one listing of the bucket
+
+        Hashes are kept for the keys whose etag is the one recorded with
+        them. Keys changed by anything else lose theirs, so they're uploaded
+        again the next time they're saved
+        """
+        with self._keys_lock:
+            old_keys = self._keys if self._keys is not None else self._read_keys() or {}
+            keys = {}
+            for key in self.bucket.list():
+                name = self._decode_name(key.name)
+                old = old_keys.get(name, {})
+                keys[name] = {
+                    'hash': old.get('hash') if old.get('etag') == key.etag else None,
+                    'etag': key.etag,
+                    'modified': calendar.timegm(time.strptime(key.last_modified[:19], '%Y-%m-%dT%H:%M:%S')),
+                }
+            self._keys = keys
+            self._write_keys()
+
+    def _key_name(self, name):
+        return self._normalize_name(self._clean_name(name))
+
+    def _content_hash(self, name, content):
+        """
+        Returns a hash of content and how it would be stored under name
+        """
+        digest = hashlib.md5()
+        digest.update(self._content_type(name, content))
+        digest.update('\0gzip\0' if self._should_gzip(name, content) else '\0\0')
+        for chunk in content.chunks(READ_CHUNK_SIZE):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def _entry(self, name):
+        with self._keys_lock:
+            return self.keys.get(self._key_name(name))
+
+    def unchanged(self, name, content):
+        """
+        Returns whether the key name was last saved with the same contents
+        as content, according to the key manifest
+        """
+        entry = self._entry(name)
+        return bool(entry) and entry['hash'] == self._content_hash(self._key_name(name), content)
+
+    def exists(self, name):
+        return self._entry(name) is not None
+
+    def modified_time(self, name):
+        entry = self._entry(name)
+        if entry is None:
+            raise OSError('{0} is not in the key manifest'.format(name))
+        # In local time, like S3BotoStorage's
+        return datetime.fromtimestamp(entry['modified'])
+
+    def save(self, name, content):
+        cleaned_name = self._clean_name(self.get_available_name(name))
+        name = self._normalize_name(cleaned_name)
+        content_hash = self._content_hash(name, content)
+        entry = self._entry(name)
+        if entry and entry['hash'] == content_hash:
+            return cleaned_name
+
+        etag = self._upload(name, cleaned_name, content)
+        with self._keys_lock:
+            self.keys[name] = {'hash': content_hash, 'etag': etag, 'modified': time.time()}
+            self._keys_changed = True
         return cleaned_name
+
+    def delete(self, name):
+        super(ManifestStaticToS3Storage, self).delete(name)
+        self._forget_keys([name])
+
+    def delete_many(self, names):
+        super(ManifestStaticToS3Storage, self).delete_many(names)
+        self._forget_keys(names)
+
+    def _forget_keys(self, names):
+        # Written straight away, since a deleted key left in the manifest
+        # would stop the file being uploaded again
+        with self._keys_lock:
+            for name in names:
+                if self.keys.pop(self._key_name(name), None):
+                    self._keys_changed = True
+            self.save_keys()
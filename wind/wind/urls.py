@@ -3,8 +3,6 @@ from django.conf import settings
 from django.contrib import admin
 from django.views.generic.simple import direct_to_template
 
-from blog_wind.feeds import RecentFeed
-
 admin.autodiscover()
 
 urlpatterns = patterns('',
@@ -19,13 +17,16 @@ urlpatterns = patterns('',
     # Blog
     url(r'^$', 'blog_wind.views.home', name='home'),
     url(r'^page/(?P<page>\d+)$', 'blog_wind.views.home', name='paged_home'),
+    url(r'^older/(?P<older_than>\d{20}-\d+)$', 'blog_wind.views.home', name='older_home'),
+    url(r'^newer/(?P<newer_than>\d{20}-\d+)$', 'blog_wind.views.home', name='newer_home'),
     url(r'^writing$', 'blog_wind.views.writing', name='writing'),
     url(r'^photos$', 'blog_wind.views.galleries', name='galleries'),
     url(r'^about$', direct_to_template, {'template': 'about.html'}, name='about'),
+    url(r'^search$', 'blog_wind.views.search', name='search'),
     url(r'^preview/(?P<slug>[-\w]+)$', 'blog_wind.views.preview', name='preview'),
     url(r'^(?P<slug>[-\w]+)$', 'blog_wind.views.post', name='post'),
     # RSS
-    url(r'^feeds/recent$', RecentFeed(), name='feed'),
+    url(r'^feeds/recent$', 'blog_wind.feeds.recent_feed', name='feed'),
     #Media
     (r'media/(?P<path>.*)$', 'django.views.static.serve', {'document_root': settings.MEDIA_ROOT}),
     #Static Media